@@ -0,0 +1,81 @@
+'''
+djclient.py
+
+A thin client for "djcontrol.py daemon", for Liquidsoap to call instead of
+starting djcontrol.py itself. It only uses the standard library, so it starts
+quickly and leaves the API connection to the daemon.
+'''
+
+import argparse
+import os
+import socket
+import sys
+
+
+DJ_SOCKET = os.environ.get('DJ_SOCKET', './djcontrol.sock')
+
+
+def send_command(socket_path, command):
+    '''
+    Sends one command to the daemon and returns its answer.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(10)
+        client.connect(socket_path)
+        client.sendall((command + '\n').encode('utf8'))
+        with client.makefile('r', encoding='utf8') as reader:
+            return reader.readline().rstrip('\n')
+
+
+def main():
+    '''Main loop of the program'''
+    description = 'Sends a command to the running djcontrol daemon.'
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '--socket',
+        help='Path of the daemon\'s Unix socket.',
+        default=DJ_SOCKET
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser(
+        'next',
+        help='Gets the next song from the radio.'
+    )
+
+    parser_played = subparsers.add_parser(
+        'played',
+        help='Tells the radio which song just played.'
+    )
+    parser_played.add_argument(
+        'request',
+        help='Song request ID number.',
+        nargs=1,
+        type=int
+    )
+
+    args = parser.parse_args()
+
+    if args.command == 'next':
+        command = 'next'
+    elif args.command == 'played':
+        command = 'played {}'.format(args.request[0])
+    else:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    try:
+        reply = send_command(args.socket, command)
+    except OSError as err:
+        sys.stderr.write('Could not reach djcontrol daemon: {}\n'.format(err))
+        sys.exit(1)
+
+    if reply:
+        print(reply)
+    if reply == 'ERROR':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,54 @@ djcontrol.py
 This is the helper script that glues the webapi/database to the liquidsoap
 application. We make RESTful requests here to get the next song and to report
 when a song has been played.
+
+Run with "daemon" to keep one process (and one keep-alive connection to the
+API) around, answering commands over a Unix socket (or stdin/stdout with
+"--stdio") one line at a time:
+
+    next             -> annotate string (empty line on failure)
+    played <req_id>  -> OK (or ERROR)
+
+Liquidsoap can then talk to it with the "djclient.py" script next to this one,
+or with something like "socat - UNIX-CONNECT:./djcontrol.sock".
+
+So that the stream doesn't go silent when the API is slow or down, a few
+state files are kept in DJ_STATE_DIR:
+
+    fallback.json  the last DJ_FALLBACK_SIZE songs the API gave us, played
+                   (oldest first) when the API misses DJ_LATENCY_BUDGET seconds
+    pending.json   the idempotency key of a "next" call that got no answer,
+                   sent again with the following one so a song the web service
+                   queued in the meantime is handed back instead of lost
+    played.spool   "played" reports that couldn't be sent yet, replayed in
+                   batches (with the time they were really played) through
+                   the bulk "played" endpoint once the API is back
+
+Songs are only ever asked for when Liquidsoap wants one, since asking the web
+service queues the song (and moves its "playing now" and replay times).
+
+The state files are guarded with a lock file, so the daemon and any number of
+one-shot "next" and "played" runs can share a state directory.
 '''
 
 import argparse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import fcntl
+import hashlib
 import json
 import logging
 from logging.handlers import RotatingFileHandler
+import os
+import socket
+import socketserver
+import sys
+import threading
+import uuid
 
 from decouple import config
 import requests
+from requests.adapters import HTTPAdapter
 
 
 DJ_TOKEN = config('DJ_TOKEN')
@@ -21,6 +60,31 @@ API_URL = config('API_URL')  # With trailing slash
 
 RADIO_NAME = config('RADIO_NAME')
 
+DJ_SOCKET = config('DJ_SOCKET', default='./djcontrol.sock')
+
+# Local state kept so playout carries on while the API is slow or down
+STATE_DIR = config('DJ_STATE_DIR', default='./djstate')
+
+FALLBACK_SIZE = config('DJ_FALLBACK_SIZE', default=50, cast=int)
+
+LATENCY_BUDGET = config('DJ_LATENCY_BUDGET', default=2.0, cast=float)
+
+REFRESH_INTERVAL = config('DJ_REFRESH_INTERVAL', default=15.0, cast=float)
+
+LOCK_FILE = 'state.lock'
+
+FLUSH_LOCK_FILE = 'flush.lock'
+
+PENDING_FILE = 'pending.json'
+
+FALLBACK_FILE = 'fallback.json'
+
+SPOOL_FILE = 'played.spool'
+
+SPOOL_BATCH_SIZE = 500  # Played reports replayed per request
+
+FALLBACK_ID = 0  # Request ID given to songs played from the fallback list
+
 HEADERS = {
     'Content-Type': 'application/json; charset=utf-8',
     'Authorization': 'Token {}'.format(DJ_TOKEN)
@@ -51,6 +115,14 @@ logging.basicConfig(
     )
 LOGGER = logging.getLogger('djcontrol')
 
+# One pooled, keep-alive session for every request to the API
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+REFRESH = threading.Event()
+
 
 def clean_quotes(unclean_string):
     '''
@@ -69,18 +141,145 @@ def beautify_artists(artists):
     return clean_quotes(output.join(artists))
 
 
-def next_request():
+def annotate(request_id, song):
+    '''
+    Turns a song from the API into a Liquidsoap annotate string.
+    '''
+    if song['song_type'] == 'J':
+        artist = RADIO_NAME
+        title = 'Jingle'
+        game = RADIO_NAME
+    else:
+        artist = beautify_artists(song['artists'])
+        title = clean_quotes(song['title'])
+        game = clean_quotes(song['game'])
+    return ANNOTATE.format(
+        request_id,
+        song['song_type'],
+        artist,
+        title,
+        game,
+        song['replaygain'],
+        song['path']
+    )
+
+
+@contextmanager
+def state_lock(filename=LOCK_FILE, wait=True):
+    '''
+    Holds an exclusive lock on the state directory, shared with every other
+    djcontrol process and thread using it. Without waiting, it yields whether
+    the lock could be taken right away.
+    '''
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, filename), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file,
+                        fcntl.LOCK_EX if wait else
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(filename, default):
+    '''
+    Reads one of the JSON state files, or returns the default if it doesn't
+    exist (or is unreadable).
+    '''
+    try:
+        with open(os.path.join(STATE_DIR, filename), encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(filename, data):
+    '''
+    Atomically replaces one of the JSON state files.
+    '''
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, filename)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def remember_fallback(song):
+    '''
+    Keeps a song the API gave us in the fallback list, without its request ID
+    so playing it again later isn't reported back.
+    '''
+    entry = annotate(FALLBACK_ID, song)
+    with state_lock():
+        fallback = read_json(FALLBACK_FILE, [])
+        fallback = [f for f in fallback if f != entry] + [entry]
+        write_json(FALLBACK_FILE, fallback[-FALLBACK_SIZE:])
+
+
+def pick_fallback():
+    '''
+    Returns the cached song that was played the longest ago, if any, and moves
+    it to the back of the list.
+    '''
+    with state_lock():
+        fallback = read_json(FALLBACK_FILE, [])
+        if not fallback:
+            return None
+        entry = fallback.pop(0)
+        write_json(FALLBACK_FILE, fallback + [entry])
+    return entry
+
+
+def pending_key():
+    '''
+    Returns the idempotency key of the "next" call that last went unanswered,
+    or a new one if the last call was answered.
+    '''
+    with state_lock():
+        idempotency_key = read_json(PENDING_FILE, None)
+        if idempotency_key is None:
+            idempotency_key = uuid.uuid4().hex
+            write_json(PENDING_FILE, idempotency_key)
+    return idempotency_key
+
+
+def clear_pending_key(idempotency_key):
+    '''
+    Forgets a "next" call's idempotency key once it has been answered.
+    '''
+    with state_lock():
+        if read_json(PENDING_FILE, None) == idempotency_key:
+            os.remove(os.path.join(STATE_DIR, PENDING_FILE))
+
+
+def fetch_request(timeout):
     '''
     Sends an HTTP[S] request to the radio web service to retrieve the next
-    requested song.
+    requested song, and returns it as a Liquidsoap annotate string. If the
+    last request went unanswered, its idempotency key is sent again so the
+    song it may have queued is the one we get.
     '''
-    LOGGER.debug('Received command to get next song request.')
+    idempotency_key = pending_key()
     try:
-        resp = requests.get(API_URL + 'next/', headers=HEADERS, timeout=5)
+        resp = SESSION.get(
+            API_URL + 'next/',
+            headers={'Idempotency-Key': idempotency_key},
+            timeout=timeout
+        )
         resp.encoding = 'utf-8'
         resp.raise_for_status()
     except requests.exceptions.HTTPError as errh:
         LOGGER.error('Http Error: %s', errh)
+        # A 409 means the first attempt is still running, so keep its key
+        if errh.response is None or errh.response.status_code != 409:
+            clear_pending_key(idempotency_key)
     except requests.exceptions.ConnectionError as errc:
         LOGGER.error('Error Connecting: %s', errc)
     except requests.exceptions.Timeout as errt:
@@ -89,56 +288,77 @@ def next_request():
         LOGGER.error('Error: %s', err)
     else:
         LOGGER.debug('Received JSON response: %s', resp.text)
+        clear_pending_key(idempotency_key)
         song_request = json.loads(resp.text)
         song = song_request['song']
-        if song['song_type'] == 'J':
-            artist = RADIO_NAME
-            title = 'Jingle'
-            game = RADIO_NAME
-        else:
-            artist = beautify_artists(song['artists'])
-            title = clean_quotes(song['title'])
-            game = clean_quotes(song['game'])
-        LOGGER.info(
-            'ID: %s, Artist[s]: %s, Title: %s, Game: %s, Gain: %s, Path: %s',
-            song_request['id'],
-            artist,
-            title,
-            game,
-            song['replaygain'],
-            song['path']
-        )
-        annotate_string = ANNOTATE.format(
-            song_request['id'],
-            song['song_type'],
-            artist,
-            title,
-            game,
-            song['replaygain'],
-            song['path']
-        )
-        LOGGER.debug(annotate_string)
-        print(annotate_string)
+        annotate_string = annotate(song_request['id'], song)
+        LOGGER.info('ID: %s, %s', song_request['id'], annotate_string)
+        remember_fallback(song)
+        return annotate_string
+    return None
 
 
-def just_played(request_id):
+def next_request():
+    '''
+    Returns the next song to play: from the API within the latency budget,
+    and otherwise a song from the fallback list so the stream doesn't go
+    silent.
+    '''
+    LOGGER.debug('Received command to get next song request.')
+    annotate_string = fetch_request(timeout=LATENCY_BUDGET)
+    if annotate_string is None:
+        annotate_string = pick_fallback()
+        if annotate_string is not None:
+            LOGGER.warning('Playing from the fallback list: %s',
+                           annotate_string)
+    return annotate_string
+
+
+def spool_played(request_id, played_at):
+    '''
+    Durably queues a "played" report that couldn't be sent, to be replayed
+    later by flush_spool().
+    '''
+    entry = {'song_request': request_id, 'played_at': played_at}
+    with state_lock():
+        path = os.path.join(STATE_DIR, SPOOL_FILE)
+        with open(path, 'a', encoding='utf8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    LOGGER.warning('Spooled played report for Req_ID: %s', request_id)
+
+
+def read_spool():
+    '''
+    Returns every spooled "played" report, oldest first.
+    '''
+    try:
+        with open(os.path.join(STATE_DIR, SPOOL_FILE), encoding='utf8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def post_played(request_id, timeout):
     '''
     Sends an HTTP[S] request to the radio web service to let it know that a
-    song has been played.
+    song has been played. Returns True if it was accepted, False if it was
+    refused and None if it couldn't be delivered (and is worth retrying).
     '''
-    LOGGER.debug('Received command to report a song was just played.')
     try:
         request_played = json.dumps({'song_request': request_id})
-        resp = requests.post(
+        resp = SESSION.post(
             API_URL + 'played/',
-            headers=HEADERS,
             data=request_played,
-            timeout=5
+            timeout=timeout
         )
         resp.encoding = 'utf-8'
         resp.raise_for_status()
     except requests.exceptions.HTTPError as errh:
         LOGGER.error('Http Error: %s', errh)
+        if errh.response is not None and errh.response.status_code < 500:
+            return False
     except requests.exceptions.ConnectionError as errc:
         LOGGER.error('Error Connecting: %s', errc)
     except requests.exceptions.Timeout as errt:
@@ -147,6 +367,204 @@ def just_played(request_id):
         LOGGER.error('Error: %s', err)
     else:
         LOGGER.info('Req_ID: %s', request_id)
+        return True
+    return None
+
+
+def post_played_batch(entries, timeout):
+    '''
+    Sends a batch of spooled "played" reports to the radio web service in
+    one request. The batch is keyed by its contents, so if it is sent again
+    after a timeout the web service gives back its first answer. Returns
+    True if the batch was taken care of and None if it is worth retrying.
+    '''
+    batch = json.dumps({'played': entries})
+    idempotency_key = hashlib.sha1(batch.encode('utf8')).hexdigest()
+    try:
+        resp = SESSION.post(
+            API_URL + 'played/bulk/',
+            data=batch,
+            headers={'Idempotency-Key': idempotency_key},
+            timeout=timeout
+        )
+        resp.encoding = 'utf-8'
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as errh:
+        LOGGER.error('Http Error: %s', errh)
+        # A 409 means the first attempt is still running, so send it again
+        if (errh.response is not None and
+                errh.response.status_code < 500 and
+                errh.response.status_code != 409):
+            # The web service will never take this batch, so drop it.
+            LOGGER.error('Dropped spooled reports: %s', batch)
+            return True
+    except requests.exceptions.ConnectionError as errc:
+        LOGGER.error('Error Connecting: %s', errc)
+    except requests.exceptions.Timeout as errt:
+        LOGGER.error('Timeout Error: %s', errt)
+    except requests.exceptions.RequestException as err:
+        LOGGER.error('Error: %s', err)
+    else:
+        result = json.loads(resp.text)
+        LOGGER.info('Req_IDs: %s, already played: %s',
+                    result['played'], result['skipped'])
+        return True
+    return None
+
+
+def flush_spool(timeout=10):
+    '''
+    Replays the spooled "played" reports in batches (including any spooled
+    meanwhile), stopping at the first batch that still can't be delivered.
+    Nothing is done if another process is already replaying them.
+    '''
+    with state_lock(FLUSH_LOCK_FILE, wait=False) as flushing:
+        if not flushing:
+            return
+        while True:
+            with state_lock():
+                batch = read_spool()[:SPOOL_BATCH_SIZE]
+            if not batch:
+                return
+            LOGGER.info('Replaying %s spooled played reports.', len(batch))
+            if post_played_batch(batch, timeout=timeout) is None:
+                return
+            with state_lock():
+                # Keep anything spooled while we were replaying.
+                remaining = read_spool()[len(batch):]
+                path = os.path.join(STATE_DIR, SPOOL_FILE)
+                with open(path + '.tmp', 'w', encoding='utf8') as f:
+                    f.writelines(json.dumps(e) + '\n' for e in remaining)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.tmp', path)
+
+
+def just_played(request_id):
+    '''
+    Reports that a song has been played, spooling the report for later if the
+    web service can't be reached. Returns whether it was taken care of.
+    '''
+    LOGGER.debug('Received command to report a song was just played.')
+    if request_id == FALLBACK_ID:
+        return True
+    played_at = datetime.now(timezone.utc).isoformat()
+    result = post_played(request_id, timeout=LATENCY_BUDGET)
+    if result is None:
+        spool_played(request_id, played_at)
+        return True
+    if result:
+        REFRESH.set()
+    return result
+
+
+def spool_just_played(request_id):
+    '''
+    Reports that a song has been played by spooling the report straight away,
+    then replaying the spool if no other process is already doing so.
+    '''
+    LOGGER.debug('Received command to report a song was just played.')
+    if request_id == FALLBACK_ID:
+        return
+    spool_played(request_id, datetime.now(timezone.utc).isoformat())
+    flush_spool(timeout=LATENCY_BUDGET)
+
+
+def refresh_forever():
+    '''
+    Keeps the spool empty in the background, waking up early whenever a
+    report gets through (since the API is back).
+    '''
+    while True:
+        REFRESH.clear()
+        try:
+            flush_spool()
+        except Exception:
+            # Whatever went wrong (eg. the disk is full), keep trying, since
+            # nothing else replays the spool while the daemon runs.
+            LOGGER.exception('Could not replay the spooled reports.')
+        REFRESH.wait(REFRESH_INTERVAL)
+
+
+def handle_command(line):
+    '''
+    Runs a single line protocol command and returns the line to answer with.
+    '''
+    parts = line.split()
+    try:
+        if parts == ['next']:
+            return next_request() or ''
+        if len(parts) == 2 and parts[0] == 'played' and parts[1].isdigit():
+            return ('ERROR', 'OK')[just_played(int(parts[1]))]
+    except (KeyError, TypeError, ValueError, AttributeError, OSError):
+        # A malformed response (or a spool that can't be written) shouldn't
+        # take the whole daemon down.
+        LOGGER.exception('Could not handle command: %s', line.strip())
+        return 'ERROR'
+    LOGGER.warning('Unknown command: %s', line.strip())
+    return 'ERROR'
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    '''
+    Answers line protocol commands from a client connected to the socket.
+    '''
+    def handle(self):
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf8').strip()
+            if not line:
+                continue
+            reply = handle_command(line) + '\n'
+            self.wfile.write(reply.encode('utf8'))
+            self.wfile.flush()
+
+
+def socket_in_use(socket_path):
+    '''
+    Checks whether another daemon is answering on the Unix socket. A socket
+    file left behind by a daemon that is gone refuses connections.
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def serve_socket(socket_path):
+    '''
+    Keeps running, answering commands from clients over a Unix socket. Won't
+    start if another daemon is already listening on it.
+    '''
+    if os.path.exists(socket_path):
+        if socket_in_use(socket_path):
+            LOGGER.error('Another daemon is listening on %s', socket_path)
+            sys.exit(1)
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                    CommandHandler)
+    server.daemon_threads = True
+    LOGGER.info('Listening for commands on %s', socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def serve_stdio():
+    '''
+    Keeps running, answering commands read from stdin on stdout.
+    '''
+    LOGGER.info('Listening for commands on stdin')
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        print(handle_command(line), flush=True)
 
 
 def main():
@@ -172,12 +590,35 @@ def main():
         type=int
     )
 
+    parser_daemon = subparsers.add_parser(
+        'daemon',
+        help='Keeps running and answers commands over a Unix socket.'
+    )
+    parser_daemon.add_argument(
+        '--socket',
+        help='Path of the Unix socket to listen on.',
+        default=DJ_SOCKET
+    )
+    parser_daemon.add_argument(
+        '--stdio',
+        help='Answer commands on stdin/stdout instead of a socket.',
+        action='store_true'
+    )
+
     args = parser.parse_args()
 
     if args.command == 'next':
-        next_request()
+        annotate_string = next_request()
+        if annotate_string:
+            print(annotate_string)
     elif args.command == 'played':
-        just_played(args.request[0])
+        spool_just_played(args.request[0])
+    elif args.command == 'daemon':
+        threading.Thread(target=refresh_forever, daemon=True).start()
+        if args.stdio:
+            serve_stdio()
+        else:
+            serve_socket(args.socket)
 
 
 if __name__ == '__main__':
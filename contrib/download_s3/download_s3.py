@@ -4,15 +4,32 @@ download_s3.py
 This is the helper script that downloads songs from an Amazon S3 instance
 (or other implementations, like DigialOcean Spaces). Currently used as a
 workaround for a pipe-leaking issue with the "aws-cli" client.
+
+With "--batch", it downloads every "s3path filepath" pair listed (one per
+line) in a file or on stdin, S3_WORKERS at a time, through a single pooled
+client. Large objects are fetched as S3_PART_CONCURRENCY ranged gets at once.
+
+If S3_CACHE_DIR is set, downloaded objects are also kept there, named after
+their key and ETag, so songs that are played again are copied from the local
+disk instead of fetched again (at the cost of asking for each object's ETag
+first). The least recently used ones are removed once the cache grows past
+S3_CACHE_SIZE MiB, and objects bigger than that are never kept.
 '''
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
+import os
+import shutil
 import sys
-import traceback
+import tempfile
+import threading
 
 from decouple import config
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # If these four are not defined, then boto3 will look for defaults in the
 # ~/.aws configurations
@@ -24,6 +41,27 @@ S3_SECRET_KEY = config('S3_SECRET_KEY', default=None)
 # Radio name for metadata
 RADIO_NAME = config('RADIO_NAME', default='Save Point Radio')
 
+# Number of files downloaded at once in batch mode
+S3_WORKERS = config('S3_WORKERS', default=8, cast=int)
+
+# Number of ranged gets of a single object sent at once
+S3_PART_CONCURRENCY = config('S3_PART_CONCURRENCY', default=4, cast=int)
+
+# Objects bigger than this (in MiB) are fetched in ranges of the same size
+S3_MULTIPART_SIZE = config('S3_MULTIPART_SIZE', default=8, cast=int)
+
+# Local cache of downloaded objects (off unless a directory is given)
+S3_CACHE_DIR = config('S3_CACHE_DIR', default='')
+
+# Size (in MiB) the cache is trimmed back to
+S3_CACHE_SIZE = config('S3_CACHE_SIZE', default=4096, cast=int)
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_SIZE * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_SIZE * 1024 * 1024,
+    max_concurrency=S3_PART_CONCURRENCY
+)
+
 logging.basicConfig(
         handlers=[logging.FileHandler('./s3_downloads.log', encoding='utf8')],
         level=logging.INFO,
@@ -33,45 +71,177 @@ logging.basicConfig(
     )
 LOGGER = logging.getLogger('download_s3')
 
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    '''
+    Returns the S3 client shared by every download, creating it (with a
+    connection pool big enough for all of them) the first time.
+    '''
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            session = boto3.session.Session()
+            _CLIENT = session.client(
+                's3',
+                region_name=S3_REGION,
+                endpoint_url=S3_ENDPOINT,
+                aws_access_key_id=S3_ACCESS_KEY,
+                aws_secret_access_key=S3_SECRET_KEY,
+                config=Config(
+                    max_pool_connections=S3_WORKERS * S3_PART_CONCURRENCY
+                )
+            )
+    return _CLIENT
+
+
+class Cache(object):
+    '''
+    A directory of downloaded objects, named after their key and ETag, that
+    is trimmed back to a size limit by removing the least recently used
+    ones. The files' modification times record when they were last used.
+    '''
+    def __init__(self, directory, max_size):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, etag):
+        '''Where an object is (or would be) cached'''
+        name = hashlib.sha256('{}\n{}'.format(key, etag).encode('utf8'))
+        ext = os.path.splitext(key)[1]
+        return os.path.join(self._directory, name.hexdigest() + ext)
+
+    def get(self, key, etag, filepath):
+        '''
+        Copies a cached object to the file path, returning whether it was in
+        the cache.
+        '''
+        cached = self.path(key, etag)
+        try:
+            os.utime(cached)
+            shutil.copyfile(cached, filepath)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, client, bucket, key, etag, filepath):
+        '''
+        Downloads an object to the file path, keeping a copy in the cache
+        unless it is bigger than the whole cache.
+        '''
+        cached = self.path(key, etag)
+        handle, partial = tempfile.mkstemp(dir=self._directory,
+                                           suffix='.part')
+        os.close(handle)
+        try:
+            client.download_file(bucket, key, partial,
+                                 Config=TRANSFER_CONFIG)
+            # Copied out before trimming, which could remove it again
+            shutil.copyfile(partial, filepath)
+            if os.path.getsize(partial) <= self._max_size:
+                os.replace(partial, cached)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self.trim()
+
+    def trim(self):
+        '''
+        Removes the least recently used objects until the cache fits in its
+        size limit again.
+        '''
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self._directory):
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            while entries and total > self._max_size:
+                _, size, path = entries.pop(0)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
 
-def download_file(s3path, filepath):
+def download_file(s3path, filepath, cache=None):
     '''
-    Downloads a file from an S3 instance and saves it to a specified path.
+    Downloads a file from an S3 instance and saves it to a specified path,
+    going through the local cache if there is one.
     '''
 
     obj_parts = s3path[5:].split('/')
     obj_bucket = obj_parts[0]
     obj_key = '/'.join(obj_parts[1:])
 
-    session = boto3.session.Session()
-    client = session.client(
-        's3',
-        region_name=S3_REGION,
-        endpoint_url=S3_ENDPOINT,
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_client()
 
     try:
-        client.download_file(obj_bucket, obj_key, filepath)
+        if cache is None:
+            client.download_file(obj_bucket, obj_key, filepath,
+                                 Config=TRANSFER_CONFIG)
+            source = 'storage'
+        else:
+            etag = client.head_object(Bucket=obj_bucket,
+                                      Key=obj_key)['ETag']
+            if cache.get(obj_key, etag, filepath):
+                source = 'cache'
+            else:
+                cache.put(client, obj_bucket, obj_key, etag, filepath)
+                source = 'storage'
     except Exception:
-        LOGGER.error(
-            'Download failed for: %s -- %s',
-            s3path,
-            traceback.print_exc()
-        )
+        LOGGER.exception('Download failed for: %s', s3path)
         result = 1
     else:
         LOGGER.info(
-            'Successful download of: %s to %s',
+            'Successful download of: %s to %s (from %s)',
             s3path,
-            filepath
+            filepath,
+            source
         )
         result = 0
 
     return result
 
 
+def download_batch(pairs, cache=None):
+    '''
+    Downloads every (s3path, filepath) pair at once, S3_WORKERS at a time,
+    returning the number of failed downloads.
+    '''
+    with ThreadPoolExecutor(max_workers=S3_WORKERS) as executor:
+        results = executor.map(lambda pair: download_file(*pair, cache=cache),
+                               pairs)
+        return sum(results)
+
+
+def read_pairs(batch_file):
+    '''
+    Reads "s3path filepath" pairs, one per line, from a file (or stdin for
+    "-").
+    '''
+    if batch_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_file, 'r', encoding='utf8') as file:
+            lines = file.readlines()
+
+    pairs = []
+    for line in lines:
+        if line.strip():
+            s3path, filepath = line.strip().split(None, 1)
+            pairs.append((s3path, filepath))
+    return pairs
+
+
 def main():
     '''Main loop of the program'''
 
@@ -82,13 +252,28 @@ def main():
     parser.add_argument(
         's3path',
         help='Path to the S3 object',
-        nargs=1
+        nargs='?'
     )
 
     parser.add_argument(
         'filepath',
         help='Path to place the downloaded file',
-        nargs=1
+        nargs='?'
+    )
+
+    parser.add_argument(
+        '--batch',
+        help=('Download every "s3path filepath" pair listed one per line in '
+              'a file (or stdin, if no file is given)'),
+        metavar='FILE',
+        nargs='?',
+        const='-'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        help='Download straight from the S3 instance, skipping the cache',
+        action='store_true'
     )
 
     if len(sys.argv) == 1:
@@ -98,8 +283,17 @@ def main():
 
     args = parser.parse_args()
 
-    if args.s3path and args.filepath:
-        result = download_file(args.s3path[0], args.filepath[0])
+    cache = None
+    if S3_CACHE_DIR and not args.no_cache:
+        cache = Cache(S3_CACHE_DIR, S3_CACHE_SIZE * 1024 * 1024)
+
+    if args.batch:
+        failures = download_batch(read_pairs(args.batch), cache)
+        result = 1 if failures else 0
+    elif args.s3path and args.filepath:
+        result = download_file(args.s3path, args.filepath, cache)
+    else:
+        parser.error('please give an s3path and filepath, or --batch')
 
     LOGGER.info('Program finished. Exiting.')
     sys.exit(result)
@@ -3,21 +3,55 @@ export_playlist.py
 
 This is the helper script that exports old playlist databases to be reimported
 by the new database later.
+
+Playlists are written either as a single JSON document ("json") or as JSON
+Lines ("jsonl"), which can be read back one entity at a time. A JSON Lines
+playlist starts with a header line, followed by one object per line holding a
+single album, artist, game or song, with every album, artist and game coming
+before the songs:
+
+    {"header": {"format": "spradio-playlist", "version": 1}}
+    {"album": {"title": ..., "disabled": ...}}
+    {"artist": {"alias": ..., "first_name": ..., ...}}
+    {"game": {"title": ..., "disabled": ...}}
+    {"song": {"title": ..., "artists": [...], "store": {...}, ...}}
 '''
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal, getcontext
 import hashlib
 import json
 import mimetypes
 import os
+import pathlib
 import sqlite3
 import sys
+import time
 import unicodedata
 
 import magic
 
 
+PLAYLIST_FORMAT = 'spradio-playlist'
+
+PLAYLIST_VERSION = 1
+
+# Bytes read from a file at a time while hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Default file remembering the hash and MIME type of every exported file
+CACHE_FILE = 'export_cache.json'
+
+# Settings for reading the whole old database once, without changing it
+READ_PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',  # 64 MiB
+    'PRAGMA mmap_size = 268435456',  # 256 MiB
+)
+
+
 def scrub(text):
     '''
     Forcing a Unicode NFC normalization to remove combining marks that mess
@@ -42,14 +76,57 @@ def detect_mime(path):
 def hash_file(path):
     '''
     Run a music file through a hashing algorithm (SHA3_256) and return the
-    hexidecimal digest.
+    hexidecimal digest. The file is read in chunks, so it's never held in
+    memory all at once.
     '''
+    filehash = hashlib.sha3_256()
     try:
         with open(path, 'rb') as file:
-            filehash = hashlib.sha3_256(file.read()).hexdigest()
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                filehash.update(chunk)
     except OSError:
-        filehash = None
-    return filehash
+        return None
+    return filehash.hexdigest()
+
+
+def inspect_file(path_and_cached):
+    '''
+    Stat, detect the MIME type of and hash a music file, unless its size and
+    modification time match what was cached for it last time. Run in a
+    worker process, so many files can be inspected at once. A file that
+    can't be read gets None for all of its details.
+    '''
+    path, cached = path_and_cached
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {'filesize': None,
+                'mtime': None,
+                'mime': None,
+                'filehash': None}
+    if (cached and cached['filesize'] == stat.st_size and
+            cached['mtime'] == stat.st_mtime):
+        return cached
+    return {'filesize': stat.st_size,
+            'mtime': stat.st_mtime,
+            'mime': detect_mime(path),
+            'filehash': hash_file(path)}
+
+
+def load_cache(cache_file):
+    '''Loads the cached file details of the last export, if any'''
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, 'r', encoding='utf8') as file:
+            return json.load(file)
+    return {}
+
+
+def save_cache(cache_file, cache):
+    '''Atomically replaces the cached file details'''
+    if cache_file:
+        with open(cache_file + '.tmp', 'w', encoding='utf8') as file:
+            json.dump(cache, file, ensure_ascii=False)
+        os.replace(cache_file + '.tmp', cache_file)
 
 
 def adapt_decimal(number):
@@ -62,10 +139,13 @@ def convert_decimal(text):
     return float(text.decode('utf8'))
 
 
-def import_sqlite3(db_file):
+def read_sqlite3(db_file, jobs=None, cache_file=CACHE_FILE):
     '''
-    Imports a playlist from an SQLite3 database file and exports to a
-    JSON file.
+    Reads a playlist from an SQLite3 database file, yielding each album,
+    artist, game and song (in that order) as a (kind, entity) pair. The
+    songs' files are inspected by a pool of 'jobs' worker processes (one per
+    CPU by default), skipping those unchanged since the export that wrote
+    the cache file.
     '''
     totals = {
         'albums': 0,
@@ -78,45 +158,50 @@ def import_sqlite3(db_file):
     if not os.path.isfile(db_file):
         raise FileNotFoundError
 
+    started = time.perf_counter()
+    rows = 0
+
     detect_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-    con = sqlite3.connect(db_file, detect_types=detect_types)
+    db_uri = pathlib.Path(db_file).resolve().as_uri() + '?mode=ro'
+    con = sqlite3.connect(db_uri, detect_types=detect_types, uri=True)
+    for pragma in READ_PRAGMAS:
+        con.execute(pragma)
     cur = con.cursor()
 
     # Fetching albums first
-    albums = list()
     for album in con.execute('SELECT title, enabled FROM albums'):
-        albums.append({
+        yield 'album', {
             'title': scrub(album[0]),
             'disabled': not bool(album[1])
-        })
+        }
         totals['albums'] += 1
+        rows += 1
     print('Exported {} albums'.format(str(totals['albums'])))
 
     # Next up, artists
-    artists = list()
     artist_query = 'SELECT alias, firstname, lastname, enabled FROM artists'
     for artist in con.execute(artist_query):
-        artists.append({
+        yield 'artist', {
             'alias': scrub(artist[0]) or '',
             'first_name': scrub(artist[1]) or '',
             'last_name': scrub(artist[2]) or '',
             'disabled': not bool(artist[3])
-        })
+        }
         totals['artists'] += 1
+        rows += 1
     print('Exported {} artists'.format(str(totals['artists'])))
 
     # On to games
-    games = list()
     for game in con.execute('SELECT title, enabled FROM games'):
-        games.append({
+        yield 'game', {
             'title': scrub(game[0]),
             'disabled': not bool(game[1])
-        })
+        }
         totals['games'] += 1
+        rows += 1
     print('Exported {} games'.format(str(totals['games'])))
 
     # Now the songs
-    songs = list()
     songs_query = '''SELECT
                         songs.songs_id AS id,
                         games.title AS game,
@@ -133,52 +218,94 @@ def import_sqlite3(db_file):
                         ON (songs.album = albums.albums_id)'''
     cur.execute(songs_query)
     old_songs = cur.fetchall()
-    for song in old_songs:
-        # Deal with the list of artists
-        song_artists = list()
-        song_artist_query = '''SELECT
-                                    ifnull(alias, "") AS alias,
-                                    ifnull(firstname, "") AS firstname,
-                                    ifnull(lastname, "") AS lastname
-                                FROM artists
-                                WHERE artists_id
-                                IN (SELECT artists_artists_id
-                                    FROM songs_have_artists
-                                    WHERE songs_songs_id = ?)'''
-        cur.execute(song_artist_query, [song[0]])
-        song_artist_results = cur.fetchall()
-        for artist in song_artist_results:
-            song_artists.append({
-                'alias': scrub(artist[0]),
-                'first_name': scrub(artist[1]),
-                'last_name': scrub(artist[2])
-            })
-        store = {'path': scrub(song[7]),
-                 'mime': detect_mime(scrub(song[7])),
-                 'filesize': os.stat(scrub(song[7])).st_size,
-                 'filehash': hash_file(scrub(song[7])),
-                 'length': song[6]}
-        songs.append({'album': scrub(song[2]),
-                      'artists': song_artists,
-                      'game': scrub(song[1]),
-                      'disabled': not bool(song[3]),
-                      'type': song[4],
-                      'title': scrub(song[5]),
-                      'store': store})
-        if song[4] == 'S':
-            totals['songs'] += 1
-        else:
-            totals['jingles'] += 1
+    rows += len(old_songs)
+
+    # Every song's artists, all in one go
+    song_artists = dict()
+    song_artist_query = '''SELECT DISTINCT
+                                songs_have_artists.songs_songs_id AS song,
+                                artists.artists_id AS id,
+                                ifnull(artists.alias, "") AS alias,
+                                ifnull(artists.firstname, "") AS firstname,
+                                ifnull(artists.lastname, "") AS lastname
+                            FROM songs_have_artists
+                            JOIN artists
+                                ON (songs_have_artists.artists_artists_id =
+                                    artists.artists_id)
+                            ORDER BY song, id'''
+    for artist in con.execute(song_artist_query):
+        song_artists.setdefault(artist[0], []).append({
+            'alias': scrub(artist[2]),
+            'first_name': scrub(artist[3]),
+            'last_name': scrub(artist[4])
+        })
+        rows += 1
+
+    cache = load_cache(cache_file)
+    new_cache = {}
+    paths = [scrub(song[7]) for song in old_songs]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        files = executor.map(inspect_file,
+                             [(path, cache.get(path)) for path in paths],
+                             chunksize=16)
+        for song, path, details in zip(old_songs, paths, files):
+            if details['filesize'] is not None:
+                new_cache[path] = details
+            store = {'path': path,
+                     'mime': details['mime'],
+                     'filesize': details['filesize'],
+                     'filehash': details['filehash'],
+                     'length': song[6]}
+            yield 'song', {'album': scrub(song[2]),
+                           'artists': song_artists.get(song[0], []),
+                           'game': scrub(song[1]),
+                           'disabled': not bool(song[3]),
+                           'type': song[4],
+                           'title': scrub(song[5]),
+                           'store': store}
+            if song[4] == 'S':
+                totals['songs'] += 1
+            else:
+                totals['jingles'] += 1
+    con.close()
+    save_cache(cache_file, new_cache)
     print('Exported {} requestables ({} songs, {} jingles)'.format(
         str(totals['songs'] + totals['jingles']),
         str(totals['songs']),
         str(totals['jingles'])
     ))
 
-    return {'albums': albums,
-            'artists': artists,
-            'games': games,
-            'songs': songs}
+    elapsed = time.perf_counter() - started
+    print('Read {} rows in {:.2f} seconds ({:.0f} rows/sec)'.format(
+        str(rows),
+        elapsed,
+        rows / elapsed if elapsed else 0
+    ))
+
+
+def import_sqlite3(db_file, jobs=None, cache_file=CACHE_FILE):
+    '''
+    Imports a playlist from an SQLite3 database file, to be exported as a
+    single JSON file.
+    '''
+    playlist = {'albums': [], 'artists': [], 'games': [], 'songs': []}
+    for kind, entity in read_sqlite3(db_file, jobs, cache_file):
+        playlist[kind + 's'].append(entity)
+    return playlist
+
+
+def write_jsonl(entities, playlist_file):
+    '''
+    Writes (kind, entity) pairs to a JSON Lines playlist file as they come,
+    so the whole playlist never has to be held in memory.
+    '''
+    with open(playlist_file, 'w', encoding='utf8') as file:
+        header = {'format': PLAYLIST_FORMAT, 'version': PLAYLIST_VERSION}
+        file.write(json.dumps({'header': header}) + '\n')
+        for kind, entity in entities:
+            file.write(json.dumps({kind: entity},
+                                  ensure_ascii=False,
+                                  sort_keys=True) + '\n')
 
 
 def main():
@@ -202,6 +329,31 @@ def main():
         help='Path to the sqlite3 database file.',
         nargs=1
     )
+    parser_sqlite3.add_argument(
+        '--format',
+        help='Playlist file format (default: json).',
+        choices=['json', 'jsonl'],
+        default='json'
+    )
+    parser_sqlite3.add_argument(
+        '--jobs',
+        help='Number of files to inspect at once (default: one per CPU).',
+        type=int,
+        default=None
+    )
+    parser_sqlite3.add_argument(
+        '--cache',
+        help=('File caching each song file\'s details between exports '
+              '(default: {}).'.format(CACHE_FILE)),
+        default=CACHE_FILE
+    )
+    parser_sqlite3.add_argument(
+        '--no-cache',
+        help='Inspect every file again, without reading or writing a cache.',
+        dest='cache',
+        action='store_const',
+        const=None
+    )
 
     if len(sys.argv) == 1:
         sys.stderr.write('Error: please specify a command\n\n')
@@ -213,7 +365,11 @@ def main():
     args = parser.parse_args()
 
     if args.command == 'sqlite3':
-        results = import_sqlite3(args.db_file[0])
+        if args.format == 'jsonl':
+            write_jsonl(read_sqlite3(args.db_file[0], args.jobs, args.cache),
+                        'playlist.jsonl')
+        else:
+            results = import_sqlite3(args.db_file[0], args.jobs, args.cache)
 
     if results:
         with open('playlist.json', 'w', encoding='utf8') as file:
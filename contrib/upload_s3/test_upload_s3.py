@@ -0,0 +1,143 @@
+'''
+test_upload_s3.py
+
+Tests for upload_s3.py against a mocked S3 bucket. Needs moto on top of the
+script's own requirements, and runs with "python -m unittest" from this
+directory.
+'''
+
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import boto3
+from moto import mock_aws
+
+BUCKET = 'radio-test'
+
+upload_s3 = None
+
+
+def setUpModule():
+    '''
+    Imports the script from a scratch directory, since it logs to (and
+    writes its new playlist in) the current one.
+    '''
+    global upload_s3
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'S3_BUCKET': BUCKET
+    })
+    setUpModule.cwd = os.getcwd()
+    setUpModule.scratch = tempfile.mkdtemp()
+    os.chdir(setUpModule.scratch)
+    upload_s3 = importlib.import_module('upload_s3')
+
+
+def tearDownModule():
+    os.chdir(setUpModule.cwd)
+    shutil.rmtree(setUpModule.scratch)
+
+
+class UploadPlaylistTests(unittest.TestCase):
+    '''
+    Uploading a JSON Lines playlist.
+    '''
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3')
+        self.client.create_bucket(Bucket=BUCKET)
+
+        self.directory = tempfile.mkdtemp(dir=setUpModule.scratch)
+        self.manifest = os.path.join(self.directory, 'manifest.jsonl')
+        self.playlist = os.path.join(self.directory, 'playlist.jsonl')
+
+        songs = []
+        # The first two songs are the same file, the third one wasn't hashed
+        for name, content, hashed in (('a.ogg', b'same', True),
+                                      ('b.ogg', b'same', True),
+                                      ('c.ogg', b'other', False)):
+            path = os.path.join(self.directory, name)
+            with open(path, 'wb') as file:
+                file.write(content)
+            songs.append({'album': 'Album',
+                          'artists': [{'alias': '',
+                                       'first_name': 'First',
+                                       'last_name': 'Last'}],
+                          'game': 'Game',
+                          'disabled': False,
+                          'type': 'S',
+                          'title': name,
+                          'store': {
+                              'path': path,
+                              'mime': 'audio/ogg',
+                              'filesize': len(content),
+                              'filehash': (hashlib.sha3_256(content)
+                                           .hexdigest() if hashed else None),
+                              'length': '1.00'
+                          }})
+        with open(self.playlist, 'w', encoding='utf8') as file:
+            file.write(json.dumps({'header': {
+                'format': upload_s3.PLAYLIST_FORMAT,
+                'version': upload_s3.PLAYLIST_VERSION
+            }}) + '\n')
+            for song in songs:
+                file.write(json.dumps({'song': song}) + '\n')
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.directory)
+
+    def upload(self):
+        '''
+        Runs the upload, returning its summary line and the new playlist's
+        songs.
+        '''
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            upload_s3.import_playlist(self.playlist, self.manifest)
+        with open('playlist_s3.jsonl', encoding='utf8') as file:
+            songs = [json.loads(line)['song'] for line in file.readlines()[1:]]
+        return output.getvalue().strip().splitlines()[-1], songs
+
+    def bucket_keys(self):
+        response = self.client.list_objects_v2(Bucket=BUCKET)
+        return [obj['Key'] for obj in response.get('Contents', [])]
+
+    def test_same_file_uploaded_once(self):
+        summary, songs = self.upload()
+        self.assertIn('1 failures', summary)
+        self.assertEqual(len(self.bucket_keys()), 1)
+        self.assertEqual(songs[0]['store']['path'], songs[1]['store']['path'])
+        self.assertTrue(songs[0]['store']['path'].startswith('s3://'))
+
+    def test_unhashed_song_not_uploaded(self):
+        _, songs = self.upload()
+        self.assertFalse(any('None' in key for key in self.bucket_keys()))
+        self.assertFalse(songs[2]['store']['path'].startswith('s3://'))
+
+    def test_resume_from_manifest(self):
+        self.upload()
+        self.client.delete_object(Bucket=BUCKET, Key=self.bucket_keys()[0])
+
+        # Objects in the manifest are trusted, without looking them up
+        summary, _ = self.upload()
+        self.assertIn('0 successful, 2 already uploaded', summary)
+        self.assertEqual(self.bucket_keys(), [])
+
+        os.remove(self.manifest)
+        self.upload()
+        self.assertEqual(len(self.bucket_keys()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
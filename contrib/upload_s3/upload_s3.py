@@ -3,19 +3,32 @@ upload_s3.py
 
 This is the helper script that uploads songs from an exported playlist into
 an Amazon S3 instance (or other implementations, like DigialOcean Spaces).
+
+JSON Lines playlists (see export_playlist.py) are read and rewritten one line
+at a time into "playlist_s3.jsonl", while single JSON document playlists are
+still loaded whole and written out to "playlist_s3.json".
+
+Songs are uploaded S3_WORKERS at a time, each in up to S3_PART_CONCURRENCY
+multipart chunks at once. Objects are named after the file's hash, so any that
+are already in the bucket (or recorded in the upload manifest by an earlier,
+interrupted run) are skipped instead of uploaded again.
 '''
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import os
 import sys
 import threading
-import traceback
+import time
 from unicodedata import normalize
 
 from decouple import config
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 # If these four are not defined, then boto3 will look for defaults in the
 # ~/.aws configurations
@@ -30,6 +43,27 @@ S3_BUCKET = config('S3_BUCKET')
 # Radio name for metadata
 RADIO_NAME = config('RADIO_NAME', default='Save Point Radio')
 
+# Number of songs uploaded at once
+S3_WORKERS = config('S3_WORKERS', default=8, cast=int)
+
+# Number of parts of a single multipart upload sent at once
+S3_PART_CONCURRENCY = config('S3_PART_CONCURRENCY', default=4, cast=int)
+
+# Files bigger than this (in MiB) are uploaded in parts of the same size
+S3_MULTIPART_SIZE = config('S3_MULTIPART_SIZE', default=8, cast=int)
+
+MANIFEST_FILE = 'upload_manifest.jsonl'
+
+PLAYLIST_FORMAT = 'spradio-playlist'
+
+PLAYLIST_VERSION = 1
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_SIZE * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_SIZE * 1024 * 1024,
+    max_concurrency=S3_PART_CONCURRENCY
+)
+
 logging.basicConfig(
         handlers=[logging.FileHandler('./s3_uploads.log', encoding='utf8')],
         level=logging.INFO,
@@ -42,27 +76,84 @@ LOGGER = logging.getLogger('upload_s3')
 
 class Progress(object):
     '''
-    A callback class for the Amazon S3 upload to detect how far along in an
-    upload we are.
+    A callback class for the Amazon S3 uploads to show how far along all of
+    the uploads are together, and how fast they're going.
     '''
-    def __init__(self, filepath):
-        self._filepath = filepath
-        self._filename = os.path.basename(filepath)
-        self._size = float(os.path.getsize(filepath))
+    def __init__(self, total_files, total_bytes):
+        self._total_files = total_files
+        self._total_bytes = float(total_bytes)
+        self._files_done = 0
         self._seen_so_far = 0
+        self._uploaded = 0
+        self._started = time.monotonic()
+        self._shown = 0.0
         self._lock = threading.Lock()
 
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stdout.write(
-                "\r%s  %s / %s  (%.2f%%)" % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage
-                )
+            self._uploaded += bytes_amount
+            self._show()
+
+    def file_done(self, skipped_bytes=0):
+        '''
+        Counts a finished file, along with its size if it didn't need
+        uploading.
+        '''
+        with self._lock:
+            self._files_done += 1
+            self._seen_so_far += skipped_bytes
+            self._show(force=True)
+
+    def _show(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._shown < 0.2:
+            return
+        self._shown = now
+        percentage = 100.0
+        if self._total_bytes:
+            percentage = (self._seen_so_far / self._total_bytes) * 100
+        speed = self._uploaded / max(now - self._started, 0.001)
+        sys.stdout.write(
+            "\r%s / %s files  %.1f / %.1f MiB  (%.2f%%)  %.2f MiB/s" % (
+                self._files_done, self._total_files,
+                self._seen_so_far / 1048576, self._total_bytes / 1048576,
+                percentage, speed / 1048576
             )
-            sys.stdout.flush()
+        )
+        sys.stdout.flush()
+
+
+class Manifest(object):
+    '''
+    A record of every object uploaded so far, one JSON object per line, so
+    that an interrupted run can pick up where it stopped.
+    '''
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._keys = set()
+        self._lock = threading.Lock()
+        if os.path.isfile(filepath):
+            with open(filepath, 'r', encoding='utf8') as file:
+                for line in file:
+                    if line.strip():
+                        self._keys.add(json.loads(line)['key'])
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key, source):
+        '''
+        Durably records an uploaded object.
+        '''
+        with self._lock:
+            if key in self._keys:
+                return
+            with open(self._filepath, 'a', encoding='utf8') as file:
+                file.write(json.dumps({'key': key, 'source': source}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self._keys.add(key)
 
 
 def asciify(text):
@@ -98,56 +189,104 @@ def beautify_artists(artists):
     return output.join(fullnames)
 
 
-def import_playlist(playlist_file):
+def read_header(pfile):
     '''
-    Imports a playlist from a JSON file, uploads the files to an S3[-like]
-    instance, and exports a new JSON file with the updated paths.
+    Returns the header of a JSON Lines playlist, leaving the file at the first
+    entity. For a single JSON document playlist, returns None and rewinds the
+    file.
     '''
-    if not os.path.isfile(playlist_file):
-        raise FileNotFoundError
+    try:
+        first_line = json.loads(pfile.readline())
+    except ValueError:
+        first_line = None
 
-    with open(playlist_file, 'r', encoding='utf8') as pfile:
-        playlist = json.load(pfile)
+    if isinstance(first_line, dict) and 'header' in first_line:
+        header = first_line['header']
+        if (header.get('format') != PLAYLIST_FORMAT or
+                header.get('version') != PLAYLIST_VERSION):
+            raise ValueError('Unsupported playlist format: {}'.format(header))
+        return header
 
-    session = boto3.session.Session()
-    client = session.client(
-        's3',
-        region_name=S3_REGION,
-        endpoint_url=S3_ENDPOINT,
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    pfile.seek(0)
+    return None
 
-    totals = {'success': 0, 'fail': 0}
-
-    for song in playlist['songs']:
-        old_path = song['store']['path']
-
-        if song['type'] == 'S':
-            prefix = 'songs'
-            metadata = {
-                'album': asciify(song['album']),
-                'artists': asciify(beautify_artists(song['artists'])),
-                'game': asciify(song['game']),
-                'title': asciify(song['title']),
-                'length': str(song['store']['length']),
-                'original-path': asciify(old_path)
-            }
+
+def read_entities(pfile):
+    '''
+    Yields each (kind, entity) pair from the rest of a JSON Lines playlist.
+    '''
+    for line in pfile:
+        if line.strip():
+            yield next(iter(json.loads(line).items()))
+
+
+def measure(songs):
+    '''
+    Counts the songs, and adds up the size of their files.
+    '''
+    total_files = total_bytes = 0
+    for song in songs:
+        total_files += 1
+        total_bytes += song['store'].get('filesize') or 0
+    return total_files, total_bytes
+
+
+def object_exists(client, key, size):
+    '''
+    Checks whether an object of the given size is already in the bucket.
+    '''
+    try:
+        head = client.head_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return size is None or head['ContentLength'] == size
+
+
+def upload_song(client, song, progress, manifest):
+    '''
+    Uploads a song's file to the S3[-like] instance, unless it's already
+    there, and points its store at the uploaded copy. Returns whether it was
+    'uploaded', 'skipped' or 'failed'.
+    '''
+    old_path = song['store']['path']
+    size = song['store'].get('filesize')
+
+    if song['type'] == 'S':
+        prefix = 'songs'
+        metadata = {
+            'album': asciify(song['album']),
+            'artists': asciify(beautify_artists(song['artists'])),
+            'game': asciify(song['game']),
+            'title': asciify(song['title']),
+            'length': str(song['store']['length']),
+            'original-path': asciify(old_path)
+        }
+    else:
+        prefix = 'jingles'
+        metadata = {
+            'artists': asciify(RADIO_NAME),
+            'title': asciify(song['title']),
+            'length': str(song['store']['length']),
+            'original-path': asciify(old_path)
+        }
+    file_hash = song['store'].get('filehash')
+    if not file_hash:
+        # Objects are named after the hash, so there's nowhere to put it
+        LOGGER.error('No file hash for: %s, not uploaded', old_path)
+        progress.file_done(size or 0)
+        return 'failed'
+    ext = os.path.splitext(old_path)[1]
+    new_path = '{}/{}{}'.format(prefix, file_hash, ext)
+
+    try:
+        if new_path in manifest or object_exists(client, new_path, size):
+            LOGGER.info('Already uploaded: %s as %s', old_path, new_path)
+            status = 'skipped'
+            progress.file_done(size or 0)
         else:
-            prefix = 'jingles'
-            metadata = {
-                'artists': asciify(RADIO_NAME),
-                'title': asciify(song['title']),
-                'length': str(song['store']['length']),
-                'original-path': asciify(old_path)
-            }
-        file_hash = song['store']['filehash']
-        ext = os.path.splitext(old_path)[1]
-        new_path = '{}/{}{}'.format(prefix, file_hash, ext)
-
-        LOGGER.info('Begin upload of: %s', old_path)
-
-        try:
+            LOGGER.info('Begin upload of: %s', old_path)
             client.upload_file(
                 old_path,
                 S3_BUCKET,
@@ -156,30 +295,116 @@ def import_playlist(playlist_file):
                     'Metadata': metadata,
                     'ContentType': song['store']['mime']
                 },
-                Callback=Progress(old_path)
+                Config=TRANSFER_CONFIG,
+                Callback=progress
             )
-        except Exception:
-            LOGGER.error(
-                'Upload failed for: %s -- %s',
-                old_path,
-                traceback.print_exc()
-            )
-            totals['fail'] += 1
-        else:
-            song['store']['path'] = 's3://{}/{}'.format(S3_BUCKET, new_path)
-            LOGGER.info(
-                'Successful upload of: %s to %s',
-                old_path,
-                song['store']['path']
-            )
-            totals['success'] += 1
+            status = 'uploaded'
+            progress.file_done()
+    except Exception:
+        LOGGER.exception('Upload failed for: %s', old_path)
+        progress.file_done()
+        return 'failed'
+
+    manifest.add(new_path, old_path)
+    song['store']['path'] = 's3://{}/{}'.format(S3_BUCKET, new_path)
+    LOGGER.info(
+        'Successful upload of: %s to %s',
+        old_path,
+        song['store']['path']
+    )
+    return status
 
-        sys.stdout.write("\r\n")
-        sys.stdout.flush()
 
-    result_message = 'Uploads complete -- {} successful, {} failures'.format(
-        totals['success'],
-        totals['fail']
+def upload_in_order(executor, upload, entities, window):
+    '''
+    Uploads the songs among the (kind, entity) pairs in the executor, and
+    yields every pair back in its original order (along with the upload's
+    result), keeping at most 'window' songs in flight at once.
+    '''
+    def finish(pending):
+        kind, entity, future = pending
+        return kind, entity, future.result() if future else None
+
+    in_flight = deque()
+    for kind, entity in entities:
+        future = None
+        if kind == 'song':
+            future = executor.submit(upload, entity)
+        in_flight.append((kind, entity, future))
+        if len(in_flight) >= window:
+            yield finish(in_flight.popleft())
+    while in_flight:
+        yield finish(in_flight.popleft())
+
+
+def import_playlist(playlist_file, manifest_file=MANIFEST_FILE):
+    '''
+    Imports a playlist from a JSON file, uploads the files to an S3[-like]
+    instance, and exports a new JSON file with the updated paths. JSON Lines
+    playlists are streamed straight to the new file, so nothing is returned
+    for them.
+    '''
+    if not os.path.isfile(playlist_file):
+        raise FileNotFoundError
+
+    session = boto3.session.Session()
+    client = session.client(
+        's3',
+        region_name=S3_REGION,
+        endpoint_url=S3_ENDPOINT,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY
+    )
+    manifest = Manifest(manifest_file)
+
+    totals = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+
+    with open(playlist_file, 'r', encoding='utf8') as pfile:
+        header = read_header(pfile)
+        if header is None:
+            playlist = json.load(pfile)
+            progress = Progress(*measure(playlist['songs']))
+        else:
+            playlist = None
+            progress = Progress(*measure(
+                e for k, e in read_entities(pfile) if k == 'song'
+            ))
+            pfile.seek(0)
+            read_header(pfile)
+
+        def upload(song):
+            return upload_song(client, song, progress, manifest)
+
+        with ThreadPoolExecutor(max_workers=S3_WORKERS) as executor:
+            if playlist is not None:
+                entities = [('song', song) for song in playlist['songs']]
+                for _, _, status in upload_in_order(executor, upload,
+                                                    entities,
+                                                    len(entities) or 1):
+                    totals[status] += 1
+            else:
+                LOGGER.info('Exporting new playlist file to '
+                            '\'playlist_s3.jsonl\'')
+                with open('playlist_s3.jsonl', 'w',
+                          encoding='utf8') as file:
+                    file.write(json.dumps({'header': header}) + '\n')
+                    for kind, entity, status in upload_in_order(
+                            executor, upload, read_entities(pfile),
+                            S3_WORKERS * 4):
+                        if status:
+                            totals[status] += 1
+                        file.write(json.dumps({kind: entity},
+                                              ensure_ascii=False,
+                                              sort_keys=True) + '\n')
+
+    sys.stdout.write("\r\n")
+    sys.stdout.flush()
+
+    result_message = ('Uploads complete -- {} successful, {} already '
+                      'uploaded, {} failures').format(
+        totals['uploaded'],
+        totals['skipped'],
+        totals['failed']
     )
     print(result_message)
     LOGGER.info(result_message)
@@ -204,6 +429,12 @@ def main():
         help='Path to the playlist file.',
         nargs=1
     )
+    parser_playlist.add_argument(
+        '--manifest',
+        help=('File recording every uploaded object, so an interrupted run '
+              'can resume (default: {}).'.format(MANIFEST_FILE)),
+        default=MANIFEST_FILE
+    )
 
     if len(sys.argv) == 1:
         sys.stderr.write('Error: please specify a command\n\n')
@@ -215,7 +446,7 @@ def main():
     args = parser.parse_args()
 
     if args.command == 'playlist':
-        results = import_playlist(args.filepath[0])
+        results = import_playlist(args.filepath[0], args.manifest)
 
     if results:
         LOGGER.info('Exporting new playlist file to \'playlist_s3.json\'')
@@ -0,0 +1,39 @@
+from rest_framework.response import Response
+
+
+class EagerLoadingMixin(object):
+    '''
+    Viewset mixin that lets a serializer set up the joins, prefetches and
+    annotations it needs (through a 'setup_eager_loading' static method)
+    before its queryset is evaluated.
+    '''
+    @staticmethod
+    def eager_load(queryset, serializer_class):
+        '''
+        Prepare the queryset for the given serializer, if it asks for it.
+        '''
+        setup = getattr(serializer_class, 'setup_eager_loading', None)
+        if setup is not None:
+            return setup(queryset)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        '''
+        Eager load the queryset used by the standard list/detail actions.
+        '''
+        queryset = super().filter_queryset(queryset)
+        return self.eager_load(queryset, self.get_serializer_class())
+
+    def get_listing_response(self, queryset, serializer_class):
+        '''
+        Eager load, paginate and serialize a listing for an extra action.
+        '''
+        queryset = self.eager_load(queryset, serializer_class)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = serializer_class(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = serializer_class(queryset, many=True)
+        return Response(serializer.data)
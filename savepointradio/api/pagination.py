@@ -1,5 +1,15 @@
+from base64 import b64decode, b64encode
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connections
+from django.db.models import Q
+
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class TotalPagesPagination(pagination.PageNumberPagination):
@@ -18,3 +28,226 @@ class TotalPagesPagination(pagination.PageNumberPagination):
             'total_pages': self.page.paginator.num_pages,
             'results': data
         })
+
+
+class KeysetPagination(pagination.BasePagination):
+    '''
+    Pagination class that pages by the values of the ordering columns (keyset
+    pagination) rather than by OFFSET, so a deep page costs the same as the
+    first one. The cursors in the links are opaque, and stay stable while new
+    rows are added.
+
+    The ordering is taken from the view's 'keyset_ordering' attribute, or
+    else from the queryset's ordering. The primary key is always added as
+    the last column to break ties, so the ordering columns should be covered
+    by an index ending in the primary key.
+
+    No COUNT(*) is run. Views can set 'keyset_estimate_count' to report the
+    planner's row estimate as 'count' (PostgreSQL only, otherwise null).
+    '''
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    ordering = None
+    estimate_count = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(queryset, view)
+        self.count = None
+        if getattr(view, 'keyset_estimate_count', self.estimate_count):
+            self.count = self.get_estimated_count(queryset)
+
+        position, self.reverse = self.decode_cursor(request)
+        ordering = self.ordering
+        if self.reverse:
+            ordering = [self._reverse_field(f) for f in ordering]
+
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._keyset_filter(ordering,
+                                                           position))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+
+        # Moving backwards, there is always a next page (the one we came
+        # from), and vice versa when moving forwards from a cursor.
+        if self.reverse:
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'count': self.count,
+            'results': data
+        })
+
+    def get_ordering(self, queryset, view):
+        '''
+        The ordering columns of the keyset, ending with the primary key.
+        '''
+        ordering = getattr(view, 'keyset_ordering', self.ordering)
+        if not ordering:
+            ordering = (queryset.query.order_by or
+                        queryset.model._meta.ordering)
+        ordering = [self._check_field(queryset.model, f) for f in ordering]
+
+        pk_names = ('pk', 'id', queryset.model._meta.pk.name)
+        if not any(f.lstrip('-') in pk_names for f in ordering):
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append(('pk', '-pk')[descending])
+        return ordering
+
+    def get_estimated_count(self, queryset):
+        '''
+        Ask the query planner for an estimate of the number of rows instead
+        of counting them.
+        '''
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, obj, reverse):
+        '''
+        Build a link to the page after (or before) the given object.
+        '''
+        position = [self._encode_value(self._get_value(obj, f))
+                    for f in self.ordering]
+        data = json.dumps({'p': position, 'r': int(reverse)})
+        cursor = b64encode(data.encode('utf8'), altchars=b'-_')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url,
+                                   self.cursor_query_param,
+                                   cursor.decode('ascii'))
+
+    def decode_cursor(self, request):
+        '''
+        Return the position and direction from the cursor in the request.
+        '''
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            data = json.loads(b64decode(encoded.encode('ascii'),
+                                        altchars=b'-_').decode('utf8'))
+            position = data['p']
+            reverse = bool(data['r'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or \
+           len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    @staticmethod
+    def _check_field(model, field):
+        '''
+        Make sure an ordering column is a plain (possibly related) field name,
+        since the cursors are built from the rows' values for it.
+        '''
+        if not isinstance(field, str):
+            raise ImproperlyConfigured(
+                'Keyset pagination can only order by field names, '
+                'not {!r}'.format(field)
+            )
+        try:
+            for name in field.lstrip('-').split('__'):
+                if model is None:
+                    raise FieldDoesNotExist(name)
+                if name == 'pk':
+                    model_field = model._meta.pk
+                else:
+                    model_field = model._meta.get_field(name)
+                model = model_field.related_model
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured(
+                'Keyset pagination can only order by field names, '
+                'not {!r}'.format(field)
+            )
+        return field
+
+    @staticmethod
+    def _reverse_field(field):
+        if field.startswith('-'):
+            return field[1:]
+        return '-' + field
+
+    @staticmethod
+    def _keyset_filter(ordering, position):
+        '''
+        Rows after the position, eg. for ordering (a, -b, pk):
+        (a > x) OR (a = x AND b < y) OR (a = x AND b = y AND pk > z)
+        '''
+        keyset = Q()
+        equal = Q()
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = ('__gt', '__lt')[field.startswith('-')]
+            keyset |= equal & Q(**{name + lookup: value})
+            equal &= Q(**{name: value})
+        return keyset
+
+    @staticmethod
+    def _get_value(obj, field):
+        value = obj
+        for attr in field.lstrip('-').split('__'):
+            value = getattr(value, attr)
+        return value
+
+    @staticmethod
+    def _encode_value(value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        if isinstance(value, (int, float, str)) or value is None:
+            return value
+        return str(value)
+
+
+class OptionalKeysetPagination(TotalPagesPagination):
+    '''
+    Page number pagination (with the total number of pages) by default, or
+    KeysetPagination when the client asks for it with a 'cursor' parameter
+    (left empty for the first page).
+    '''
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -1,6 +1,12 @@
-from rest_framework.serializers import (IntegerField,
+from datetime import timedelta
+
+from django.utils import timezone
+
+from rest_framework.serializers import (DateTimeField,
+                                        IntegerField,
                                         ModelSerializer,
-                                        Serializer)
+                                        Serializer,
+                                        ValidationError)
 
 from profiles.models import SongRequest
 from .radio import RadioSongSerializer
@@ -10,6 +16,34 @@ class JustPlayedSerializer(Serializer):
     song_request = IntegerField()
 
 
+class PlayedItemSerializer(Serializer):
+    # How far ahead of the server's clock a reported play may be
+    MAX_CLOCK_SKEW = timedelta(minutes=1)
+
+    song_request = IntegerField()
+    played_at = DateTimeField(required=False)
+
+    def validate_played_at(self, value):
+        if value > timezone.now() + self.MAX_CLOCK_SKEW:
+            raise ValidationError('Plays cannot be reported in the future.')
+        return value
+
+
+class BulkPlayedSerializer(Serializer):
+    MAX_ITEMS = 1000
+
+    played = PlayedItemSerializer(many=True, allow_empty=False)
+
+    def validate_played(self, value):
+        if len(value) > self.MAX_ITEMS:
+            raise ValidationError(
+                'No more than {} plays can be reported at once.'.format(
+                    self.MAX_ITEMS
+                )
+            )
+        return value
+
+
 class MakeRequestSerializer(Serializer):
     song = IntegerField()
 
@@ -20,3 +54,7 @@ class GetRequestSerializer(ModelSerializer):
     class Meta:
         model = SongRequest
         fields = ('id', 'song')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return RadioSongSerializer.setup_eager_loading(queryset, 'song__')
@@ -29,6 +29,10 @@ class BasicProfileSerializer(ModelSerializer):
         model = RadioProfile
         fields = ('id', 'user')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related('user')
+
 
 class FullProfileSerializer(BasicProfileSerializer):
     user = FullUserSerializer()
@@ -50,6 +54,11 @@ class HistorySerializer(ModelSerializer):
         model = SongRequest
         fields = ('created_date', 'played_at', 'profile', 'song')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        queryset = queryset.select_related('profile__user')
+        return SongMinimalSerializer.setup_eager_loading(queryset, 'song__')
+
 
 class BasicProfileRatingsSerializer(ModelSerializer):
     song = SongMinimalSerializer()
@@ -58,6 +67,10 @@ class BasicProfileRatingsSerializer(ModelSerializer):
         model = Rating
         fields = ('created_date', 'song', 'value')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return SongMinimalSerializer.setup_eager_loading(queryset, 'song__')
+
 
 class BasicSongRatingsSerializer(ModelSerializer):
     profile = BasicProfileSerializer()
@@ -65,3 +78,7 @@ class BasicSongRatingsSerializer(ModelSerializer):
     class Meta:
         model = Rating
         fields = ('created_date', 'profile', 'value')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related('profile__user')
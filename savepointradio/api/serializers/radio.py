@@ -1,3 +1,5 @@
+from django.db.models import Exists, OuterRef
+
 from rest_framework.serializers import (BooleanField, CharField, DecimalField,
                                         IntegerField, ListField,
                                         ModelSerializer, Serializer,
@@ -47,8 +49,16 @@ class StoreSerializer(ModelSerializer):
         model = Store
         fields = ('id', 'active', 'iri', 'file_size', 'length', 'mime_type')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        '''Annotate whether each store is active in the same query.'''
+        active_for = Song.objects.filter(active_store=OuterRef('pk'))
+        return queryset.annotate(is_active=Exists(active_for))
+
     def get_active(self, obj):
         '''Checks to see if this store is active for a song.'''
+        if hasattr(obj, 'is_active'):
+            return obj.is_active
         if obj.active_for.all():
             return True
         return False
@@ -68,6 +78,16 @@ class SongSerializer(ModelSerializer):
                   'num_played', 'last_played', 'length', 'next_play',
                   'song_type', 'title', 'average_rating', 'is_requestable')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        '''
+        Join the active store, prefetch the artists and annotate the request
+        state needed for each song.
+        '''
+        queryset = queryset.select_related('active_store')
+        queryset = queryset.prefetch_related('artists')
+        return queryset.with_request_state()
+
 
 class SongMinimalSerializer(ModelSerializer):
     '''Minimal song information, usually appended to favorites/ratings.'''
@@ -79,6 +99,15 @@ class SongMinimalSerializer(ModelSerializer):
         model = Song
         fields = ('id', 'album', 'artists', 'game', 'title')
 
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        '''
+        Join the album and game, and prefetch the artists, of each song. The
+        prefix is used when the songs are related to the queryset's model.
+        '''
+        queryset = queryset.select_related(prefix + 'album', prefix + 'game')
+        return queryset.prefetch_related(prefix + 'artists')
+
 
 class SongListSerializer(ModelSerializer):
     '''Song information used in large listings.'''
@@ -96,6 +125,16 @@ class SongListSerializer(ModelSerializer):
         fields = ('id', 'album', 'artists', 'game', 'title', 'average_rating',
                   'length', 'is_requestable')
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        '''
+        Join the album, game and active store, prefetch the artists and
+        annotate the request state needed for each song.
+        '''
+        queryset = queryset.select_related('album', 'game', 'active_store')
+        queryset = queryset.prefetch_related('artists')
+        return queryset.with_request_state()
+
 
 class SongRetrieveSerializer(SongSerializer):
     '''
@@ -106,6 +145,16 @@ class SongRetrieveSerializer(SongSerializer):
     artists = ArtistSerializer(many=True)
     game = GameSerializer()
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        '''
+        Join the album, game and active store, prefetch the artists and
+        annotate the request state needed for the song.
+        '''
+        queryset = queryset.select_related('album', 'game', 'active_store')
+        queryset = queryset.prefetch_related('artists')
+        return queryset.with_request_state()
+
 
 class RadioSongSerializer(ModelSerializer):
     '''
@@ -128,11 +177,29 @@ class RadioSongSerializer(ModelSerializer):
         fields = ('album', 'artists', 'game', 'song_type', 'title', 'length',
                   'replaygain', 'path')
 
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        '''
+        Join the album, game and active store, and prefetch the artists, of
+        each song. The prefix is used when the songs are related to the
+        queryset's model.
+        '''
+        queryset = queryset.select_related(prefix + 'album',
+                                           prefix + 'game',
+                                           prefix + 'active_store__cached')
+        return queryset.prefetch_related(prefix + 'artists')
+
     def get_path(self, obj):
-        '''Converts the IRI into a filesystem path.'''
+        '''
+        Converts the IRI into a filesystem path, or to the path of the local
+        copy of a remote file when it has been cached.
+        '''
         iri = str(obj.active_store.iri)
         if iri.startswith('file://'):
             return iri_to_path(iri)
+        cached = getattr(obj.active_store, 'cached', None)
+        if cached is not None and cached.is_warm:
+            return cached.path
         return iri
 
 
@@ -0,0 +1,49 @@
+'''
+Helpers for testing the API.
+'''
+
+import contextlib
+from unittest import mock
+from urllib.parse import urlsplit
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+
+class QueryCountMixin(object):
+    '''
+    TestCase mixin for checking that a listing endpoint runs a fixed number of
+    queries, no matter how many rows are on the page.
+    '''
+    def assertQueriesPerPage(self, url, num, page_sizes=(1, 10, 100),
+                             **extra):
+        '''
+        Fetch the url once per page size and assert every page took exactly
+        'num' queries. The page size is set on the pagination class of the
+        view behind the url (and on its keyset class, if it has one). The
+        database needs at least max(page_sizes) rows for the check to be
+        meaningful.
+        '''
+        view = resolve(urlsplit(url).path).func.cls
+        pagination_classes = [view.pagination_class]
+        if hasattr(view.pagination_class, 'keyset_class'):
+            pagination_classes.append(view.pagination_class.keyset_class)
+
+        for page_size in page_sizes:
+            with contextlib.ExitStack() as stack:
+                for pagination_class in pagination_classes:
+                    stack.enter_context(mock.patch.object(
+                        pagination_class, 'page_size', page_size
+                    ))
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url, **extra)
+            self.assertEqual(response.status_code, 200)
+            executed = len(context.captured_queries)
+            queries = '\n'.join(q['sql'] for q in context.captured_queries)
+            self.assertEqual(
+                executed,
+                num,
+                '{} queries executed for a page size of {}, {} expected\n'
+                '{}'.format(executed, page_size, num, queries)
+            )
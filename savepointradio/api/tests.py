@@ -1,3 +1,380 @@
-from django.test import TestCase
+from datetime import timedelta
+import json
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from core.models import RadioUser
+from profiles.models import RadioProfile, Rating, SongRequest
+from radio.models import Album, Artist, Game, Song, Store
+from .pagination import KeysetPagination
+from .serializers.controls import BulkPlayedSerializer
+from .testing import QueryCountMixin
+from .views.controls import IDEMPOTENCY_IN_PROGRESS
+
+
+class PaginationTests(TestCase):
+    '''
+    Listings page by page number unless a keyset cursor is asked for.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        game = Game.objects.create(title='Game')
+        album = Album.objects.create(title='Album')
+        Store.objects.bulk_create([
+            Store(iri='file:///music/{}.ogg'.format(i), length=100)
+            for i in range(150)
+        ])
+        stores = Store.objects.order_by('pk')
+        Song.objects.bulk_create([
+            Song(title='Song {:03}'.format(i),
+                 sorted_title='song {:03}'.format(i),
+                 game=game,
+                 album=album,
+                 active_store=store,
+                 published_date=published)
+            for i, store in enumerate(stores)
+        ])
+
+    def test_page_numbers_by_default(self):
+        response = self.client.get('/api/songs/', {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 150)
+        self.assertEqual(response.data['total_pages'], 2)
+        self.assertEqual(response.data['results'][0]['title'], 'Song 100')
+
+    def test_keyset_with_cursor(self):
+        response = self.client.get('/api/songs/', {'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('total_pages', response.data)
+        self.assertEqual(response.data['results'][0]['title'], 'Song 000')
+
+        response = self.client.get(response.data['links']['next'])
+        self.assertEqual(response.data['results'][0]['title'], 'Song 100')
+        self.assertIsNone(response.data['links']['next'])
+
+        response = self.client.get('/api/songs/', {'cursor': 'bad'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_keyset_orders_by_field_names_only(self):
+        paginator = KeysetPagination()
+        self.assertEqual(
+            paginator.get_ordering(Song.objects.order_by('game__title'), None),
+            ['game__title', 'pk']
+        )
+        for ordering in ('?', 'title__lower', F('title').desc()):
+            with self.assertRaises(ImproperlyConfigured):
+                paginator.get_ordering(Song.objects.order_by(ordering), None)
+
+
+class QueryCountTests(QueryCountMixin, TestCase):
+    '''
+    Every listing runs the same number of queries however long its page is.
+    The counts include the two queries loading the admin's session.
+    '''
+    ROWS = 100
+
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        rows = range(cls.ROWS)
+        Game.objects.bulk_create([
+            Game(title='Game {:03}'.format(i),
+                 sorted_title='game {:03}'.format(i),
+                 published_date=published)
+            for i in rows
+        ])
+        Album.objects.bulk_create([
+            Album(title='Album {:03}'.format(i),
+                  sorted_title='album {:03}'.format(i),
+                  published_date=published)
+            for i in rows
+        ])
+        Artist.objects.bulk_create([
+            Artist(alias='Artist {:03}'.format(i), published_date=published)
+            for i in rows
+        ])
+        Store.objects.bulk_create([
+            Store(iri='file:///music/{}.ogg'.format(i), length=100)
+            for i in rows
+        ])
+        games = Game.objects.order_by('pk')
+        albums = Album.objects.order_by('pk')
+        artists = Artist.objects.order_by('pk')
+        stores = Store.objects.order_by('pk')
+
+        Song.objects.bulk_create([
+            Song(title='Song {:03}'.format(i),
+                 sorted_title='song {:03}'.format(i),
+                 game=game,
+                 album=album,
+                 active_store=store,
+                 published_date=published)
+            for i, game, album, store in zip(rows, games, albums, stores)
+        ])
+        songs = Song.objects.order_by('pk')
+        cls.song = songs[0]
+        Song.artists.through.objects.bulk_create([
+            Song.artists.through(song=song, artist=artist)
+            for song, artist in zip(songs, artists)
+        ])
+        Song.stores.through.objects.bulk_create([
+            Song.stores.through(song=cls.song, store=store)
+            for store in stores
+        ])
+
+        for i in rows:
+            RadioUser.objects.create(email='user{}@example.com'.format(i),
+                                     name='User {}'.format(i))
+        profiles = RadioProfile.objects.filter(user__is_dj=False)
+        cls.profile = profiles.first()
+        RadioProfile.favorites.through.objects.bulk_create(
+            [RadioProfile.favorites.through(radioprofile=profile,
+                                            song=cls.song)
+             for profile in profiles] +
+            [RadioProfile.favorites.through(radioprofile=cls.profile,
+                                            song=song)
+             for song in songs[1:]]
+        )
+        Rating.objects.bulk_create([
+            Rating(profile=cls.profile, song=song, value=3) for song in songs
+        ])
+        SongRequest.objects.bulk_create([
+            SongRequest(profile=cls.profile,
+                        song=song,
+                        queued_at=published,
+                        played_at=published)
+            for song in songs
+        ])
+
+        cls.admin = RadioUser.objects.create(email='admin@example.com',
+                                             name='Admin',
+                                             is_staff=True,
+                                             is_superuser=True)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_radio_listings(self):
+        for url in ('/api/albums/', '/api/artists/', '/api/games/',
+                    '/api/stores/'):
+            with self.subTest(url=url):
+                self.assertQueriesPerPage(url, 4)
+
+    def test_song_listings(self):
+        self.assertQueriesPerPage('/api/songs/', 5)
+        self.assertQueriesPerPage('/api/songs/?cursor=', 4)
+        for action in ('stores', 'favorites'):
+            with self.subTest(action=action):
+                self.assertQueriesPerPage(
+                    '/api/songs/{}/{}/'.format(self.song.pk, action), 6
+                )
+
+    def test_profile_listings(self):
+        self.assertQueriesPerPage('/api/profiles/', 4)
+        for action in ('favorites', 'ratings'):
+            with self.subTest(action=action):
+                self.assertQueriesPerPage(
+                    '/api/profiles/{}/{}/'.format(self.profile.pk, action), 6
+                )
+
+    def test_history_listing(self):
+        self.assertQueriesPerPage('/api/history/', 5)
+        self.assertQueriesPerPage('/api/history/?cursor=', 4)
+
+
+class BulkPlayedTests(SimpleTestCase):
+    '''
+    Validating a batch of reported plays.
+    '''
+    def is_valid(self, played_at):
+        serializer = BulkPlayedSerializer(data={'played': [
+            {'song_request': 1, 'played_at': played_at.isoformat()}
+        ]})
+        return serializer.is_valid()
+
+    def test_plays_in_the_past(self):
+        self.assertTrue(self.is_valid(timezone.now() - timedelta(days=1)))
+
+    def test_clock_skew_allowed(self):
+        self.assertTrue(self.is_valid(timezone.now() + timedelta(seconds=5)))
+
+    def test_plays_in_the_future_rejected(self):
+        self.assertFalse(self.is_valid(timezone.now() + timedelta(hours=1)))
+
+
+class BulkPlayedRequestTests(TestCase):
+    '''
+    Reporting many plays at once through /played/bulk/.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        store = Store.objects.create(iri='file:///music/song.ogg', length=100)
+        cls.song = Song.objects.create(title='Song',
+                                       active_store=store,
+                                       published_date=published)
+        listener = RadioUser.objects.create(email='listener@example.com',
+                                            name='Listener')
+        cls.profile = RadioProfile.objects.get(user=listener)
+        dj = RadioUser.objects.get(is_dj=True)
+        cls.token = Token.objects.get_or_create(user=dj)[0].key
+
+    def setUp(self):
+        cache.clear()
+
+    def make_request(self, **kwargs):
+        return SongRequest.objects.create(profile=self.profile,
+                                          song=self.song,
+                                          queued_at=timezone.now(),
+                                          **kwargs)
+
+    def post(self, plays, key=None):
+        extra = {'HTTP_AUTHORIZATION': 'Token ' + self.token}
+        if key is not None:
+            extra['HTTP_IDEMPOTENCY_KEY'] = key
+        played = [{'song_request': pk, 'played_at': when.isoformat()}
+                  for pk, when in plays]
+        return self.client.post('/api/played/bulk/',
+                                json.dumps({'played': played}),
+                                content_type='application/json',
+                                **extra)
+
+    def test_same_song_twice(self):
+        first, second = self.make_request(), self.make_request()
+        earlier = timezone.now() - timedelta(minutes=10)
+        later = timezone.now() - timedelta(minutes=5)
+
+        response = self.post([(second.pk, later), (first.pk, earlier)])
+        self.assertEqual(response.data, {'played': [first.pk, second.pk],
+                                         'skipped': []})
+        self.song.refresh_from_db()
+        self.assertEqual(self.song.num_played, 2)
+        self.assertEqual(self.song.last_played, later)
+        first.refresh_from_db()
+        self.assertEqual(first.played_at, earlier)
+
+    def test_played_and_missing_skipped(self):
+        played = self.make_request(played_at=timezone.now())
+        waiting = self.make_request()
+        now = timezone.now()
+
+        response = self.post([(played.pk, now),
+                              (waiting.pk, now),
+                              (waiting.pk + 100, now)])
+        self.assertEqual(response.data, {'played': [waiting.pk],
+                                         'skipped': [played.pk,
+                                                     waiting.pk + 100]})
+        self.song.refresh_from_db()
+        self.assertEqual(self.song.num_played, 1)
+
+    def test_old_play_keeps_last_played(self):
+        latest = timezone.now() - timedelta(minutes=1)
+        Song.objects.filter(pk=self.song.pk).update(last_played=latest,
+                                                    num_played=3)
+
+        self.post([(self.make_request().pk, latest - timedelta(days=1))])
+        self.song.refresh_from_db()
+        self.assertEqual(self.song.last_played, latest)
+        self.assertEqual(self.song.num_played, 4)
+
+    def test_retry_gets_first_response(self):
+        song_request = self.make_request()
+        plays = [(song_request.pk, timezone.now())]
+
+        first = self.post(plays, key='batch')
+        self.assertEqual(first.data['played'], [song_request.pk])
+        self.assertEqual(self.post(plays, key='batch').data, first.data)
+        self.assertEqual(self.post(plays).data['skipped'], [song_request.pk])
+
+    def test_retry_during_first_attempt(self):
+        song_request = self.make_request()
+        plays = [(song_request.pk, timezone.now())]
+        mark_played = SongRequest.music.mark_played
+        retries = []
+
+        def slow_mark_played(reported):
+            # The retry arrives while the first attempt is still running
+            retries.append(self.post(plays, key='batch'))
+            return mark_played(reported)
+
+        with mock.patch.object(SongRequest.music, 'mark_played',
+                               side_effect=slow_mark_played), \
+                mock.patch('api.views.controls.IDEMPOTENCY_WAIT', 0):
+            first = self.post(plays, key='batch')
+
+        self.assertEqual(retries[0].status_code, 409)
+        self.assertEqual(self.post(plays, key='batch').data, first.data)
+
+
+class NextRequestTests(TestCase):
+    '''
+    Queueing the next song, with retries sharing an Idempotency-Key.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        for i in range(3):
+            store = Store.objects.create(iri='file:///music/{}.ogg'.format(i),
+                                         length=100)
+            Song.objects.create(title='Song {}'.format(i),
+                                active_store=store,
+                                published_date=published)
+        dj = RadioUser.objects.get(is_dj=True)
+        cls.token = Token.objects.get_or_create(user=dj)[0].key
+
+    def setUp(self):
+        cache.clear()
+
+    def next_song(self, key='retry'):
+        return self.client.get('/api/next/',
+                               HTTP_AUTHORIZATION='Token ' + self.token,
+                               HTTP_IDEMPOTENCY_KEY=key)
+
+    def queued(self):
+        return SongRequest.objects.filter(queued_at__isnull=False).count()
+
+    def test_retry_gets_first_song(self):
+        first = self.next_song()
+        retry = self.next_song()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(self.queued(), 1)
+
+        self.assertNotEqual(self.next_song('other').data['id'],
+                            first.data['id'])
+
+    def test_retry_during_first_attempt(self):
+        queue_next = SongRequest.music.queue_next
+        retries = []
+
+        def slow_queue_next():
+            # The retry arrives while the first attempt is still running
+            retries.append(self.next_song())
+            return queue_next()
+
+        with mock.patch.object(SongRequest.music, 'queue_next',
+                               side_effect=slow_queue_next), \
+                mock.patch('api.views.controls.IDEMPOTENCY_WAIT', 0):
+            first = self.next_song()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(retries[0].status_code, 409)
+        self.assertEqual(self.queued(), 1)
+        self.assertEqual(self.next_song().data, first.data)
+
+    def test_failed_attempt_releases_key(self):
+        with mock.patch.object(SongRequest.music, 'queue_next',
+                               return_value=None):
+            self.assertEqual(self.next_song().status_code, 503)
+        self.assertNotEqual(cache.get('api.next.retry'),
+                            IDEMPOTENCY_IN_PROGRESS)
+        self.assertEqual(self.next_song().status_code, 200)
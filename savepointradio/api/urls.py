@@ -2,7 +2,8 @@ from django.urls import path
 
 from rest_framework.routers import DefaultRouter
 
-from api.views.controls import JustPlayed, MakeRequest, NextRequest
+from api.views.controls import (BulkJustPlayed, JustPlayed, MakeRequest,
+                                NextRequest)
 from api.views.profiles import HistoryViewSet, ProfileViewSet
 from api.views.radio import (AlbumViewSet, ArtistViewSet, GameViewSet,
                              StoreViewSet, SongViewSet)
@@ -34,6 +35,7 @@ router.register(r'songs', SongViewSet, base_name='song')
 urlpatterns = [
     path('next/', NextRequest.as_view()),
     path('played/', JustPlayed.as_view()),
+    path('played/bulk/', BulkJustPlayed.as_view()),
     path('request/', MakeRequest.as_view()),
 ]
 
@@ -1,4 +1,7 @@
+import time
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.utils import timezone
 
 from rest_framework import status
@@ -9,18 +12,63 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from core.utils import get_setting
 from profiles.exceptions import MakeRequestError
 from profiles.models import RadioProfile, SongRequest
-from radio.models import Song
+from radio.models import CachedStore
 from ..permissions import IsDJ
-from ..serializers.controls import (JustPlayedSerializer,
+from ..serializers.controls import (BulkPlayedSerializer,
+                                    JustPlayedSerializer,
                                     MakeRequestSerializer,
                                     GetRequestSerializer)
 
 
 User = get_user_model()
 
+# How long the response to a batch of plays (or to a next song call) is kept
+# for its idempotency key. The responses are kept in Django's cache, which
+# has to be shared between the workers for retries to find them (see CACHES
+# in the settings).
+IDEMPOTENCY_TTL = 60 * 60 * 24
+
+# Kept under an idempotency key while its first attempt is still running.
+# The reservation lapses after IDEMPOTENCY_LOCK_TTL seconds in case that
+# attempt never finishes, and a retry waits up to IDEMPOTENCY_WAIT seconds
+# for it to finish before giving up with a 409.
+IDEMPOTENCY_IN_PROGRESS = 'in-progress'
+IDEMPOTENCY_LOCK_TTL = 60
+IDEMPOTENCY_WAIT = 10
+IDEMPOTENCY_POLL = 0.1
+
+
+def reserve_idempotency_key(cache_key):
+    '''
+    Atomically claim an idempotency key for this attempt, returning None if
+    it was claimed. Otherwise, return the response stored by the attempt
+    holding it, waiting for that attempt to finish first (or returning
+    IDEMPOTENCY_IN_PROGRESS if it didn't finish in time).
+    '''
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        if cache.add(cache_key, IDEMPOTENCY_IN_PROGRESS, IDEMPOTENCY_LOCK_TTL):
+            return None
+        response = cache.get(cache_key)
+        if response is not None and response != IDEMPOTENCY_IN_PROGRESS:
+            return response
+        if time.monotonic() >= deadline:
+            return IDEMPOTENCY_IN_PROGRESS
+        time.sleep(IDEMPOTENCY_POLL)
+
+
+def replay_response(response):
+    '''
+    Respond to a retry with the response stored for its idempotency key.
+    '''
+    if response == IDEMPOTENCY_IN_PROGRESS:
+        return Response({'detail': 'A request with this Idempotency-Key is '
+                                   'still being processed.'},
+                        status=status.HTTP_409_CONFLICT)
+    return Response(response)
+
 
 class JustPlayed(APIView):
     authentication_classes = [TokenAuthentication]
@@ -47,33 +95,88 @@ class JustPlayed(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class BulkJustPlayed(APIView):
+    '''
+    Report many played songs at once, eg. the DJ's spooled reports or a
+    replay of old playout logs. Each play is only ever counted once, and an
+    'Idempotency-Key' header makes a retried batch get back the response of
+    the first attempt, even while that attempt is running.
+    '''
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsDJ]
+
+    def post(self, request, format=None):
+        cache_key = None
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if idempotency_key:
+            cache_key = 'api.played.{}'.format(idempotency_key[:128])
+            response = reserve_idempotency_key(cache_key)
+            if response is not None:
+                return replay_response(response)
+
+        serializer = BulkPlayedSerializer(data=request.data)
+        if serializer.is_valid():
+            now = timezone.now()
+            plays = [(item['song_request'], item.get('played_at') or now)
+                     for item in serializer.validated_data['played']]
+            try:
+                played = SongRequest.music.mark_played(plays)
+            except Exception:
+                if cache_key is not None:
+                    cache.delete(cache_key)
+                raise
+
+            response = {
+                'played': sorted(played),
+                'skipped': sorted(set(p[0] for p in plays) - set(played))
+            }
+            if cache_key is not None:
+                cache.set(cache_key, response, IDEMPOTENCY_TTL)
+            return Response(response)
+        if cache_key is not None:
+            cache.delete(cache_key)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class NextRequest(RetrieveAPIView):
+    '''
+    Queue the next song to play. An 'Idempotency-Key' header makes a retried
+    call (eg. after a timeout) get back the song queued by the first attempt
+    instead of queueing another one, even while that attempt is running.
+    '''
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsDJ]
     queryset = SongRequest.objects.all()
     serializer = GetRequestSerializer
 
     def retrieve(self, request):
-        dj_profile = RadioProfile.objects.get(user__is_dj=True)
-
-        limit = get_setting('songs_per_jingle')
-        played_songs = SongRequest.music.get_played_requests(limit)
-        if [j for j in played_songs if j.song.is_jingle]:
-            if not SongRequest.music.unplayed().exists():
-                random_song = Song.music.get_random_requestable_song()
-                next_play = SongRequest.objects.create(profile=dj_profile,
-                                                       song=random_song)
-            else:
-                next_play = SongRequest.music.next_request()
-        else:
-            random_jingle = Song.music.get_random_jingle()
-            next_play = SongRequest.objects.create(profile=dj_profile,
-                                                   song=random_jingle)
-
-        next_play.queued_at = timezone.now()
-        next_play.save(update_fields=['queued_at'])
-
+        cache_key = None
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if idempotency_key:
+            cache_key = 'api.next.{}'.format(idempotency_key[:128])
+            response = reserve_idempotency_key(cache_key)
+            if response is not None:
+                return replay_response(response)
+
+        try:
+            next_play = SongRequest.music.queue_next()
+        except Exception:
+            if cache_key is not None:
+                cache.delete(cache_key)
+            raise
+        if next_play is None:
+            if cache_key is not None:
+                cache.delete(cache_key)
+            return Response({'detail': 'No songs are available to play.'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        next_play = GetRequestSerializer.setup_eager_loading(
+            SongRequest.objects.filter(pk=next_play.pk)
+        ).get()
+        CachedStore.objects.mark_used(next_play.song.active_store_id)
         serializer = GetRequestSerializer(next_play, many=False)
+        if cache_key is not None:
+            cache.set(cache_key, serializer.data, IDEMPOTENCY_TTL)
         return Response(serializer.data)
 
 
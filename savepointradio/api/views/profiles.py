@@ -3,9 +3,11 @@ from django.shortcuts import get_object_or_404
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny
-from rest_framework.response import Response
 
 from profiles.models import RadioProfile, SongRequest
+from radio.models import Song
+from ..mixins import EagerLoadingMixin
+from ..pagination import OptionalKeysetPagination
 from ..permissions import IsAdminOwnerOrReadOnly
 from ..serializers.profiles import (BasicProfileSerializer,
                                     FullProfileSerializer,
@@ -14,7 +16,7 @@ from ..serializers.profiles import (BasicProfileSerializer,
 from ..serializers.radio import SongListSerializer
 
 
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOwnerOrReadOnly]
     queryset = RadioProfile.objects.all()
     serializer_class = BasicProfileSerializer
@@ -37,7 +39,8 @@ class ProfileViewSet(viewsets.ModelViewSet):
         Grab the object as normal, but let us know if the requesting user is
         the owner.
         '''
-        obj = get_object_or_404(self.get_queryset(), **self.kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        obj = get_object_or_404(queryset, **self.kwargs)
         if self.request.user.pk == obj.user.pk:
             self.is_owner = True
         else:
@@ -48,31 +51,25 @@ class ProfileViewSet(viewsets.ModelViewSet):
     @action(detail=True, permission_classes=[AllowAny])
     def favorites(self, request, pk=None):
         profile = self.get_object()
-        favorites = profile.favorites.all().order_by('sorted_title')
-
-        page = self.paginate_queryset(favorites)
-        if page is not None:
-            serializer = SongListSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = SongListSerializer(favorites, many=True)
-        return Response(serializer.data)
+        favorites = Song.music.filter(
+            song_favorites=profile
+        ).order_by('sorted_title')
+        return self.get_listing_response(favorites, SongListSerializer)
 
     @action(detail=True, permission_classes=[AllowAny])
     def ratings(self, request, pk=None):
         profile = self.get_object()
         ratings = profile.rating_profile.all().order_by('-created_date')
-
-        page = self.paginate_queryset(ratings)
-        if page is not None:
-            serializer = BasicProfileRatingsSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = BasicProfileRatingsSerializer(ratings, many=True)
-        return Response(serializer.data)
+        return self.get_listing_response(ratings,
+                                         BasicProfileRatingsSerializer)
 
 
-class HistoryViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+class HistoryViewSet(EagerLoadingMixin,
+                     mixins.ListModelMixin,
+                     viewsets.GenericViewSet):
     permission_classes = [AllowAny]
-    queryset = SongRequest.objects.all()
+    queryset = SongRequest.music.unplanned()
     serializer_class = HistorySerializer
+    pagination_class = OptionalKeysetPagination
+    keyset_ordering = ('-created_date', '-id')
+    keyset_estimate_count = True
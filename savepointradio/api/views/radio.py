@@ -5,6 +5,8 @@ from rest_framework.response import Response
 
 from profiles.models import RadioProfile, Rating
 from radio.models import Album, Artist, Game, Song, Store
+from ..mixins import EagerLoadingMixin
+from ..pagination import OptionalKeysetPagination
 from ..permissions import IsAdminOrReadOnly, IsAuthenticatedAndNotDJ
 from ..serializers.profiles import (BasicProfileSerializer,
                                     BasicSongRatingsSerializer,
@@ -65,14 +67,19 @@ class GameViewSet(viewsets.ModelViewSet):
         return Game.music.available()
 
 
-class StoreViewSet(viewsets.ModelViewSet):
+class StoreViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     queryset = Store.objects.all()
     permission_classes = [IsAdminUser]
     serializer_class = StoreSerializer
 
 
-class SongViewSet(viewsets.ModelViewSet):
+class SongViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
+    # With a 'cursor', songs page by their default ordering (sorted_title,
+    # id), while the extra listings page by the ordering of their own
+    # querysets.
+    pagination_class = OptionalKeysetPagination
+    keyset_estimate_count = True
 
     def get_queryset(self):
         '''
@@ -82,7 +89,7 @@ class SongViewSet(viewsets.ModelViewSet):
         if (self.request.user.is_authenticated and
             self.request.user.is_staff and
             not self.request.user.is_dj):
-            return Song.objects.all()
+            return Song.music.all()
         return Song.music.available_songs()
 
     def get_serializer_class(self):
@@ -172,28 +179,14 @@ class SongViewSet(viewsets.ModelViewSet):
         '''Get a list of data stores associate with this song.'''
         song = self.get_object()
         stores = song.stores.all().order_by('-created_date')
-
-        page = self.paginate_queryset(stores)
-        if page is not None:
-            serializer = StoreSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = StoreSerializer(stores, many=True)
-        return Response(serializer.data)
+        return self.get_listing_response(stores, StoreSerializer)
 
     @action(detail=True, permission_classes=[AllowAny])
     def favorites(self, request, pk=None):
         '''Get a list of users who added this song to their favorites list.'''
         song = self.get_object()
         profiles = song.song_favorites.all().order_by('user__name')
-
-        page = self.paginate_queryset(profiles)
-        if page is not None:
-            serializer = BasicProfileSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = BasicProfileSerializer(profiles, many=True)
-        return Response(serializer.data)
+        return self.get_listing_response(profiles, BasicProfileSerializer)
 
     @action(methods=['post'],
             detail=True,
@@ -231,14 +224,7 @@ class SongViewSet(viewsets.ModelViewSet):
         '''Get a list of a song's ratings.'''
         song = self.get_object()
         ratings = song.rating_set.all().order_by('-created_date')
-
-        page = self.paginate_queryset(ratings)
-        if page is not None:
-            serializer = BasicSongRatingsSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = BasicSongRatingsSerializer(ratings, many=True)
-        return Response(serializer.data)
+        return self.get_listing_response(ratings, BasicSongRatingsSerializer)
 
     @action(methods=['post'],
             detail=True,
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from .signals import (check_setting_version, delete_setting_through,
+                              write_setting_through)
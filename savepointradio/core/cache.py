@@ -0,0 +1,133 @@
+'''
+In-process caching of the dynamic settings stored in the database.
+'''
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Setting
+
+
+VERSION_KEY = 'core.setting_cache.version'
+
+
+class SettingCache(object):
+    '''
+    Keeps a typed copy of every Setting row in memory. All rows are loaded
+    with a single query and served from memory until either the TTL runs out
+    or the shared version counter is bumped by another process saving a
+    Setting.
+
+    The version counter lives in Django's cache framework, so invalidation
+    reaches other workers when a shared backend (memcached, redis, database)
+    is configured. With the default local-memory backend, the TTL is what
+    bounds how stale another worker can be. The counter is only checked on
+    the first read of each request (see new_request()), and otherwise when
+    the TTL runs out.
+    '''
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._values = None
+        self._version = None
+        self._loaded_at = 0.0
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return getattr(settings, 'DYNAMIC_SETTING_CACHE_TTL', 60)
+        return self._ttl
+
+    def _shared_version(self):
+        return cache.get(VERSION_KEY, 0)
+
+    def _is_stale(self):
+        if self._values is None:
+            return True
+        if time.monotonic() - self._loaded_at >= self.ttl:
+            return True
+        if getattr(self._local, 'checked', False):
+            return False
+        self._local.checked = True
+        return self._version != self._shared_version()
+
+    def new_request(self):
+        '''
+        Let the next read in this thread check the shared version counter
+        again.
+        '''
+        self._local.checked = False
+
+    def load(self):
+        '''
+        Fetch every setting from the database in one query and replace the
+        cached values.
+        '''
+        version = self._shared_version()
+        values = {s.name: s.get() for s in Setting.objects.all()}
+        self._local.checked = True
+        with self._lock:
+            self._values = values
+            self._version = version
+            self._loaded_at = time.monotonic()
+        return values
+
+    def get(self, name):
+        '''
+        Return the typed value of a setting, reloading all settings first if
+        the cache is stale.
+        '''
+        values = self._values
+        if self._is_stale():
+            values = self.load()
+        try:
+            return values[name]
+        except KeyError:
+            raise Setting.DoesNotExist(
+                'Setting "{}" does not exist.'.format(name)
+            )
+
+    def set(self, name, value):
+        '''
+        Write a typed value straight into this process' cache.
+        '''
+        with self._lock:
+            if self._values is not None:
+                self._values[name] = value
+
+    def delete(self, name):
+        '''
+        Remove a setting from this process' cache.
+        '''
+        with self._lock:
+            if self._values is not None:
+                self._values.pop(name, None)
+
+    def clear(self):
+        '''
+        Drop this process' cached values so the next read reloads them.
+        '''
+        with self._lock:
+            self._values = None
+
+    def bump_version(self):
+        '''
+        Increment the shared version counter so other processes reload on
+        their next read. This process keeps its values (which were already
+        written through) unless another process changed a setting in the
+        meantime.
+        '''
+        cache.add(VERSION_KEY, 0, timeout=None)
+        version = cache.incr(VERSION_KEY)
+        with self._lock:
+            if self._version == version - 1:
+                self._version = version
+            else:
+                self._values = None
+
+
+setting_cache = SettingCache()
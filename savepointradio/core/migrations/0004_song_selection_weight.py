@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:46
+
+from django.db import migrations
+
+
+def song_selection_weight(apps, schema_editor):
+    SETTING_TYPES = {'Integer': 0, 'Float': 1, 'String': 2, 'Bool': 3}
+    Setting = apps.get_model('core', 'Setting')
+    db_alias = schema_editor.connection.alias
+    Setting.objects.using(db_alias).create(
+        name='song_selection_weight',
+        description='How the DJ weights the random selection of songs. Use '
+                    '"none" for an even chance, "rating" to favor higher '
+                    'rated songs, or "plays" to favor less played songs.',
+        setting_type=SETTING_TYPES['String'],
+        data='none'
+    )
+
+
+def remove_song_selection_weight(apps, schema_editor):
+    Setting = apps.get_model('core', 'Setting')
+    db_alias = schema_editor.connection.alias
+    Setting.objects.using(db_alias).filter(
+        name='song_selection_weight'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_default_settings'),
+    ]
+
+    operations = [
+        migrations.RunPython(song_selection_weight,
+                             remove_song_selection_weight),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:53
+
+from django.db import migrations
+
+
+def lookahead_queue_size(apps, schema_editor):
+    SETTING_TYPES = {'Integer': 0, 'Float': 1, 'String': 2, 'Bool': 3}
+    Setting = apps.get_model('core', 'Setting')
+    db_alias = schema_editor.connection.alias
+    Setting.objects.using(db_alias).create(
+        name='lookahead_queue_size',
+        description='The amount of songs the "planqueue" command keeps '
+                    'planned ahead of time, so the DJ does not have to '
+                    'pick them when asking for the next song.',
+        setting_type=SETTING_TYPES['Integer'],
+        data='5'
+    )
+
+
+def remove_lookahead_queue_size(apps, schema_editor):
+    Setting = apps.get_model('core', 'Setting')
+    db_alias = schema_editor.connection.alias
+    Setting.objects.using(db_alias).filter(
+        name='lookahead_queue_size'
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_song_selection_weight'),
+    ]
+
+    operations = [
+        migrations.RunPython(lookahead_queue_size,
+                             remove_lookahead_queue_size),
+    ]
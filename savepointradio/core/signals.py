@@ -0,0 +1,44 @@
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import setting_cache
+from .models import Setting
+
+
+@receiver(post_save, sender=Setting)
+def write_setting_through(sender, instance, **kwargs):
+    """
+    Once the change is committed, write the saved value into this process'
+    setting cache and let every other process know to reload.
+    """
+    name, value = instance.name, instance.get()
+
+    def write_through():
+        setting_cache.set(name, value)
+        setting_cache.bump_version()
+    transaction.on_commit(write_through)
+
+
+@receiver(post_delete, sender=Setting)
+def delete_setting_through(sender, instance, **kwargs):
+    """
+    Once the deletion is committed, drop the setting from the cache and
+    notify the other processes.
+    """
+    name = instance.name
+
+    def delete_through():
+        setting_cache.delete(name)
+        setting_cache.bump_version()
+    transaction.on_commit(delete_through)
+
+
+@receiver(request_started)
+def check_setting_version(sender, **kwargs):
+    """
+    Check whether another process changed a setting at most once per
+    request.
+    """
+    setting_cache.new_request()
@@ -1,3 +1,64 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from .cache import setting_cache, VERSION_KEY
+from .utils import get_setting, set_setting
+
+
+class SettingCacheTests(TestCase):
+    '''
+    Dynamic settings are served from memory, checking for changes made by
+    other processes at most once per request.
+    '''
+    def setUp(self):
+        cache.delete(VERSION_KEY)
+        setting_cache.clear()
+
+    def test_version_checked_once_per_request(self):
+        get_setting('songs_per_jingle')
+        with mock.patch.object(setting_cache, '_shared_version',
+                               wraps=setting_cache._shared_version) as check:
+            setting_cache.new_request()
+            for _ in range(3):
+                get_setting('songs_per_jingle')
+        self.assertEqual(check.call_count, 1)
+
+    def test_changes_seen_on_next_request(self):
+        before = get_setting('songs_per_jingle')
+        # Another process saves the setting and bumps the counter
+        set_setting('songs_per_jingle', before + 1)
+        cache.add(VERSION_KEY, 0)
+        cache.incr(VERSION_KEY)
+
+        self.assertEqual(get_setting('songs_per_jingle'), before)
+        setting_cache.new_request()
+        self.assertEqual(get_setting('songs_per_jingle'), before + 1)
+
+    def test_bump_version_without_counter(self):
+        setting_cache.bump_version()
+        setting_cache.bump_version()
+        self.assertEqual(cache.get(VERSION_KEY), 2)
+
+
+class SettingWriteThroughTests(TransactionTestCase):
+    '''
+    Saved settings only reach the cache once they are committed.
+    '''
+    serialized_rollback = True
+
+    def setUp(self):
+        setting_cache.clear()
+
+    def test_rolled_back_change_not_cached(self):
+        before = get_setting('songs_per_jingle')
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                set_setting('songs_per_jingle', before + 1)
+                raise RuntimeError
+        self.assertEqual(get_setting('songs_per_jingle'), before)
+
+        set_setting('songs_per_jingle', before + 1)
+        self.assertEqual(get_setting('songs_per_jingle'), before + 1)
@@ -16,6 +16,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import connection
 from django.utils.encoding import iri_to_uri, uri_to_iri
 
+from .cache import setting_cache
 from .models import Setting
 
 
@@ -67,13 +68,18 @@ def get_len(rawqueryset):
 
 
 def get_setting(name):
-    '''Helper function to get dynamic settings from the database.'''
-    setting = Setting.objects.get(name=name)
-    return setting.get()
+    '''
+    Helper function to get dynamic settings from the database. Values are
+    served from the in-process setting cache.
+    '''
+    return setting_cache.get(name)
 
 
 def set_setting(name, value, setting_type=None):
-    '''Helper function to set dynamic settings from the database.'''
+    '''
+    Helper function to set dynamic settings from the database. The saved
+    value is written through to the setting cache once it's committed.
+    '''
     setting_types = {'Integer': 0, 'Float': 1, 'String': 2, 'Bool': 3}
     try:
         setting = Setting.objects.get(name=name)
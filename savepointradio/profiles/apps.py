@@ -5,4 +5,8 @@ class ProfilesConfig(AppConfig):
     name = 'profiles'
 
     def ready(self):
-        from .signals import create_profile, update_song_plays
+        from .signals import (add_song_rating, create_profile,
+                              drop_unavailable_plans,
+                              drop_unavailable_plans_in_bulk,
+                              remember_rating_value, remove_song_rating,
+                              update_song_plays)
@@ -0,0 +1,40 @@
+'''
+Django management command to keep the next songs for the DJ planned ahead of
+time. Run it once (eg. from cron), or leave it running with "--interval".
+'''
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from profiles.models import SongRequest
+
+
+class Command(BaseCommand):
+    '''Main "planqueue" command class'''
+    help = 'Plans the next songs and jingles the DJ will play'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size',
+                            type=int,
+                            help='Number of songs to keep planned (defaults '
+                                 'to the "lookahead_queue_size" setting)')
+        parser.add_argument('--interval',
+                            type=int,
+                            help='Keep running, topping up the plan every '
+                                 'INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        if options['size'] is not None and options['size'] < 0:
+            raise CommandError('Size must not be negative')
+
+        while True:
+            added = SongRequest.music.plan_ahead(options['size'])
+            self.stdout.write('Planned {} requests ({} waiting)'.format(
+                str(added),
+                str(SongRequest.music.planned().count())
+            ))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
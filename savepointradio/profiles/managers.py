@@ -1,4 +1,10 @@
-from django.db import models
+from django.apps import apps
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from core.utils import get_setting
+from radio.models import PlaylistAggregate, Song
 
 
 class RequestManager(models.Manager):
@@ -8,6 +14,49 @@ class RequestManager(models.Manager):
     def unplayed(self):
         return self.get_queryset().filter(played_at__isnull=True)
 
+    def unqueued(self):
+        return self.unplayed().filter(queued_at__isnull=True)
+
+    def planned(self):
+        '''
+        Requests the DJ has planned ahead of time that are still waiting.
+        '''
+        return self.unqueued().filter(profile__user__is_dj=True)
+
+    def waiting(self):
+        '''
+        Requests made by listeners that are still waiting.
+        '''
+        return self.unqueued().exclude(profile__user__is_dj=True)
+
+    def unplanned(self):
+        '''
+        Every request except the ones the DJ has planned ahead of time and
+        not queued yet.
+        '''
+        return self.get_queryset().exclude(
+            played_at__isnull=True,
+            queued_at__isnull=True,
+            profile__user__is_dj=True
+        )
+
+    def pending(self):
+        '''
+        Unplayed requests that hold on to their song: the queued ones, and
+        the ones listeners are still waiting for. Planned songs give way to
+        them, so they can still be requested.
+        '''
+        return self.unplanned().filter(played_at__isnull=True)
+
+    def playable_planned(self):
+        '''
+        Planned requests whose songs are still available to be played.
+        '''
+        return self.planned().filter(
+            song__disabled=False,
+            song__published_date__lte=timezone.now()
+        )
+
     def played(self):
         return self.get_queryset().filter(models.Q(queued_at__isnull=False) |
                                           models.Q(played_at__isnull=False))
@@ -19,3 +68,192 @@ class RequestManager(models.Manager):
 
     def next_request(self):
         return self.unplayed().earliest('created_date')
+
+    def dj_profile_id(self):
+        '''
+        Primary key of the DJ's profile.
+        '''
+        profile = apps.get_model(app_label='profiles',
+                                 model_name='RadioProfile')
+        return profile.objects.values_list('pk', flat=True).get(
+            user__is_dj=True
+        )
+
+    def lock_queue_state(self):
+        '''
+        Lock the single row of queue state (creating it if it's missing) for
+        the rest of the transaction, and return it.
+        '''
+        queue_state = apps.get_model(app_label='profiles',
+                                     model_name='QueueState')
+        queue_state.objects.get_or_create(pk=1)
+        return queue_state.objects.select_for_update().get(pk=1)
+
+    def _pop(self, queryset):
+        '''
+        Lock and return the oldest request in the queryset. Callers already
+        hold the queue state lock, so no one else is popping at the same time.
+        '''
+        return queryset.select_for_update(
+            of=('self',)
+        ).select_related('song').order_by('created_date').first()
+
+    def queue_next(self):
+        '''
+        Decide what the DJ plays next and queue it, returning the song
+        request. Jingles come from the planned queue (or at random) every
+        'songs_per_jingle' songs. Otherwise, the oldest listener request is
+        played, then the oldest planned song, and only if nothing was
+        planned is a random song picked on the spot.
+
+        Everything happens in one transaction holding a lock on the queue
+        state, so concurrent callers are served one after the other. Returns
+        None if there is nothing available to play.
+        '''
+        now = timezone.now()
+
+        with transaction.atomic():
+            state = self.lock_queue_state()
+
+            next_play = None
+            if state.songs_since_jingle >= get_setting('songs_per_jingle'):
+                next_play = self._pop(
+                    self.playable_planned().filter(song__song_type='J')
+                )
+                if next_play is None:
+                    jingle = Song.music.get_random_jingle()
+                    if jingle is not None:
+                        next_play = self.create(
+                            profile_id=self.dj_profile_id(),
+                            song=jingle
+                        )
+                if next_play is not None:
+                    state.songs_since_jingle = 0
+
+            if next_play is None:
+                next_play = self._pop(self.waiting())
+                if next_play is None:
+                    next_play = self._pop(
+                        self.playable_planned().filter(song__song_type='S')
+                    )
+                if next_play is None:
+                    song = Song.music.get_random_requestable_song()
+                    if song is None:
+                        return None
+                    next_play = self.create(profile_id=self.dj_profile_id(),
+                                            song=song)
+                state.songs_since_jingle += 1
+
+            next_play.queued_at = now
+            self.filter(pk=next_play.pk).update(queued_at=now)
+            state.save(update_fields=['songs_since_jingle'])
+            if next_play.song is not None:
+                Song.music.mark_queued(next_play.song, now)
+
+        return next_play
+
+    def mark_played(self, plays):
+        '''
+        Mark many requests as played at once, given (request id, played at)
+        pairs. Requests that don't exist or were already played are skipped,
+        so reporting the same play twice is harmless. The requests, and the
+        last played date and play count of their songs, are each written
+        with a single bulk update in one transaction. Returns the ids of the
+        requests that were marked.
+        '''
+        played_at = {}
+        for request_id, when in plays:
+            played_at.setdefault(request_id, when)
+
+        with transaction.atomic():
+            requests = list(self.unplayed().filter(
+                pk__in=played_at
+            ).select_for_update().only('pk', 'song_id'))
+            if not requests:
+                return []
+
+            song_plays = {}
+            for song_request in requests:
+                song_request.played_at = played_at[song_request.pk]
+                if song_request.song_id is not None:
+                    count, last = song_plays.get(song_request.song_id,
+                                                 (0, None))
+                    if last is None or song_request.played_at > last:
+                        last = song_request.played_at
+                    song_plays[song_request.song_id] = (count + 1, last)
+            self.bulk_update(requests, ['played_at'])
+
+            songs = []
+            for song_id, (count, last) in song_plays.items():
+                last = models.Value(last, output_field=models.DateTimeField())
+                songs.append(Song(
+                    pk=song_id,
+                    num_played=models.F('num_played') + count,
+                    last_played=Greatest(Coalesce('last_played', last), last)
+                ))
+            Song.objects.bulk_update(songs, ['num_played', 'last_played'])
+            PlaylistAggregate.objects.raise_least_played()
+
+        return [song_request.pk for song_request in requests]
+
+    def prune_planned(self, song_ids=None):
+        '''
+        Drop planned requests whose songs are no longer available (or only
+        those for the given songs).
+        '''
+        planned = self.planned()
+        if song_ids is not None:
+            planned = planned.filter(song_id__in=song_ids)
+        available = Song.music.available().values('pk')
+        return planned.exclude(song__in=available).delete()[0]
+
+    def plan_ahead(self, size=None):
+        '''
+        Keep the next 'size' songs (by default the 'lookahead_queue_size'
+        setting), and the jingles due between them, planned as requests from
+        the DJ, so the next song can be popped off the queue instantly.
+        Returns the number of newly planned requests.
+        '''
+        if size is None:
+            size = get_setting('lookahead_queue_size')
+
+        added = 0
+        with transaction.atomic():
+            state = self.lock_queue_state()
+            dj_profile_id = self.dj_profile_id()
+            self.prune_planned()
+
+            planned = self.planned()
+            planned_songs = list(planned.filter(
+                song__song_type='S'
+            ).values_list('song_id', flat=True))
+            for _ in range(size - len(planned_songs)):
+                # Planned songs are still requestable, so leave them out
+                song = Song.music.pick_random(
+                    Song.music.requestable().exclude(pk__in=planned_songs)
+                )
+                if song is None:
+                    break
+                self.create(profile_id=dj_profile_id, song=song)
+                planned_songs.append(song.pk)
+                added += 1
+
+            per_jingle = max(get_setting('songs_per_jingle'), 1)
+            jingles_due = (state.songs_since_jingle + size) // per_jingle
+            planned_jingles = list(planned.filter(
+                song__song_type='J'
+            ).values_list('song_id', flat=True))
+            for _ in range(jingles_due - len(planned_jingles)):
+                jingles = Song.music.available_jingles()
+                jingle = Song.music.pick_random(
+                    jingles.exclude(pk__in=planned_jingles)
+                )
+                if jingle is None:
+                    jingle = Song.music.pick_random(jingles)
+                if jingle is None:
+                    break
+                self.create(profile_id=dj_profile_id, song=jingle)
+                planned_jingles.append(jingle.pk)
+                added += 1
+
+        return added
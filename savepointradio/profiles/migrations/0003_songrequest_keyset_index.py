@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_create_dj_profile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='songrequest',
+            index=models.Index(fields=['created_date', 'id'], name='profiles_so_created_95609a_idx'),
+        ),
+    ]
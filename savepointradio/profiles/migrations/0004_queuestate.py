@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:51
+
+from django.db import migrations, models
+
+
+def create_queue_state(apps, schema_editor):
+    QueueState = apps.get_model('profiles', 'QueueState')
+    SongRequest = apps.get_model('profiles', 'SongRequest')
+    db_alias = schema_editor.connection.alias
+
+    # Pick up the jingle spacing from where the request history left off
+    queued = SongRequest.objects.using(db_alias).filter(
+        queued_at__isnull=False
+    )
+    last_jingle = queued.filter(song__song_type='J').order_by(
+        '-queued_at'
+    ).first()
+    if last_jingle is not None:
+        queued = queued.filter(queued_at__gt=last_jingle.queued_at)
+    QueueState.objects.using(db_alias).create(
+        pk=1,
+        songs_since_jingle=queued.filter(song__song_type='S').count()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0003_songrequest_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('songs_since_jingle', models.PositiveIntegerField(default=0, verbose_name='songs queued since the last jingle')),
+            ],
+        ),
+        migrations.RunPython(create_queue_state, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.core.validators import (MaxLengthValidator, MinValueValidator,
                                     MaxValueValidator)
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
 from core.behaviors import Disableable, Timestampable
@@ -80,6 +80,8 @@ class RadioProfile(Disableable, Timestampable, models.Model):
             raise MakeRequestError(message.format(play_again))
 
         SongRequest.objects.create(profile=self, song=song)
+        # The listener's request takes the place of the DJ's plan for it
+        SongRequest.music.planned().filter(song=song).delete()
 
     def __str__(self):
         return "{}'s profile".format(self.user.get_username())
@@ -99,6 +101,12 @@ class Rating(Timestampable, models.Model):
                                              self.profile.user.get_username(),
                                              self.value)
 
+    def save(self, *args, **kwargs):
+        # The signals keeping the song's rating sum current lock the old
+        # value before the save, so hold that lock until the new one is in
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 
 class SongRequest(Timestampable, models.Model):
     profile = models.ForeignKey(RadioProfile,
@@ -124,9 +132,28 @@ class SongRequest(Timestampable, models.Model):
 
     class Meta:
         ordering = ['-created_date', ]
+        indexes = [
+            models.Index(fields=['created_date', 'id']),
+        ]
 
     def __str__(self):
         req_user = self.profile.user.get_username()
         return "{} - Requested by {} at {}".format(self.song.title,
                                                    req_user,
                                                    self.created_date)
+
+
+class QueueState(models.Model):
+    '''
+    A single-row model holding the DJ's scheduling state. Locking this row
+    serializes concurrent calls for the next song.
+    '''
+    songs_since_jingle = models.PositiveIntegerField(
+        _('songs queued since the last jingle'),
+        default=0
+    )
+
+    def __str__(self):
+        return '{} songs since the last jingle'.format(
+            self.songs_since_jingle
+        )
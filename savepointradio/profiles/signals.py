@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.db.models import F
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
-from .models import RadioProfile, SongRequest
+from radio.models import PlaylistAggregate, Song
+from radio.signals import songs_bulk_changed
+from .models import RadioProfile, Rating, SongRequest
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -24,12 +26,72 @@ def update_song_plays(sender, instance, created, update_fields, **kwargs):
     """
     if not created and update_fields:
         song = instance.song
+        if 'queued_at' in update_fields:
+            Song.music.mark_queued(song, instance.queued_at)
         if 'played_at' in update_fields:
             song.last_played = instance.played_at
             song.num_played = F('num_played') + 1
             song.save()
-        if 'queued_at' in update_fields:
-            if song.is_song:
-                queued = instance.queued_at
-                song.next_play = song.get_date_when_requestable(queued)
-                song.save()
+            PlaylistAggregate.objects.raise_least_played()
+
+
+@receiver(post_save, sender=Song)
+def drop_unavailable_plans(sender, instance, created, **kwargs):
+    """
+    If a song is disabled or unpublished, take it out of the DJ's planned
+    queue.
+    """
+    if not created and not instance.is_available:
+        SongRequest.music.prune_planned([instance.pk])
+
+
+@receiver(songs_bulk_changed, sender=Song)
+def drop_unavailable_plans_in_bulk(sender, song_ids, fields, **kwargs):
+    """
+    If a set of songs is disabled or unpublished at once, take them out of
+    the DJ's planned queue.
+    """
+    if 'disabled' in fields or 'published_date' in fields:
+        SongRequest.music.prune_planned(song_ids)
+
+
+@receiver(pre_save, sender=Rating)
+def remember_rating_value(sender, instance, **kwargs):
+    """
+    Before a rating is changed, remember its old value so the song's stored
+    rating sum can be adjusted by the difference. The row stays locked until
+    the save is committed (see Rating.save()), so concurrent changes to the
+    same rating are applied one after the other.
+    """
+    instance._value_before = None
+    if instance.pk is not None:
+        instance._value_before = Rating.objects.select_for_update().filter(
+            pk=instance.pk
+        ).values_list('value', flat=True).first()
+
+
+@receiver(post_save, sender=Rating)
+def add_song_rating(sender, instance, created, **kwargs):
+    """
+    Keep the rating count and sum stored on the song up to date when a
+    rating is created or changed.
+    """
+    before = getattr(instance, '_value_before', None)
+    if created or before is None:
+        Song.music.adjust_rating_stats(instance.song_id, 1, instance.value)
+    elif instance.value != before:
+        Song.music.adjust_rating_stats(instance.song_id,
+                                       total=instance.value - before)
+    else:
+        return
+    # The song's ratings change how long it waits to be played again
+    Song.music.update_next_play(song_ids=[instance.song_id])
+
+
+@receiver(post_delete, sender=Rating)
+def remove_song_rating(sender, instance, **kwargs):
+    """
+    Take a deleted rating out of the song's stored rating count and sum.
+    """
+    Song.music.adjust_rating_stats(instance.song_id, -1, -instance.value)
+    Song.music.update_next_play(song_ids=[instance.song_id])
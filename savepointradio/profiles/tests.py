@@ -1,3 +1,126 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
+
+from core.cache import setting_cache
+from core.models import RadioUser
+from core.utils import set_setting
+from radio.models import Song, Store
+from .models import QueueState, RadioProfile, Rating, SongRequest
+
+
+class QueueNextTests(TestCase):
+    '''
+    Queueing the DJ's next song.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i),
+                 sorted_title='song {}'.format(i),
+                 published_date=published)
+            for i in range(3)
+        ])
+
+    def test_missing_queue_state(self):
+        QueueState.objects.all().delete()
+        self.assertIsNotNone(SongRequest.music.queue_next())
+        self.assertEqual(QueueState.objects.get(pk=1).songs_since_jingle, 1)
+
+    def test_recreated_dj_profile(self):
+        SongRequest.music.queue_next()
+        RadioUser.objects.filter(is_dj=True).delete()
+        dj = RadioUser.objects.create(email='newdj@radiostation.net',
+                                      name='New DJ',
+                                      is_dj=True)
+
+        next_play = SongRequest.music.queue_next()
+        self.assertEqual(next_play.profile_id,
+                         RadioProfile.objects.get(user=dj).pk)
+
+
+class PlannedRequestTests(TestCase):
+    '''
+    Songs the DJ planned ahead give way to listener requests.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i),
+                 sorted_title='song {}'.format(i),
+                 published_date=published)
+            for i in range(6)
+        ])
+        cls.listener = RadioUser.objects.create(email='listener@example.com',
+                                                name='Listener')
+
+    def test_plan_ahead_picks_different_songs(self):
+        self.assertEqual(SongRequest.music.plan_ahead(5), 5)
+        planned = SongRequest.music.planned().values_list('song_id',
+                                                          flat=True)
+        self.assertEqual(len(set(planned)), 5)
+
+    def test_planned_song_can_be_requested(self):
+        SongRequest.music.plan_ahead(5)
+        song = SongRequest.music.planned().first().song
+        self.assertTrue(song.is_requestable)
+
+        profile = RadioProfile.objects.get(user=self.listener)
+        profile.make_request(song.pk)
+        planned = SongRequest.music.planned()
+        self.assertFalse(planned.filter(song=song).exists())
+        self.assertEqual(SongRequest.music.waiting().get().song, song)
+
+        response = self.client.get('/api/history/')
+        self.assertEqual(response.data['count'], 1)
+
+
+class RatingTests(TestCase):
+    '''
+    Rating a song changes how long it waits to be played again.
+    '''
+    def test_rating_updates_next_play(self):
+        set_setting('min_ratings_for_variance', 1)
+        setting_cache.clear()
+        played = timezone.now() - timedelta(hours=1)
+        store = Store.objects.create(iri='file:///music/song.ogg', length=100)
+        song = Song.objects.create(title='Song',
+                                   active_store=store,
+                                   last_played=played,
+                                   published_date=played)
+        Song.music.update_next_play()
+        song.refresh_from_db()
+        before = song.next_play
+
+        user = RadioUser.objects.create(email='listener@example.com',
+                                        name='Listener')
+        rating = Rating.objects.create(profile=user.radioprofile,
+                                       song=song,
+                                       value=5)
+        song.refresh_from_db()
+        self.assertLess(song.next_play, before)
+        self.assertEqual(song.next_play, song.get_date_when_requestable())
+
+        rating.delete()
+        song.refresh_from_db()
+        self.assertEqual(song.next_play, before)
+
+    def test_rating_sum_follows_changes(self):
+        song = Song.objects.create(title='Song')
+        user = RadioUser.objects.create(email='listener@example.com',
+                                        name='Listener')
+        Rating.objects.create(profile=user.radioprofile, song=song, value=3)
+
+        # Two copies of the same rating, changed one after the other
+        first = Rating.objects.get()
+        second = Rating.objects.get()
+        first.value = 5
+        first.save()
+        second.value = 4
+        second.save()
 
-# Create your tests here.
+        song.refresh_from_db()
+        self.assertEqual((song.rating_count, song.rating_sum), (1, 4))
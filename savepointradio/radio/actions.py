@@ -1,10 +1,110 @@
+import json
+
 from django import forms
+from django.conf import settings
 from django.contrib import admin, messages
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from core.utils import create_success_message, quantify
+from .models import ActionJob, Song
+from .signals import songs_bulk_changed
+
+
+# Rows inserted into a many-to-many table per query
+BATCH_SIZE = 500
+
+
+def changed_in_bulk(model, ids, fields):
+    '''
+    Let the receivers of the batch signal catch up after the selected items
+    were changed with single queries (which skip their save signals).
+    '''
+    if model == Song and ids:
+        songs_bulk_changed.send(sender=Song, song_ids=ids, fields=fields)
+
+
+def change_ids(model, ids, field, children, m2m=False, removal=False):
+    '''
+    Point the items with the given ids at a child (or None), or add/remove
+    the children of a many-to-many field, with a constant number of
+    queries.
+    '''
+    through_field = getattr(model, field)
+    if m2m:
+        through = through_field.through
+        parent_column = through_field.field.m2m_field_name()
+        child_column = through_field.field.m2m_reverse_field_name()
+        if removal:
+            through.objects.filter(**{
+                parent_column + '__in': ids,
+                child_column + '__in': children
+            }).delete()
+        else:
+            through.objects.bulk_create(
+                [through(**{parent_column + '_id': parent_id,
+                            child_column + '_id': child})
+                 for child in children
+                 for parent_id in ids],
+                batch_size=BATCH_SIZE,
+                ignore_conflicts=True
+            )
+    else:
+        attname = through_field.field.attname
+        for child in children:
+            model.objects.filter(pk__in=ids).update(**{
+                attname: child,
+                'modified_date': timezone.now()
+            })
+    changed_in_bulk(model, ids, [field])
+
+
+def publish_ids(model, ids, published_date):
+    '''
+    Publish the items with the given ids at the same date.
+    '''
+    model.objects.filter(pk__in=ids).update(published_date=published_date)
+    changed_in_bulk(model, ids, ['published_date'])
+
+
+def run_action(model, ids, action, arguments):
+    '''
+    Apply an action (as recorded on an ActionJob) to the given items.
+    '''
+    if action == ActionJob.PUBLISH:
+        publish_ids(model, ids, parse_datetime(arguments['published_date']))
+    elif action == ActionJob.CHANGE:
+        change_ids(model, ids, **arguments)
+    else:
+        raise ValueError('Unknown action "{}"'.format(action))
+
+
+def queue_large_action(request, model, ids, action, arguments):
+    '''
+    Apply an action right away on a small selection, or queue it as a job
+    for the "runactions" command to work through in chunks. Returns
+    whether it was queued.
+    '''
+    if len(ids) <= settings.RADIO_ACTION_CHUNK_SIZE:
+        with transaction.atomic():
+            run_action(model, ids, action, arguments)
+        return False
+
+    job = ActionJob.objects.create(
+        action=action,
+        model_label=model._meta.label_lower,
+        object_ids=json.dumps(sorted(ids)),
+        arguments=json.dumps(arguments),
+        total=len(ids),
+        requested_by=request.user
+    )
+    messages.info(request, '{} queued as job #{}, see its progress under '
+                           '"Action jobs".'.format(quantify(len(ids), model),
+                                                   str(job.pk)))
+    return True
 
 
 def change_items(request, queryset, parent_field, calling_function,
@@ -34,24 +134,28 @@ def change_items(request, queryset, parent_field, calling_function,
             # Remove the empty form data from the list
             data = list(filter(None, item_formset.cleaned_data))
 
-            for child in data:
-                for parent in queryset:
-                    if m2m:
-                        through_instance = getattr(parent, parent_field)
-                        if request.POST['removal'] == 'True':
-                            through_instance.remove(child[m2m])
-                        else:
-                            through_instance.add(child[m2m])
-                    else:
-                        setattr(parent, parent_field, child['item'])
-                        parent.save()
+            parent_ids = list(queryset.values_list('pk', flat=True))
+            is_removal = request.POST['removal'] == 'True'
+            if m2m:
+                children = [child[m2m].pk for child in data]
+            else:
+                children = [child['item'].pk for child in data]
+            arguments = {
+                'field': parent_field,
+                'children': children,
+                'm2m': bool(m2m),
+                'removal': is_removal
+            }
+            if queue_large_action(request, queryset.model, parent_ids,
+                                  ActionJob.CHANGE, arguments):
+                return HttpResponseRedirect(request.get_full_path())
 
             # Return with informative success message and counts
             message = create_success_message(queryset.model,
-                                             queryset.count(),
+                                             len(parent_ids),
                                              child_model,
                                              len(data),
-                                             request.POST['removal'] == 'True')
+                                             is_removal)
             messages.success(request, message)
             return HttpResponseRedirect(request.get_full_path())
         else:
@@ -72,17 +176,23 @@ def change_items(request, queryset, parent_field, calling_function,
 
 
 def publish_items(request, queryset):
-    rows_updated = queryset.update(published_date=timezone.now())
-    message = quantify(rows_updated, queryset.model)
+    parent_ids = list(queryset.values_list('pk', flat=True))
+    arguments = {'published_date': timezone.now().isoformat()}
+    if queue_large_action(request, queryset.model, parent_ids,
+                          ActionJob.PUBLISH, arguments):
+        return
+    message = quantify(len(parent_ids), queryset.model)
     messages.success(request, '{} successfully published.'.format(message))
 
 
 def remove_items(request, queryset, parent_field, calling_function):
     through_field = getattr(queryset.model, parent_field)
     child_model = through_field.field.related_model
-    for parent in queryset:
-        setattr(parent, parent_field, None)
-        parent.save()
-    message = create_success_message(queryset.model, queryset.count(),
+    parent_ids = list(queryset.values_list('pk', flat=True))
+    arguments = {'field': parent_field, 'children': [None]}
+    if queue_large_action(request, queryset.model, parent_ids,
+                          ActionJob.CHANGE, arguments):
+        return
+    message = create_success_message(queryset.model, len(parent_ids),
                                      child_model, 1, True)
     messages.success(request, message)
@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.db import models
 from django.forms import TextInput
+from django.utils import timezone
 
+from core.utils import quantify
 from .actions import change_items, publish_items, remove_items
-from .models import Album, Artist, Game, Song, Store
+from .models import ActionJob, Album, Artist, Game, Song, Store
 
 
 class ArtistInline(admin.TabularInline):
@@ -127,7 +129,8 @@ class StoreAdmin(admin.ModelAdmin):
                        'file_size',
                        'length',
                        'track_gain',
-                       'track_peak')
+                       'track_peak',
+                       'filehash')
         }),
         ('Stats', {
             'classes': ('collapse',),
@@ -150,6 +153,7 @@ class SongAdmin(admin.ModelAdmin):
                     '_is_enabled',
                     '_is_published',
                     '_is_requestable')
+    list_select_related = ('game', 'album', 'active_store')
     search_fields = ['title']
     actions = ['publish_songs',
                'add_game', 'remove_game',
@@ -162,7 +166,9 @@ class SongAdmin(admin.ModelAdmin):
                        'num_played',
                        'created_date',
                        'modified_date',
-                       'next_play')
+                       'next_play',
+                       'rating_count',
+                       'rating_sum')
     fieldsets = (
         ('Song Disabling', {
             'classes': ('collapse',),
@@ -180,7 +186,9 @@ class SongAdmin(admin.ModelAdmin):
                        'modified_date',
                        'last_played',
                        'num_played',
-                       'next_play')
+                       'next_play',
+                       'rating_count',
+                       'rating_sum')
         }),
         ('Album', {
             'fields': ('album',)
@@ -191,6 +199,16 @@ class SongAdmin(admin.ModelAdmin):
     )
     inlines = [ArtistInline, StoreInline]
 
+    def get_queryset(self, request):
+        # Prefetch the artists and annotate what "_is_requestable" needs, so
+        # the changelist doesn't query again for every row
+        queryset = Song.music.get_queryset()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        queryset = queryset.prefetch_related('artists')
+        return queryset.with_request_state()
+
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'active_store':
             kwargs['queryset'] = Store.objects.filter(
@@ -230,3 +248,59 @@ class SongAdmin(admin.ModelAdmin):
     def publish_songs(self, request, queryset):
         publish_items(request, queryset)
     publish_songs.short_description = "Publish selected songs"
+
+
+@admin.register(ActionJob)
+class ActionJobAdmin(admin.ModelAdmin):
+    # Detail List display
+    list_display = ('id',
+                    'action',
+                    'model_label',
+                    'status',
+                    'progress',
+                    'requested_by',
+                    'created_date',
+                    'finished_date')
+    list_filter = ('status', 'action')
+    actions = ['requeue_jobs']
+
+    # Edit Form display
+    readonly_fields = ('action',
+                       'model_label',
+                       'status',
+                       'progress',
+                       'error',
+                       'requested_by',
+                       'created_date',
+                       'started_date',
+                       'finished_date')
+    fieldsets = (
+        ('Main', {
+            'fields': ('action', 'model_label', 'status', 'progress', 'error')
+        }),
+        ('Stats', {
+            'fields': ('requested_by',
+                       'created_date',
+                       'started_date',
+                       'finished_date')
+        })
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def requeue_jobs(self, request, queryset):
+        # Jobs carry on from the last chunk they finished. Only failed or
+        # stuck jobs are requeued, so a job is never run twice at once.
+        rows_updated = queryset.filter(
+            pk__in=ActionJob.objects.requeueable().values('pk')
+        ).update(
+            status=ActionJob.QUEUED,
+            error='',
+            finished_date=None,
+            modified_date=timezone.now()
+        )
+        self.message_user(request,
+                          '{} requeued.'.format(quantify(rows_updated,
+                                                         ActionJob)))
+    requeue_jobs.short_description = "Requeue selected jobs"
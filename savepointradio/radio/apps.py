@@ -5,4 +5,13 @@ class RadioConfig(AppConfig):
     name = 'radio'
 
     def ready(self):
-        from .signals import cascade_disable, update_sorted_fields
+        from .signals import (cascade_disable,
+                              reconcile_bulk_changes,
+                              remember_playlist_contribution,
+                              remember_store_length,
+                              remove_playlist_contribution,
+                              remove_store_length,
+                              update_next_play,
+                              update_playlist_totals,
+                              update_sorted_fields,
+                              update_store_length)
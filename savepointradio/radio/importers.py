@@ -0,0 +1,160 @@
+'''
+Helpers shared by the management commands that import exported playlists
+(see contrib/export_playlist).
+'''
+
+import decimal
+from itertools import islice
+import json
+import re
+
+from django.core.management.base import CommandError
+
+from core.utils import path_to_iri
+from .models import Store
+
+# Number of rows written per INSERT
+BATCH_SIZE = 500
+
+# Kinds of entities in a playlist, in the order they have to be imported
+PLAYLIST_KINDS = ('album', 'artist', 'game', 'song')
+
+PLAYLIST_FORMAT = 'spradio-playlist'
+
+PLAYLIST_VERSION = 1
+
+# Decimal precision used for the numbers read from a playlist
+PLAYLIST_PRECISION = 8
+
+
+def artist_key(artist):
+    '''
+    Natural key used to match a song's artists to the imported artists.
+    '''
+    return (artist['alias'] or '',
+            artist['first_name'] or '',
+            artist['last_name'] or '')
+
+
+def _parse_json(text):
+    '''
+    Parse a JSON document from a playlist, reading its numbers as Decimals
+    with the playlist precision. The precision is only set while parsing,
+    so it doesn't leak into the rest of the process (or into the caller of
+    read_playlist() between the entities it yields).
+    '''
+    with decimal.localcontext() as context:
+        context.prec = PLAYLIST_PRECISION
+        return json.loads(text, parse_float=decimal.Decimal)
+
+
+def read_playlist(pfile):
+    '''
+    Yield each entity of an exported playlist as a (kind, entity) pair. JSON
+    Lines playlists are read one line at a time, so only the entity being
+    imported is held in memory.
+    '''
+    try:
+        first_line = _parse_json(pfile.readline())
+    except ValueError:
+        first_line = None
+
+    if isinstance(first_line, dict) and 'header' in first_line:
+        header = first_line['header']
+        if (header.get('format') != PLAYLIST_FORMAT or
+                header.get('version') != PLAYLIST_VERSION):
+            raise CommandError('Unsupported playlist format: {}'.format(
+                header
+            ))
+        for line_number, line in enumerate(pfile, 2):
+            if not line.strip():
+                continue
+            entity = _parse_json(line)
+            if not isinstance(entity, dict) or len(entity) != 1:
+                raise CommandError(
+                    'Line {} is not a playlist entity'.format(line_number)
+                )
+            yield next(iter(entity.items()))
+        return
+
+    pfile.seek(0)
+    playlist = _parse_json(pfile.read())
+    for kind in PLAYLIST_KINDS:
+        for entity in playlist[kind + 's']:
+            yield kind, entity
+
+
+def split_playlist(entities):
+    '''
+    Read the albums, artists and games from the start of a playlist's
+    (kind, entity) pairs, returning them grouped by kind along with an
+    iterator over the songs that follow.
+    '''
+    entities = iter(entities)
+    lookups = {kind: [] for kind in PLAYLIST_KINDS if kind != 'song'}
+    for kind, entity in entities:
+        if kind == 'song':
+            return lookups, _iter_songs(entity, entities)
+        if kind not in lookups:
+            raise CommandError('Unknown playlist entity: {}'.format(kind))
+        lookups[kind].append(entity)
+    return lookups, iter(())
+
+
+def _iter_songs(first_song, entities):
+    yield first_song
+    for kind, entity in entities:
+        if kind != 'song':
+            if kind in PLAYLIST_KINDS:
+                raise CommandError(
+                    'Every {} has to come before the songs'.format(kind)
+                )
+            raise CommandError('Unknown playlist entity: {}'.format(kind))
+        yield entity
+
+
+def batches(iterable, size=BATCH_SIZE):
+    '''
+    Split an iterable into lists of up to 'size' items.
+    '''
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def build_store(store):
+    '''
+    Turn a song's exported store into an (unsaved) Store object.
+    '''
+    localfile = re.match(
+        r'^(?:(?:[A-Za-z]:|\\)\\|\/)',
+        store['path']
+    )
+
+    if localfile:
+        iri = path_to_iri(store['path'])
+    else:
+        iri = store['path']
+
+    if store['track_gain']:
+        gain_str = re.sub(r'[dB\+ ]', '', store['track_gain'])
+        gain = decimal.Decimal(gain_str)
+    else:
+        gain = None
+
+    if store['track_peak']:
+        peak = decimal.Decimal(store['track_peak'])
+    else:
+        peak = None
+
+    return Store(
+        iri=iri,
+        mime_type=store['mime'],
+        file_size=store['filesize'],
+        length=store['length'],
+        track_gain=gain,
+        track_peak=peak,
+        filehash=store.get('filehash') or ''
+    )
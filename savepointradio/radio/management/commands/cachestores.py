@@ -0,0 +1,201 @@
+'''
+Django management command to download the remote ("s3://") songs the DJ is
+about to play into RADIO_CACHE_DIR, so they are played from the local disk.
+Run it once (eg. from cron), or leave it running with "--interval".
+
+Needs boto3, which is only required when songs are stored on S3.
+'''
+
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.utils import timezone
+
+from radio.models import CachedStore
+
+
+# Bytes read from a file at a time while hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    '''
+    Run a file through a hashing algorithm (SHA3_256) and return the
+    resulting hash.
+    '''
+    filehash = hashlib.sha3_256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            filehash.update(chunk)
+    return filehash.hexdigest()
+
+
+def is_warm(store):
+    '''
+    Whether a store's local copy exists and matches its known size and hash.
+    '''
+    cached = getattr(store, 'cached', None)
+    return cached is not None and cached.is_warm
+
+
+class Command(BaseCommand):
+    '''Main "cachestores" command class'''
+    help = ('Downloads the remote songs of the upcoming requests to the '
+            'local cache, evicting the least recently used ones')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead',
+                            type=int,
+                            help='Number of waiting requests to cache '
+                                 '(defaults to the RADIO_CACHE_AHEAD '
+                                 'setting)')
+        parser.add_argument('--verify',
+                            action='store_true',
+                            help='Hash every cached file first, dropping the '
+                                 'ones that changed on disk')
+        parser.add_argument('--interval',
+                            type=int,
+                            help='Keep running, caching the upcoming songs '
+                                 'every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        if not settings.RADIO_CACHE_DIR:
+            raise CommandError('RADIO_CACHE_DIR is not set')
+        ahead = options['ahead']
+        if ahead is None:
+            ahead = settings.RADIO_CACHE_AHEAD
+        if ahead < 0:
+            raise CommandError('Ahead must not be negative')
+
+        try:
+            import boto3
+            from botocore.exceptions import BotoCoreError, ClientError
+        except ImportError:
+            raise CommandError('boto3 is needed to download "s3://" stores')
+        self.download_errors = (BotoCoreError, ClientError, OSError)
+        session = boto3.session.Session()
+        self.client = session.client(
+            's3',
+            region_name=settings.S3_REGION,
+            endpoint_url=settings.S3_ENDPOINT,
+            aws_access_key_id=settings.S3_ACCESS_KEY,
+            aws_secret_access_key=settings.S3_SECRET_KEY
+        )
+        os.makedirs(settings.RADIO_CACHE_DIR, exist_ok=True)
+
+        if options['verify']:
+            self.stdout.write('Dropped {} changed files'.format(
+                str(self.verify())
+            ))
+
+        while True:
+            upcoming = CachedStore.objects.upcoming_stores(ahead)
+            downloaded = 0
+            for store in upcoming:
+                if not is_warm(store) and self.download(store):
+                    downloaded += 1
+            evicted = self.evict([store.pk for store in upcoming])
+            self.stdout.write(
+                'Downloaded {} songs, evicted {} ({} upcoming)'.format(
+                    str(downloaded),
+                    str(evicted),
+                    str(len(upcoming))
+                )
+            )
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def download(self, store):
+        '''
+        Download a store into the cache, under a name made from its content
+        hash, and record where it is. Returns whether it worked.
+        '''
+        bucket, key = store.iri[5:].split('/', 1)
+        handle, partial = tempfile.mkstemp(dir=settings.RADIO_CACHE_DIR,
+                                           suffix='.part')
+        os.close(handle)
+        try:
+            try:
+                self.client.download_file(bucket, key, partial)
+            except self.download_errors as error:
+                self.stderr.write('Could not download "{}": {}'.format(
+                    store.iri,
+                    str(error)
+                ))
+                return False
+
+            filehash = hash_file(partial)
+            if store.filehash and store.filehash != filehash:
+                self.stderr.write('Hash mismatch for "{}", not cached'.format(
+                    store.iri
+                ))
+                return False
+
+            path = os.path.join(settings.RADIO_CACHE_DIR,
+                                filehash + os.path.splitext(key)[1])
+            file_size = os.path.getsize(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        CachedStore.objects.update_or_create(
+            store=store,
+            defaults={
+                'path': path,
+                'file_size': file_size,
+                'filehash': filehash,
+                'last_used': timezone.now()
+            }
+        )
+        return True
+
+    def remove(self, cached):
+        '''
+        Forget a local copy, deleting its file unless another store has the
+        same content.
+        '''
+        cached.delete()
+        if not CachedStore.objects.filter(path=cached.path).exists():
+            try:
+                os.remove(cached.path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep):
+        '''
+        Remove the least recently used local copies (other than the ones to
+        keep) until the cache fits in RADIO_CACHE_SIZE again.
+        '''
+        budget = settings.RADIO_CACHE_SIZE * 1024 * 1024
+        total = CachedStore.objects.aggregate(
+            total=Sum('file_size')
+        )['total'] or 0
+        evicted = 0
+        for cached in CachedStore.objects.least_recently_used(keep):
+            if total <= budget:
+                break
+            self.remove(cached)
+            total -= cached.file_size
+            evicted += 1
+        return evicted
+
+    def verify(self):
+        '''
+        Drop the local copies that are missing or whose content no longer
+        matches the hash they were stored under.
+        '''
+        dropped = 0
+        for cached in CachedStore.objects.all():
+            if (not os.path.isfile(cached.path) or
+                    hash_file(cached.path) != cached.filehash):
+                self.remove(cached)
+                dropped += 1
+        return dropped
@@ -1,19 +1,42 @@
 '''
 Django management command to import old playlist data. This should only be used
 for seeding a newly created database.
+
+Both playlist layouts written by contrib/export_playlist are understood: a
+single JSON document, or JSON Lines (a header line followed by one album,
+artist, game or song per line), which is read and imported as it goes.
 '''
 
-import decimal
-import json
 import os
-import re
 
 from django.core.management.base import BaseCommand, CommandError
-
-from core.utils import path_to_iri
-from radio.models import Album, Artist, Game, Store, Song
-
-decimal.getcontext().prec = 8
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core.utils import naturalize
+from radio.importers import (BATCH_SIZE, artist_key, batches, build_store,
+                             read_playlist, split_playlist)
+from radio.models import (Album, Artist, Game, PlaylistAggregate, Store,
+                          Song)
+
+
+def bulk_create(model, objs):
+    '''
+    Insert the objects in batches and make sure each one ends up with its
+    primary key, even on database backends that don't return them from a
+    bulk insert. This relies on being run inside a transaction while seeding
+    the database, so the new rows are the only ones being added.
+    '''
+    last_pk = model.objects.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+    model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+    if objs and objs[0].pk is None:
+        pks = model.objects.filter(pk__gt=last_pk).order_by(
+            'pk'
+        ).values_list('pk', flat=True)
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+    return objs
 
 
 class Command(BaseCommand):
@@ -29,8 +52,36 @@ class Command(BaseCommand):
             raise CommandError('File does not exist')
 
         with open(playlist_file, 'r', encoding='utf8') as pfile:
-            playlist = json.load(pfile, parse_float=decimal.Decimal)
+            with transaction.atomic():
+                totals = self.import_playlist(read_playlist(pfile))
+
+        self.stdout.write(
+            'Imported {} requestables ({} songs, {} jingles)'.format(
+                str(totals['songs'] + totals['jingles']),
+                str(totals['songs']),
+                str(totals['jingles'])
+            )
+        )
+
+        pub = input('Do you want to publish all imported objects as well? '
+                    '[Y/N] ')
 
+        if pub in ('Y', 'y'):
+            now = timezone.now()
+            with transaction.atomic():
+                for model in (Album, Artist, Game, Song):
+                    model.objects.update(published_date=now)
+                PlaylistAggregate.objects.reconcile()
+            self.stdout.write('Published imported objects successfully')
+        else:
+            self.stdout.write('Skipped publishing songs')
+
+    def import_playlist(self, entities):
+        '''
+        Bulk insert the playlist's (kind, entity) pairs as they come, returning
+        how much of each kind of object was imported. Albums, artists and games
+        are imported once the first song shows up, and songs in batches.
+        '''
         totals = {
             'albums': 0,
             'artists': 0,
@@ -39,115 +90,112 @@ class Command(BaseCommand):
             'jingles': 0
         }
 
+        pending, songs = split_playlist(entities)
+        lookups = self.import_lookups(pending, totals)
+        for batch in batches(songs):
+            self.import_songs(batch, lookups, totals)
+
+        PlaylistAggregate.objects.reconcile()
+
+        return totals
+
+    def import_lookups(self, pending, totals):
+        '''
+        Bulk insert the pending albums, artists and games, returning
+        dictionaries to find their new ids by title (or artist name).
+        '''
         # Fetching albums first
-        for album in playlist['albums']:
-            Album.objects.create(title=album['title'],
-                                 disabled=album['disabled'])
-            totals['albums'] += 1
+        albums = bulk_create(Album, [
+            Album(title=album['title'],
+                  sorted_title=naturalize(album['title']),
+                  disabled=album['disabled'])
+            for album in pending.pop('album')
+        ])
+        album_ids = {album.title: album.pk for album in albums}
+        totals['albums'] = len(albums)
 
         self.stdout.write('Imported {} albums'.format(str(totals['albums'])))
 
         # Next up, artists
-        for artist in playlist['artists']:
-            Artist.objects.create(alias=artist['alias'] or '',
-                                  first_name=artist['first_name'] or '',
-                                  last_name=artist['last_name'] or '',
-                                  disabled=artist['disabled'])
-            totals['artists'] += 1
+        artists = []
+        for artist in pending.pop('artist'):
+            alias, first_name, last_name = artist_key(artist)
+            new_artist = Artist(alias=alias,
+                                first_name=first_name,
+                                last_name=last_name,
+                                disabled=artist['disabled'])
+            new_artist.sorted_full_name = naturalize(new_artist.full_name)
+            artists.append(new_artist)
+        bulk_create(Artist, artists)
+        artist_ids = {
+            (artist.alias, artist.first_name, artist.last_name): artist.pk
+            for artist in artists
+        }
+        totals['artists'] = len(artists)
 
         self.stdout.write('Imported {} artists'.format(str(totals['artists'])))
 
         # On to games
-        for game in playlist['games']:
-            Game.objects.create(title=game['title'],
-                                disabled=game['disabled'])
-            totals['games'] += 1
+        games = bulk_create(Game, [
+            Game(title=game['title'],
+                 sorted_title=naturalize(game['title']),
+                 disabled=game['disabled'])
+            for game in pending.pop('game')
+        ])
+        game_ids = {game.title: game.pk for game in games}
+        totals['games'] = len(games)
 
         self.stdout.write('Imported {} games'.format(str(totals['games'])))
 
-        # Followed by the songs
-        for song in playlist['songs']:
-            try:
-                album = Album.objects.get(title__exact=song['album'])
-            except Album.DoesNotExist:
-                album = None
-
-            try:
-                game = Game.objects.get(title__exact=song['game'])
-            except Game.DoesNotExist:
-                game = None
-
-            new_song = Song.objects.create(album=album,
-                                           game=game,
-                                           disabled=song['disabled'],
-                                           song_type=song['type'],
-                                           title=song['title'])
-
-            for artist in song['artists']:
-                new_artist = Artist.objects.get(
-                    alias__exact=artist['alias'] or '',
-                    first_name__exact=artist['first_name'] or '',
-                    last_name__exact=artist['last_name'] or ''
-                )
-                new_song.artists.add(new_artist)
-
-            localfile = re.match(
-                r'^(?:(?:[A-Za-z]:|\\)\\|\/)',
-                song['store']['path']
-            )
-
-            if localfile:
-                iri = path_to_iri(song['store']['path'])
-            else:
-                iri = song['store']['path']
-
-            if song['store']['track_gain']:
-                gain_str = re.sub(r'[dB\+ ]', '', song['store']['track_gain'])
-                gain = decimal.Decimal(gain_str)
-            else:
-                gain = None
-
-            if song['store']['track_peak']:
-                peak = decimal.Decimal(song['store']['track_peak'])
-            else:
-                peak = None
-
-            new_store = Store.objects.create(
-                iri=iri,
-                mime_type=song['store']['mime'],
-                file_size=song['store']['filesize'],
-                length=song['store']['length'],
-                track_gain=gain,
-                track_peak=peak
-            )
-            new_song.stores.add(new_store)
-            new_song.active_store = new_store
-            new_song.save()
+        return album_ids, artist_ids, game_ids
+
+    def import_songs(self, playlist_songs, lookups, totals):
+        '''
+        Bulk insert a batch of songs, along with their stores and the links
+        to their artists.
+        '''
+        album_ids, artist_ids, game_ids = lookups
+
+        # The songs' stores have to be created first
+        stores = bulk_create(Store, [
+            build_store(song['store']) for song in playlist_songs
+        ])
+
+        songs = []
+        for song, store in zip(playlist_songs, stores):
+            songs.append(Song(album_id=album_ids.get(song['album']),
+                              game_id=game_ids.get(song['game']),
+                              disabled=song['disabled'],
+                              song_type=song['type'],
+                              title=song['title'],
+                              sorted_title=naturalize(song['title']),
+                              active_store_id=store.pk))
             if song['type'] == 'S':
                 totals['songs'] += 1
             else:
                 totals['jingles'] += 1
+        bulk_create(Song, songs)
 
-        self.stdout.write(
-            'Imported {} requestables ({} songs, {} jingles)'.format(
-                str(totals['songs'] + totals['jingles']),
-                str(totals['songs']),
-                str(totals['jingles'])
-            )
-        )
-
-        pub = input('Do you want to publish all imported objects as well? '
-                    '[Y/N] ')
-
-        if pub in ('Y', 'y'):
-            for album in Album.objects.all():
-                album.publish()
-            for artist in Artist.objects.all():
-                artist.publish()
-            for game in Game.objects.all():
-                game.publish()
-            for song in Song.objects.all():
-                song.publish()
-            self.stdout.write('Published imported objects successfully')
-        else:
-            self.stdout.write('Skipped publishing songs')
+        song_artists = []
+        for song, new_song in zip(playlist_songs, songs):
+            for artist in song['artists']:
+                try:
+                    artist_id = artist_ids[artist_key(artist)]
+                except KeyError:
+                    raise CommandError(
+                        'Song "{}" has an unknown artist: {}'.format(
+                            song['title'],
+                            artist
+                        )
+                    )
+                song_artists.append(Song.artists.through(
+                    song_id=new_song.pk,
+                    artist_id=artist_id
+                ))
+        Song.artists.through.objects.bulk_create(song_artists,
+                                                 batch_size=BATCH_SIZE)
+
+        Song.stores.through.objects.bulk_create([
+            Song.stores.through(song_id=song.pk, store_id=song.active_store_id)
+            for song in songs
+        ], batch_size=BATCH_SIZE)
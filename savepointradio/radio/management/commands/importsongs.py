@@ -0,0 +1,285 @@
+'''
+Django management command to import new songs into an existing library from
+an exported playlist (see contrib/export_playlist), such as one holding only
+the songs added since the last import.
+'''
+
+from itertools import islice
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from core.utils import naturalize
+from radio.importers import (BATCH_SIZE, artist_key, batches, build_store,
+                             read_playlist, split_playlist)
+from radio.models import (Album, Artist, Game, PlaylistAggregate, Store,
+                          Song)
+
+
+def get_artist_ids():
+    '''
+    Dictionary to find the id of every artist in the library by their
+    (alias, first name, last name).
+    '''
+    artists = Artist.objects.values_list('pk', 'alias', 'first_name',
+                                         'last_name')
+    return {tuple(artist[1:]): artist[0] for artist in artists}
+
+
+class Command(BaseCommand):
+    '''Main "importsongs" command class'''
+    help = ('Imports new songs from an exported playlist into the existing '
+            'library, skipping any that were already imported')
+
+    def add_arguments(self, parser):
+        parser.add_argument('playlist_file', nargs=1)
+        parser.add_argument(
+            '--publish',
+            action='store_true',
+            help='Publish the newly imported albums, artists, games and songs.'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help=('File to record progress in, so an interrupted import '
+                  'resumes where it stopped (default: the playlist file '
+                  'name followed by ".checkpoint").')
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore any recorded progress and start from the beginning.'
+        )
+
+    def handle(self, *args, **options):
+        playlist_file = options['playlist_file'][0]
+        if not os.path.isfile(playlist_file):
+            raise CommandError('File does not exist')
+
+        checkpoint_file = (options['checkpoint'] or
+                           playlist_file + '.checkpoint')
+        playlist_stat = os.stat(playlist_file)
+        checkpoint = {
+            'playlist': os.path.abspath(playlist_file),
+            'size': playlist_stat.st_size,
+            'mtime': playlist_stat.st_mtime,
+            'processed': 0
+        }
+        if not options['restart']:
+            checkpoint['processed'] = self.read_checkpoint(checkpoint_file,
+                                                           checkpoint)
+        if checkpoint['processed']:
+            self.stdout.write('Resuming after {} songs'.format(
+                str(checkpoint['processed'])
+            ))
+
+        resumed = bool(checkpoint['processed'])
+        publish_date = timezone.now() if options['publish'] else None
+        totals = {
+            'albums': 0,
+            'artists': 0,
+            'games': 0,
+            'songs': 0,
+            'skipped': 0
+        }
+
+        with open(playlist_file, 'r', encoding='utf8') as pfile:
+            pending, songs = split_playlist(read_playlist(pfile))
+            with transaction.atomic():
+                lookups = self.upsert_lookups(pending, publish_date, totals)
+
+            songs = islice(songs, checkpoint['processed'], None)
+            for batch in batches(songs):
+                with transaction.atomic():
+                    self.import_songs(batch, lookups, publish_date, totals)
+                checkpoint['processed'] += len(batch)
+                self.write_checkpoint(checkpoint_file, checkpoint)
+
+        # Bulk inserts skip the signals keeping the playlist totals current,
+        # so rebuild them if this run (or the interrupted one it resumed)
+        # added anything
+        created = sum(totals[kind] for kind in ('albums', 'artists', 'games',
+                                                'songs'))
+        if created or resumed:
+            PlaylistAggregate.objects.reconcile()
+
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        self.stdout.write(
+            'Imported {} albums, {} artists, {} games and {} songs '
+            '({} already in the library)'.format(
+                str(totals['albums']),
+                str(totals['artists']),
+                str(totals['games']),
+                str(totals['songs']),
+                str(totals['skipped'])
+            )
+        )
+
+    def read_checkpoint(self, checkpoint_file, checkpoint):
+        '''
+        Number of songs already processed by an earlier run over the same
+        playlist file, or 0 if there is no usable checkpoint.
+        '''
+        try:
+            with open(checkpoint_file, 'r', encoding='utf8') as cfile:
+                saved = json.load(cfile)
+        except (OSError, ValueError):
+            return 0
+        for key in ('playlist', 'size', 'mtime'):
+            if saved.get(key) != checkpoint[key]:
+                self.stdout.write('Playlist changed since the last run, '
+                                  'starting from the beginning')
+                return 0
+        return saved.get('processed', 0)
+
+    def write_checkpoint(self, checkpoint_file, checkpoint):
+        '''
+        Atomically record how many songs have been processed so far.
+        '''
+        with open(checkpoint_file + '.tmp', 'w', encoding='utf8') as cfile:
+            json.dump(checkpoint, cfile)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+    def upsert_lookups(self, pending, publish_date, totals):
+        '''
+        Add the albums, artists and games the library doesn't have yet
+        (matching on title, or the artist's full name), returning
+        dictionaries to find all of their ids.
+        '''
+        album_ids = dict(Album.objects.values_list('title', 'pk'))
+        new_albums = {}
+        for album in pending['album']:
+            if album['title'] not in album_ids:
+                new_albums[album['title']] = Album(
+                    title=album['title'],
+                    sorted_title=naturalize(album['title']),
+                    disabled=album['disabled'],
+                    published_date=publish_date
+                )
+        Album.objects.bulk_create(new_albums.values(), batch_size=BATCH_SIZE)
+        album_ids.update(Album.objects.filter(
+            title__in=new_albums
+        ).values_list('title', 'pk'))
+        totals['albums'] = len(new_albums)
+
+        artist_ids = get_artist_ids()
+        new_artists = {}
+        for artist in pending['artist']:
+            key = artist_key(artist)
+            if key not in artist_ids and key not in new_artists:
+                new_artist = Artist(alias=key[0],
+                                    first_name=key[1],
+                                    last_name=key[2],
+                                    disabled=artist['disabled'],
+                                    published_date=publish_date)
+                new_artist.sorted_full_name = naturalize(new_artist.full_name)
+                new_artists[key] = new_artist
+        Artist.objects.bulk_create(new_artists.values(),
+                                   batch_size=BATCH_SIZE)
+        if new_artists:
+            artist_ids = get_artist_ids()
+        totals['artists'] = len(new_artists)
+
+        game_ids = dict(Game.objects.values_list('title', 'pk'))
+        new_games = {}
+        for game in pending['game']:
+            if game['title'] not in game_ids:
+                new_games[game['title']] = Game(
+                    title=game['title'],
+                    sorted_title=naturalize(game['title']),
+                    disabled=game['disabled'],
+                    published_date=publish_date
+                )
+        Game.objects.bulk_create(new_games.values(), batch_size=BATCH_SIZE)
+        game_ids.update(Game.objects.filter(
+            title__in=new_games
+        ).values_list('title', 'pk'))
+        totals['games'] = len(new_games)
+
+        return album_ids, artist_ids, game_ids
+
+    def import_songs(self, playlist_songs, lookups, publish_date, totals):
+        '''
+        Bulk insert a batch of songs along with their stores and the links to
+        their artists, skipping those whose file (by IRI or content hash) is
+        already in the library.
+        '''
+        album_ids, artist_ids, game_ids = lookups
+
+        stores = [build_store(song['store']) for song in playlist_songs]
+        iris = {store.iri for store in stores}
+        hashes = {store.filehash for store in stores if store.filehash}
+        existing_iris = set(Store.objects.filter(
+            iri__in=iris
+        ).values_list('iri', flat=True))
+        existing_hashes = set(Store.objects.filter(
+            filehash__in=hashes
+        ).values_list('filehash', flat=True))
+
+        new_songs = []
+        for song, store in zip(playlist_songs, stores):
+            if (store.iri in existing_iris or
+                    (store.filehash and store.filehash in existing_hashes)):
+                totals['skipped'] += 1
+                continue
+            # Also skip repeats within the playlist itself
+            existing_iris.add(store.iri)
+            if store.filehash:
+                existing_hashes.add(store.filehash)
+            new_songs.append((song, store))
+
+        if not new_songs:
+            return
+
+        Store.objects.bulk_create([store for song, store in new_songs],
+                                  batch_size=BATCH_SIZE)
+        store_ids = dict(Store.objects.filter(
+            iri__in=[store.iri for song, store in new_songs]
+        ).values_list('iri', 'pk'))
+
+        songs = []
+        for song, store in new_songs:
+            songs.append(Song(album_id=album_ids.get(song['album']),
+                              game_id=game_ids.get(song['game']),
+                              disabled=song['disabled'],
+                              song_type=song['type'],
+                              title=song['title'],
+                              sorted_title=naturalize(song['title']),
+                              active_store_id=store_ids[store.iri],
+                              published_date=publish_date))
+        Song.objects.bulk_create(songs, batch_size=BATCH_SIZE)
+        song_ids = dict(Song.objects.filter(
+            active_store_id__in=store_ids.values()
+        ).values_list('active_store_id', 'pk'))
+
+        song_artists = []
+        song_stores = []
+        for song, store in new_songs:
+            song_id = song_ids[store_ids[store.iri]]
+            song_stores.append(Song.stores.through(
+                song_id=song_id,
+                store_id=store_ids[store.iri]
+            ))
+            for artist in song['artists']:
+                try:
+                    artist_id = artist_ids[artist_key(artist)]
+                except KeyError:
+                    raise CommandError(
+                        'Song "{}" has an unknown artist: {}'.format(
+                            song['title'],
+                            artist
+                        )
+                    )
+                song_artists.append(Song.artists.through(
+                    song_id=song_id,
+                    artist_id=artist_id
+                ))
+        Song.artists.through.objects.bulk_create(song_artists,
+                                                 batch_size=BATCH_SIZE)
+        Song.stores.through.objects.bulk_create(song_stores,
+                                                batch_size=BATCH_SIZE)
+        totals['songs'] += len(songs)
@@ -0,0 +1,19 @@
+'''
+Django management command to rebuild the rating count and sum stored on every
+song from the ratings themselves.
+'''
+
+from django.core.management.base import BaseCommand
+
+from radio.models import Song
+
+
+class Command(BaseCommand):
+    '''Main "rebuildratings" command class'''
+    help = 'Rebuilds the rating statistics stored on every song'
+
+    def handle(self, *args, **options):
+        rows_updated = Song.music.rebuild_rating_stats()
+        self.stdout.write(
+            'Rebuilt rating statistics for {} songs'.format(str(rows_updated))
+        )
@@ -0,0 +1,28 @@
+'''
+Django management command to rebuild the materialized playlist totals. The
+totals are kept up to date incrementally, so this is meant to be run
+periodically (eg. from cron) to correct any drift.
+'''
+
+from django.core.management.base import BaseCommand
+
+from radio.models import PlaylistAggregate
+
+
+class Command(BaseCommand):
+    '''Main "reconcileplaylist" command class'''
+    help = 'Rebuilds the total length of the available songs in the playlist'
+
+    def handle(self, *args, **options):
+        before = PlaylistAggregate.objects.filter(
+            pk=PlaylistAggregate.objects.AGGREGATE_PK
+        ).first()
+        aggregate = PlaylistAggregate.objects.reconcile()
+
+        if before is not None:
+            drift = aggregate.total_length - before.total_length
+            if drift:
+                self.stdout.write(
+                    'Corrected drift of {} seconds'.format(str(drift))
+                )
+        self.stdout.write('Playlist totals: {}'.format(str(aggregate)))
@@ -0,0 +1,85 @@
+'''
+Django management command to work through the admin actions queued for large
+selections, applying each one to its items in id-ordered chunks. Run it once
+(eg. from cron), or leave it running with "--interval".
+'''
+
+import json
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from radio.actions import run_action
+from radio.models import ActionJob
+
+
+class Command(BaseCommand):
+    '''Main "runactions" command class'''
+    help = 'Applies the queued admin actions in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            help='Number of items changed per transaction '
+                                 '(defaults to the RADIO_ACTION_CHUNK_SIZE '
+                                 'setting)')
+        parser.add_argument('--interval',
+                            type=int,
+                            help='Keep running, checking for new jobs every '
+                                 'INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size'] or settings.RADIO_ACTION_CHUNK_SIZE
+        if chunk_size < 1:
+            raise CommandError('Chunk size must be positive')
+
+        while True:
+            job = ActionJob.objects.claim_next()
+            while job is not None:
+                self.run(job, chunk_size)
+                job = ActionJob.objects.claim_next()
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def run(self, job, chunk_size):
+        '''
+        Apply a job's action one chunk at a time, recording its progress
+        along with each chunk so a requeued job carries on where it stopped.
+        If the job was requeued (or taken by another worker) in the meantime,
+        the chunk is rolled back and the job left to them.
+        '''
+        try:
+            model = apps.get_model(job.model_label)
+            ids = json.loads(job.object_ids)
+            arguments = json.loads(job.arguments)
+            for start in range(job.processed, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                with transaction.atomic():
+                    run_action(model, chunk, job.action, arguments)
+                    kept = ActionJob.objects.filter(
+                        pk=job.pk,
+                        status=ActionJob.RUNNING,
+                        processed=start
+                    ).update(processed=start + len(chunk),
+                             modified_date=timezone.now())
+                    if not kept:
+                        transaction.set_rollback(True)
+                        self.stderr.write('Job #{} was taken over, '
+                                          'stopping'.format(str(job.pk)))
+                        return
+                job.processed = start + len(chunk)
+        except Exception as error:
+            ActionJob.objects.finish(job, repr(error))
+            self.stderr.write('Job #{} failed: {}'.format(str(job.pk),
+                                                          repr(error)))
+            return
+
+        ActionJob.objects.finish(job)
+        self.stdout.write('Job #{} done: {}'.format(str(job.pk),
+                                                    job.progress))
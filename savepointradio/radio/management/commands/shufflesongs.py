@@ -0,0 +1,20 @@
+'''
+Django management command to regenerate the random selection keys of every
+song, eg. after a large import. Picks keep the keys shuffled by themselves, so
+this only evens out the chances sooner.
+'''
+
+from django.core.management.base import BaseCommand
+
+from radio.models import Song
+
+
+class Command(BaseCommand):
+    '''Main "shufflesongs" command class'''
+    help = 'Regenerates the random selection keys for all songs'
+
+    def handle(self, *args, **options):
+        Song.music.shuffle()
+        self.stdout.write('Shuffled {} songs'.format(
+            str(Song.objects.count())
+        ))
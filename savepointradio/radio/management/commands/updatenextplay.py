@@ -0,0 +1,37 @@
+'''
+Django management command to recalculate when every song can be played again.
+The waits change with the replay settings and the length of the playlist, and
+both flag them as needing an update, so leave this running with "--interval"
+(or run it periodically, eg. from cron) to pick those changes up.
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from radio.models import PlaylistAggregate, Song
+
+
+class Command(BaseCommand):
+    '''Main "updatenextplay" command class'''
+    help = 'Recalculates when every played song can be played again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval',
+                            type=int,
+                            help='Keep running, recalculating every '
+                                 'INTERVAL seconds if the replay settings '
+                                 'or the playlist length have changed')
+
+    def handle(self, *args, **options):
+        PlaylistAggregate.objects.claim_next_play_update()
+        self.update()
+
+        while options['interval']:
+            time.sleep(options['interval'])
+            if PlaylistAggregate.objects.claim_next_play_update():
+                self.update()
+
+    def update(self):
+        updated = Song.music.update_next_play()
+        self.stdout.write('Updated {} songs'.format(str(updated)))
@@ -4,10 +4,13 @@ Django Model Managers for the Radio application.
 
 from datetime import timedelta
 from decimal import getcontext, Decimal, ROUND_UP
-from random import randint
+import random
 
 from django.apps import apps
+from django.conf import settings
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Least
 from django.utils import timezone
 
 from core.utils import get_setting
@@ -64,6 +67,14 @@ class SongManager(RadioManager):
     '''
     Custom object manager for filtering out common behaviors for Song objects.
     '''
+    # Songs that come up in a random pick before one is taken regardless of
+    # its selection weight
+    PICK_TRIES = 10
+
+    # Lowest chance a song is accepted with once it comes up, which bounds
+    # the number of tries a pick takes (ratings never go below it either)
+    MIN_SELECTION_WEIGHT = 0.2
+
     def get_queryset(self):
         '''
         Return customized default QuerySet for Songs.
@@ -86,27 +97,28 @@ class SongManager(RadioManager):
         '''
         Total length of available songs in the playlist (in seconds).
         '''
-        a_songs = self.available_songs()
-        length = a_songs.aggregate(
-            total_time=models.Sum('active_store__length')
-        )
-        return length['total_time']
+        aggregate = apps.get_model(app_label='radio',
+                                   model_name='PlaylistAggregate')
+        return aggregate.objects.current().total_length
 
-    def wait_total(self, adjusted_ratio=0.0):
+    def wait_total(self, adjusted_ratio=0.0, playlist_length=None):
         '''
         Default length in seconds before a song can be played again. This is
         based on the replay ratio set in the application settings.
         '''
+        if playlist_length is None:
+            playlist_length = self.playlist_length()
         total_ratio = get_setting('replay_ratio') + adjusted_ratio
-        wait = self.playlist_length() * Decimal(total_ratio)
+        wait = playlist_length * Decimal(total_ratio)
         wait = wait.quantize(Decimal('.01'), rounding=ROUND_UP)
         return timedelta(seconds=float(wait))
 
-    def datetime_from_wait(self):
+    def datetime_from_wait(self, playlist_length=None):
         '''
         Datetime of now minus the default wait time for played songs.
         '''
-        return timezone.now() - self.wait_total()
+        wait = self.wait_total(playlist_length=playlist_length)
+        return timezone.now() - wait
 
     def playable(self):
         '''
@@ -126,19 +138,447 @@ class SongManager(RadioManager):
         # Import SongRequest here to get rid of circular dependencies
         song_request = apps.get_model(app_label='profiles',
                                       model_name='SongRequest')
-        requests = song_request.music.unplayed().values_list('song__id',
-                                                             flat=True)
+        requests = song_request.music.pending().values_list('song__id',
+                                                            flat=True)
         return self.playable().exclude(id__in=requests)
 
+    def adjust_rating_stats(self, song_id, count=0, total=0):
+        '''
+        Atomically add (or subtract, with negative values) to the rating
+        count and sum stored on a song.
+        '''
+        self.filter(pk=song_id).update(
+            rating_count=models.F('rating_count') + count,
+            rating_sum=models.F('rating_sum') + total
+        )
+
+    def rebuild_rating_stats(self):
+        '''
+        Recalculate the stored rating count and sum of every song from its
+        ratings in a single update.
+        '''
+        rating = apps.get_model(app_label='profiles', model_name='Rating')
+        ratings = rating.objects.filter(
+            song=models.OuterRef('pk')
+        ).order_by().values('song')
+        count = ratings.annotate(count=models.Count('id')).values('count')
+        total = ratings.annotate(total=models.Sum('value')).values('total')
+        return self.get_queryset().update(
+            rating_count=Coalesce(
+                models.Subquery(count, output_field=models.IntegerField()),
+                0
+            ),
+            rating_sum=Coalesce(
+                models.Subquery(total, output_field=models.IntegerField()),
+                0
+            )
+        )
+
+    def random_key(self):
+        '''
+        Generate a new random selection key, a random point between 0 and 1.
+        '''
+        return random.random()
+
+    def selection_weights(self, queryset):
+        '''
+        Function giving how likely (from 0 to 1) a song from the queryset is
+        to be accepted once it comes up, with the weighting chosen by the
+        'song_selection_weight' setting.
+        '''
+        weighting = get_setting('song_selection_weight')
+        if weighting == 'rating':
+            def weight(song):
+                if not song.is_song or song.average_rating is None:
+                    return 3.0 / 5.0
+                return float(song.average_rating) / 5.0
+        elif weighting == 'plays':
+            # Relative to the least played song, so one always gets through
+            aggregate = apps.get_model(app_label='radio',
+                                       model_name='PlaylistAggregate')
+            least_played = aggregate.objects.current().least_played
+
+            def weight(song):
+                if not song.is_song:
+                    return 1.0
+                return max((least_played + 1.0) / (song.num_played + 1.0),
+                           self.MIN_SELECTION_WEIGHT)
+        else:
+            def weight(song):
+                return 1.0
+        return weight
+
+    def pick_random(self, queryset):
+        '''
+        Pick a random song from the queryset: the one with the first
+        selection key at or after a random point, wrapping around to the
+        lowest key. Each song comes up as often as the gap before its key,
+        and gets a new key whenever it comes up, so over many picks they all
+        come up evenly. A song that comes up is then accepted by its
+        selection weight, trying again up to PICK_TRIES times. The new keys
+        of every song that came up are saved together at the end.
+        '''
+        queryset = queryset.order_by('random_key')
+        weight = self.selection_weights(queryset)
+        song = None
+        drawn = {}
+        for _ in range(self.PICK_TRIES):
+            song = queryset.filter(random_key__gte=random.random()).first()
+            if song is None:
+                song = queryset.first()
+            if song is None:
+                break
+            song.random_key = self.random_key()
+            drawn[song.pk] = song
+            if random.random() < weight(song):
+                break
+        if drawn:
+            self.bulk_update(list(drawn.values()), ['random_key'])
+        return song
+
+    def shuffle(self, queryset=None, batch_size=1000):
+        '''
+        Generate new random selection keys for every song (or those in the
+        queryset), evening out the gaps between them right away.
+        '''
+        if queryset is None:
+            queryset = self.get_queryset()
+        songs = []
+        for song in queryset.iterator(chunk_size=batch_size):
+            song.random_key = self.random_key()
+            songs.append(song)
+            if len(songs) >= batch_size:
+                self.bulk_update(songs, ['random_key'])
+                songs = []
+        if songs:
+            self.bulk_update(songs, ['random_key'])
+
+    def adjusted_ratio(self, rating_count, average):
+        '''
+        Change to the replay ratio earned by a song's ratings, once it has
+        enough of them: better rated songs can be played again sooner.
+        '''
+        min_ratings = get_setting('min_ratings_for_variance')
+        if average is not None and rating_count >= min_ratings:
+            rate_ratio = get_setting('rating_variance_ratio')
+
+            # -((average - 1)/(highest_rating - 1)) * rating_ratio
+            base = -((float(average) - 1) / 4) * rate_ratio
+            return float(base + (rate_ratio * 0.5))
+        return float(0.0)
+
+    def update_next_play(self, batch_size=1000, song_ids=None):
+        '''
+        Recalculate when every song that has been played (or is queued) can
+        be played again (or only the given songs), eg. after the replay
+        settings have changed or the playlist has grown. The play times and
+        rating stats of the whole library are loaded in one query, and only
+        the changed songs are written back. Returns the number of songs
+        updated.
+        '''
+        song_request = apps.get_model(app_label='profiles',
+                                      model_name='SongRequest')
+        playlist_length = self.playlist_length()
+
+        # A queued song that hasn't been played yet waits from when it was
+        # queued, as it did when it was marked queued
+        queued = song_request.music.unplayed().filter(
+            queued_at__isnull=False,
+            song__isnull=False
+        )
+        if song_ids is not None:
+            queued = queued.filter(song_id__in=song_ids)
+        queued = dict(queued.order_by('queued_at').values_list('song_id',
+                                                               'queued_at'))
+
+        # Songs with the same ratings wait the same time, so it's only
+        # worked out once for each
+        waits = {}
+        songs = []
+        updated = 0
+        library = self.get_queryset().songs().filter(
+            models.Q(last_played__isnull=False) |
+            models.Q(pk__in=list(queued))
+        )
+        if song_ids is not None:
+            library = library.filter(pk__in=song_ids)
+        library = library.values_list('pk', 'last_played', 'next_play',
+                                      'rating_count', 'rating_sum')
+        for pk, last_played, next_play, count, total in library.iterator(
+                chunk_size=batch_size):
+            last = last_played
+            if pk in queued and (last is None or queued[pk] > last):
+                last = queued[pk]
+
+            ratings = (count, total)
+            if ratings not in waits:
+                average = None
+                if count:
+                    average = (Decimal(total) / Decimal(count)).quantize(
+                        Decimal('.01'),
+                        rounding=ROUND_UP
+                    )
+                waits[ratings] = self.wait_total(
+                    self.adjusted_ratio(count, average),
+                    playlist_length
+                )
+
+            new_next_play = last + waits[ratings]
+            if new_next_play != next_play:
+                songs.append(self.model(pk=pk, next_play=new_next_play))
+                if len(songs) >= batch_size:
+                    self.bulk_update(songs, ['next_play'])
+                    updated += len(songs)
+                    songs = []
+        if songs:
+            self.bulk_update(songs, ['next_play'])
+            updated += len(songs)
+        return updated
+
+    def mark_queued(self, song, queued_at):
+        '''
+        Once a song is queued, set when it can be requested again and give
+        it a fresh random selection key, in a single update.
+        '''
+        updates = {'random_key': self.random_key()}
+        if song.is_song:
+            updates['next_play'] = song.get_date_when_requestable(queued_at)
+        self.filter(pk=song.pk).update(**updates)
+        for field, value in updates.items():
+            setattr(song, field, value)
+
     def get_random_requestable_song(self):
         '''
         Pick a random requestable song and return it.
         '''
-        return self.requestable()[randint(0, self.requestable().count() - 1)]
+        return self.pick_random(self.requestable())
 
     def get_random_jingle(self):
         '''
         Pick a random jingle and return it.
         '''
-        random_index = randint(0, self.available_jingles().count() - 1)
-        return self.available_jingles()[random_index]
+        return self.pick_random(self.available_jingles())
+
+
+class PlaylistAggregateManager(models.Manager):
+    '''
+    Custom object manager for keeping the materialized playlist totals up to
+    date.
+    '''
+    AGGREGATE_PK = 1
+
+    @staticmethod
+    def contribution(song_type, disabled, published_date, length):
+        '''
+        Length and count a song with the given values adds to the totals.
+        '''
+        if song_type == 'S' and not disabled and published_date is not None:
+            if published_date <= timezone.now():
+                return (length or Decimal(0)), 1
+        return Decimal(0), 0
+
+    def current(self):
+        '''
+        The playlist totals, rebuilt first if they have never been calculated
+        or a scheduled publish date has passed since.
+        '''
+        try:
+            aggregate = self.get(pk=self.AGGREGATE_PK)
+        except self.model.DoesNotExist:
+            return self.reconcile()
+        if aggregate.stale_date and aggregate.stale_date <= timezone.now():
+            return self.reconcile()
+        return aggregate
+
+    def reconcile(self):
+        '''
+        Rebuild the playlist totals from scratch with a full scan of the
+        available songs. If the total length changed, the replay waits are
+        marked as needing an update.
+        '''
+        song = apps.get_model(app_label='radio', model_name='Song')
+        now = timezone.now()
+        totals = song.music.available_songs().aggregate(
+            total_length=models.Sum('active_store__length'),
+            song_count=models.Count('id'),
+            least_played=models.Min('num_played')
+        )
+        pending = song.music.enabled().songs().filter(
+            published_date__gt=now
+        ).aggregate(stale_date=models.Min('published_date'))
+        total_length = totals['total_length'] or Decimal(0)
+        defaults = {
+            'total_length': total_length,
+            'song_count': totals['song_count'],
+            'least_played': totals['least_played'] or 0,
+            'stale_date': pending['stale_date'],
+            'reconciled_date': now
+        }
+        if not self.filter(pk=self.AGGREGATE_PK,
+                           total_length=total_length).exists():
+            defaults['next_play_stale'] = True
+        aggregate, created = self.update_or_create(pk=self.AGGREGATE_PK,
+                                                   defaults=defaults)
+        return aggregate
+
+    def adjust(self, length=0, count=0, publish_date=None, num_played=None):
+        '''
+        Incrementally add (or subtract, with negative values) to the totals.
+        A future publish date marks when the totals need a rebuild, and a
+        change of length that the replay waits need an update. The play count
+        of a song joining the playlist lowers the least play count if needed.
+        '''
+        updates = {}
+        if num_played is not None:
+            updates['least_played'] = Least('least_played', Value(num_played))
+        if length:
+            updates['total_length'] = models.F('total_length') + length
+            updates['next_play_stale'] = True
+        if count:
+            updates['song_count'] = models.F('song_count') + count
+        if publish_date is not None and publish_date > timezone.now():
+            updates['stale_date'] = Coalesce(
+                Least('stale_date', Value(publish_date)),
+                Value(publish_date)
+            )
+        if updates:
+            if not self.filter(pk=self.AGGREGATE_PK).update(**updates):
+                self.reconcile()
+
+    def raise_least_played(self):
+        '''
+        Once songs have been played, move the least play count up if no
+        available song is left with it. Only rescans the library when the
+        last of the least played songs has been played.
+        '''
+        song = apps.get_model(app_label='radio', model_name='Song')
+        least_played = self.current().least_played
+        available = song.music.available_songs()
+        if available.filter(num_played__lte=least_played).exists():
+            return
+        least = available.aggregate(
+            least=models.Min('num_played')
+        )['least']
+        if least is not None:
+            self.filter(pk=self.AGGREGATE_PK,
+                        least_played=least_played).update(least_played=least)
+
+    def mark_next_play_stale(self):
+        '''
+        Flag that the replay waits of the songs need an update, for the
+        "updatenextplay" command to pick up.
+        '''
+        if not self.filter(pk=self.AGGREGATE_PK).update(next_play_stale=True):
+            self.reconcile()
+
+    def claim_next_play_update(self):
+        '''
+        Clear the flag for updating the replay waits, returning whether it
+        was set. Only one caller ever gets True for the same flag.
+        '''
+        return bool(self.filter(
+            pk=self.AGGREGATE_PK,
+            next_play_stale=True
+        ).update(next_play_stale=False))
+
+
+class CachedStoreManager(models.Manager):
+    '''
+    Custom object manager for the local copies of remote stores.
+    '''
+    def upcoming_stores(self, limit):
+        '''
+        Remote ("s3://") active stores of the songs queued and not played
+        yet (oldest first), then of the next requests waiting to be played,
+        in the order they will be needed.
+        '''
+        song_request = apps.get_model(app_label='profiles',
+                                      model_name='SongRequest')
+        store = apps.get_model(app_label='radio', model_name='Store')
+        queued = song_request.music.unplayed().filter(
+            queued_at__isnull=False
+        ).order_by('queued_at', 'id').values_list('song__active_store',
+                                                  flat=True)
+        waiting = song_request.music.unqueued().order_by(
+            'created_date', 'id'
+        ).values_list('song__active_store', flat=True)
+        store_ids = list(queued) + list(waiting[:limit])
+
+        stores = store.objects.filter(
+            pk__in=store_ids,
+            iri__startswith='s3://'
+        ).select_related('cached').in_bulk()
+        upcoming = []
+        for store_id in store_ids:
+            if store_id in stores and stores[store_id] not in upcoming:
+                upcoming.append(stores[store_id])
+        return upcoming
+
+    def mark_used(self, store_id):
+        '''
+        Record that the local copy of a store (if any) was just handed out.
+        '''
+        return self.filter(store_id=store_id).update(last_used=timezone.now())
+
+    def least_recently_used(self, keep=None):
+        '''
+        Local copies in the order they should be evicted, leaving out the
+        stores to keep.
+        '''
+        queryset = self.get_queryset()
+        if keep:
+            queryset = queryset.exclude(store_id__in=keep)
+        return queryset.order_by('last_used', 'id')
+
+
+class ActionJobManager(models.Manager):
+    '''
+    Custom object manager for the queue of admin actions run in chunks.
+    '''
+    def claim_next(self):
+        '''
+        Mark the oldest queued job as running and return it, or None if
+        there are none. A job is only ever claimed by one worker.
+        '''
+        while True:
+            job = self.filter(status=self.model.QUEUED).order_by(
+                'created_date', 'id'
+            ).first()
+            if job is None:
+                return None
+            now = timezone.now()
+            claimed = self.filter(
+                pk=job.pk,
+                status=self.model.QUEUED
+            ).update(status=self.model.RUNNING,
+                     started_date=now,
+                     modified_date=now)
+            if claimed:
+                job.status = self.model.RUNNING
+                job.started_date = now
+                return job
+
+    def requeueable(self):
+        '''
+        Jobs that can be put back in the queue: the failed ones, and the
+        running ones that haven't finished a chunk for RADIO_ACTION_TIMEOUT
+        seconds (as their worker has likely died).
+        '''
+        stuck = timezone.now() - timedelta(
+            seconds=settings.RADIO_ACTION_TIMEOUT
+        )
+        return self.filter(
+            models.Q(status=self.model.FAILED) |
+            models.Q(status=self.model.RUNNING, modified_date__lt=stuck)
+        )
+
+    def finish(self, job, error=''):
+        '''
+        Mark a running job as done, or as failed with the error that
+        stopped it.
+        '''
+        job.status = self.model.FAILED if error else self.model.DONE
+        job.error = error
+        job.finished_date = timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_date',
+                                'modified_date'])
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0005_replaygain_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaylistAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_length', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='total length (in seconds)')),
+                ('song_count', models.PositiveIntegerField(default=0, verbose_name='number of available songs')),
+                ('stale_date', models.DateTimeField(blank=True, null=True, verbose_name='totals change at')),
+                ('reconciled_date', models.DateTimeField(blank=True, null=True, verbose_name='last reconciled')),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:45
+
+import random
+
+from django.db import migrations, models
+import radio.models
+
+
+def randomize_keys(apps, schema_editor):
+    Song = apps.get_model('radio', 'Song')
+    db_alias = schema_editor.connection.alias
+    songs = list(Song.objects.using(db_alias).only('id'))
+    for song in songs:
+        song.random_key = random.random()
+    Song.objects.using(db_alias).bulk_update(songs,
+                                             ['random_key'],
+                                             batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0006_playlistaggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='random_key',
+            field=models.FloatField(db_index=True, default=radio.models.default_random_key, editable=False, verbose_name='random selection key'),
+        ),
+        migrations.AddField(
+            model_name='playlistaggregate',
+            name='least_played',
+            field=models.PositiveIntegerField(default=0, verbose_name='fewest plays of an available song'),
+        ),
+        migrations.RunPython(randomize_keys, migrations.RunPython.noop),
+    ]
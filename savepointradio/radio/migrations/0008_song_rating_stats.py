@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:49
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def calculate_rating_stats(apps, schema_editor):
+    Song = apps.get_model('radio', 'Song')
+    Rating = apps.get_model('profiles', 'Rating')
+    db_alias = schema_editor.connection.alias
+    ratings = Rating.objects.using(db_alias).filter(
+        song=OuterRef('pk')
+    ).order_by().values('song')
+    count = ratings.annotate(count=Count('id')).values('count')
+    total = ratings.annotate(total=Sum('value')).values('total')
+    Song.objects.using(db_alias).update(
+        rating_count=Coalesce(
+            Subquery(count, output_field=models.IntegerField()), 0
+        ),
+        rating_sum=Coalesce(
+            Subquery(total, output_field=models.IntegerField()), 0
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_create_dj_profile'),
+        ('radio', '0007_song_random_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='number of ratings'),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='sum of all ratings'),
+        ),
+        migrations.RunPython(calculate_rating_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0008_song_rating_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['sorted_title', 'id'], name='radio_song_sorted__bec7dd_idx'),
+        ),
+    ]
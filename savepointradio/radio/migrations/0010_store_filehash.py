@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0009_song_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='filehash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='SHA3-256 hash of the file'),
+        ),
+    ]
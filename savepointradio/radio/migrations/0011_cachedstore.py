@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:15
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0010_store_filehash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedStore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='added on')),
+                ('modified_date', models.DateTimeField(auto_now=True, verbose_name='last modified')),
+                ('path', models.CharField(max_length=1024, verbose_name='local file path')),
+                ('file_size', models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)], verbose_name='file size')),
+                ('filehash', models.CharField(max_length=64, verbose_name='SHA3-256 hash of the file')),
+                ('last_used', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='last used')),
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cached', to='radio.Store')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
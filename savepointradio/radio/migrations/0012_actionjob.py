@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('radio', '0011_cachedstore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActionJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='added on')),
+                ('modified_date', models.DateTimeField(auto_now=True, verbose_name='last modified')),
+                ('action', models.CharField(choices=[('change', 'Change items'), ('publish', 'Publish')], max_length=16, verbose_name='action')),
+                ('model_label', models.CharField(max_length=100, verbose_name='model of the selected items')),
+                ('object_ids', models.TextField(verbose_name='ids of the selected items (JSON)')),
+                ('arguments', models.TextField(verbose_name='action arguments (JSON)')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16, verbose_name='status')),
+                ('total', models.PositiveIntegerField(verbose_name='number of items')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='number of items processed')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('started_date', models.DateTimeField(blank=True, null=True, verbose_name='started on')),
+                ('finished_date', models.DateTimeField(blank=True, null=True, verbose_name='finished on')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
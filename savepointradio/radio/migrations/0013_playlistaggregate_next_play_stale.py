@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0012_actionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlistaggregate',
+            name='next_play_stale',
+            field=models.BooleanField(default=False, verbose_name='replay waits need updating'),
+        ),
+    ]
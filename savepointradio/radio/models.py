@@ -4,23 +4,33 @@ Django Models for the Radio application.
 
 from datetime import timedelta
 from decimal import getcontext, Decimal, ROUND_UP
+import os
+import random
 
 from django.apps import apps
+from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from core.behaviors import Disableable, Publishable, Timestampable
-from core.utils import get_setting
 from .fields import RadioIRIField
-from .managers import RadioManager, SongManager
+from .managers import (ActionJobManager, CachedStoreManager,
+                       PlaylistAggregateManager, RadioManager, SongManager)
 
 
 # Set decimal precision
 getcontext().prec = 16
 
 
+def default_random_key():
+    '''
+    Unweighted random selection key for newly created songs.
+    '''
+    return random.random()
+
+
 class Album(Disableable, Publishable, Timestampable, models.Model):
     '''
     A model for a music album.
@@ -127,6 +137,10 @@ class Store(Timestampable, models.Model):
                                      decimal_places=6,
                                      null=True,
                                      blank=True)
+    filehash = models.CharField(_('SHA3-256 hash of the file'),
+                                max_length=64,
+                                db_index=True,
+                                blank=True)
 
     def _replaygain(self):
         '''
@@ -143,6 +157,75 @@ class Store(Timestampable, models.Model):
         return self.iri
 
 
+class CachedStore(Timestampable, models.Model):
+    '''
+    A model to represent the local copy of a remote store, downloaded ahead
+    of time so the DJ can play it from disk.
+    '''
+    store = models.OneToOneField(Store,
+                                 on_delete=models.CASCADE,
+                                 related_name='cached')
+    path = models.CharField(_('local file path'), max_length=1024)
+    file_size = models.BigIntegerField(_('file size'),
+                                       validators=[MinValueValidator(0)])
+    filehash = models.CharField(_('SHA3-256 hash of the file'),
+                                max_length=64)
+    last_used = models.DateTimeField(_('last used'),
+                                     default=timezone.now,
+                                     db_index=True)
+
+    objects = CachedStoreManager()
+
+    def __str__(self):
+        return self.path
+
+    def _is_warm(self):
+        '''
+        Whether the local copy is still on disk with the size it was saved
+        with, and has the content its store expects.
+        '''
+        if self.store.filehash and self.store.filehash != self.filehash:
+            return False
+        try:
+            return os.path.getsize(self.path) == self.file_size
+        except OSError:
+            return False
+    _is_warm.boolean = True
+    is_warm = property(_is_warm)
+
+
+class PlaylistAggregate(models.Model):
+    '''
+    A single-row model holding the materialized totals of the available songs
+    in the playlist, so the replay wait does not need to sum the whole
+    library every time it is calculated.
+    '''
+    total_length = models.DecimalField(_('total length (in seconds)'),
+                                       max_digits=14,
+                                       decimal_places=2,
+                                       default=0)
+    song_count = models.PositiveIntegerField(_('number of available songs'),
+                                             default=0)
+    least_played = models.PositiveIntegerField(
+        _('fewest plays of an available song'),
+        default=0
+    )
+    stale_date = models.DateTimeField(_('totals change at'),
+                                      null=True,
+                                      blank=True)
+    reconciled_date = models.DateTimeField(_('last reconciled'),
+                                           null=True,
+                                           blank=True)
+    next_play_stale = models.BooleanField(_('replay waits need updating'),
+                                          default=False)
+
+    objects = PlaylistAggregateManager()
+
+    def __str__(self):
+        return '{} songs ({} seconds)'.format(self.song_count,
+                                              self.total_length)
+
+
 class Song(Disableable, Publishable, Timestampable, models.Model):
     '''
     A model for a song.
@@ -187,12 +270,25 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
                                     db_index=True,
                                     editable=False,
                                     max_length=255)
+    rating_count = models.PositiveIntegerField(_('number of ratings'),
+                                               default=0,
+                                               editable=False)
+    rating_sum = models.PositiveIntegerField(_('sum of all ratings'),
+                                             default=0,
+                                             editable=False)
+    random_key = models.FloatField(_('random selection key'),
+                                   db_index=True,
+                                   default=default_random_key,
+                                   editable=False)
 
     objects = models.Manager()
     music = SongManager()
 
     class Meta:
         ordering = ['sorted_title', ]
+        indexes = [
+            models.Index(fields=['sorted_title', 'id']),
+        ]
 
     def _is_jingle(self):
         '''
@@ -236,21 +332,31 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
         '''
         Decimal number of the average rating of a song from 1 - 5.
         '''
-        ratings = self.rating_set.all()
-        if ratings:
-            avg = Decimal(ratings.aggregate(avg=models.Avg('value'))['avg'])
+        if self.rating_count:
+            avg = Decimal(self.rating_sum) / Decimal(self.rating_count)
             return avg.quantize(Decimal('.01'), rounding=ROUND_UP)
         return None
     average_rating = property(_average_rating)
 
+    def _playlist_contribution(self):
+        '''
+        Length and count this song adds to the playlist totals.
+        '''
+        length = None
+        if self.active_store_id:
+            length = self.active_store.length
+        return PlaylistAggregate.objects.contribution(self.song_type,
+                                                      self.disabled,
+                                                      self.published_date,
+                                                      length)
+
     def get_time_until_requestable(self):
         '''
         Length of time before a song can be requested again.
         '''
         if self._is_song() and self._is_available():
-            if self.last_played:
-                allowed_datetime = Song.music.datetime_from_wait()
-                remaining_wait = self.last_played - allowed_datetime
+            if self.next_play:
+                remaining_wait = self.next_play - timezone.now()
                 if remaining_wait.total_seconds() > 0:
                     return remaining_wait
             return timedelta(seconds=0)
@@ -265,17 +371,14 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
         if self._is_song() and self._is_available():
             if last:
                 # Check if we have enough ratings to change ratio
-                min_ratings = get_setting('min_ratings_for_variance')
-                if self.rating_set.count() >= min_ratings:
-                    rate_ratio = get_setting('rating_variance_ratio')
-
-                    # -((average - 1)/(highest_rating - 1)) * rating_ratio
-                    base = -((self._average_rating() - 1) / 4) * rate_ratio
-                    adjusted_ratio = float(base + (rate_ratio * 0.5))
-                else:
-                    adjusted_ratio = float(0.0)
-
-                return last + Song.music.wait_total(adjusted_ratio)
+                adjusted_ratio = Song.music.adjusted_ratio(
+                    self.rating_count,
+                    self._average_rating()
+                )
+
+                # Annotated by SongQuerySet.with_request_state()
+                length = getattr(self, 'playlist_total_length', None)
+                return last + Song.music.wait_total(adjusted_ratio, length)
             return timezone.now()
         return None
 
@@ -285,7 +388,9 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
         period (or at all)?
         '''
         if self._is_song() and self._is_available():
-            return self.get_date_when_requestable() <= timezone.now()
+            # Kept up to date when the song is queued and by
+            # SongManager.update_next_play(), like SongManager.playable()
+            return self.next_play is None or self.next_play < timezone.now()
         return False
     _is_playable.boolean = True
     is_playable = property(_is_playable)
@@ -295,10 +400,13 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
         Is the song playable and has it not already been requested?
         '''
         if self._is_playable():
+            if hasattr(self, 'is_queued'):
+                # Annotated by SongQuerySet.with_request_state()
+                return not self.is_queued
             song_request = apps.get_model(app_label='profiles',
                                           model_name='SongRequest')
-            requests = song_request.music.unplayed().values_list('song__id',
-                                                                 flat=True)
+            requests = song_request.music.pending().values_list('song__id',
+                                                                flat=True)
             return self.pk not in requests
         return False
     _is_requestable.boolean = True
@@ -306,3 +414,70 @@ class Song(Disableable, Publishable, Timestampable, models.Model):
 
     def __str__(self):
         return self.title
+
+
+class ActionJob(Timestampable, models.Model):
+    '''
+    A model to represent an admin action on a large selection of items,
+    applied in chunks by the "runactions" command.
+    '''
+    CHANGE = 'change'
+    PUBLISH = 'publish'
+    ACTION_CHOICES = (
+        (CHANGE, 'Change items'),
+        (PUBLISH, 'Publish'),
+    )
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    action = models.CharField(_('action'),
+                              max_length=16,
+                              choices=ACTION_CHOICES)
+    model_label = models.CharField(_('model of the selected items'),
+                                   max_length=100)
+    object_ids = models.TextField(_('ids of the selected items (JSON)'))
+    arguments = models.TextField(_('action arguments (JSON)'))
+    status = models.CharField(_('status'),
+                              max_length=16,
+                              choices=STATUS_CHOICES,
+                              default=QUEUED,
+                              db_index=True)
+    total = models.PositiveIntegerField(_('number of items'))
+    processed = models.PositiveIntegerField(_('number of items processed'),
+                                            default=0)
+    error = models.TextField(_('error'), blank=True)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                     on_delete=models.SET_NULL,
+                                     null=True,
+                                     blank=True)
+    started_date = models.DateTimeField(_('started on'),
+                                        null=True,
+                                        blank=True)
+    finished_date = models.DateTimeField(_('finished on'),
+                                         null=True,
+                                         blank=True)
+
+    objects = ActionJobManager()
+
+    def _progress(self):
+        '''
+        String representation of how far along the job is.
+        '''
+        percent = 100 * self.processed // self.total if self.total else 100
+        return '{}/{} ({}%)'.format(self.processed, self.total, percent)
+    progress = property(_progress)
+
+    def __str__(self):
+        return '#{} {} {} ({})'.format(self.pk,
+                                       self.get_action_display(),
+                                       self.model_label,
+                                       self.get_status_display())
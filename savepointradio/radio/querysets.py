@@ -1,4 +1,6 @@
+from django.apps import apps
 from django.db import models
+from django.utils import timezone
 
 from core.querysets import EnabledQuerySet, PublishedQuerySet
 
@@ -27,4 +29,35 @@ class SongQuerySet(RadioQuerySet, SongTypeQuerySet):
     Queryset combination that can easily select enabled objects, published
     objects, and objects of a certain song type.
     """
-    pass
+    def with_request_state(self):
+        """
+        Annotate each song with whether it is waiting in the request queue
+        ('is_queued') and the current playlist length
+        ('playlist_total_length'), which is everything needed to work out if
+        it is requestable without any further queries.
+
+        The playlist length follows the same rule as
+        PlaylistAggregateManager.current(): once a scheduled publish date has
+        passed, it is left out (None) so the wait falls back to the current
+        totals, which rebuilds them first.
+        """
+        song_request = apps.get_model(app_label='profiles',
+                                      model_name='SongRequest')
+        aggregate = apps.get_model(app_label='radio',
+                                   model_name='PlaylistAggregate')
+        requests = song_request.music.pending().filter(
+            song=models.OuterRef('pk')
+        )
+        total_length = aggregate.objects.filter(
+            models.Q(stale_date__isnull=True) |
+            models.Q(stale_date__gt=timezone.now()),
+            pk=aggregate.objects.AGGREGATE_PK
+        ).values('total_length')
+        return self.annotate(
+            is_queued=models.Exists(requests),
+            playlist_total_length=models.Subquery(
+                total_length,
+                output_field=models.DecimalField(max_digits=14,
+                                                 decimal_places=2)
+            )
+        )
@@ -1,9 +1,31 @@
-from django.db.models.signals import post_save, pre_save
-from django.dispatch import receiver
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import (post_delete, post_init, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver, Signal
 from django.utils import timezone
 
+from core.models import Setting
 from core.utils import naturalize
-from .models import Album, Artist, Game, Song
+from .models import Album, Artist, Game, PlaylistAggregate, Song, Store
+
+
+# Song fields that decide how a song counts towards the playlist totals
+PLAYLIST_FIELDS = {'song_type', 'disabled', 'published_date', 'active_store'}
+
+# The same fields, as the attributes holding their values on an instance
+PLAYLIST_ATTNAMES = ('song_type', 'disabled', 'published_date',
+                     'active_store_id')
+
+# Settings that decide how long a song waits before it can be played again
+REPLAY_SETTINGS = {'replay_ratio', 'rating_variance_ratio',
+                   'min_ratings_for_variance'}
+
+# Sent once after a set of songs is changed with a single .update(), which
+# skips their save signals, so receivers can catch up in bulk.
+songs_bulk_changed = Signal(providing_args=['song_ids', 'fields'])
 
 
 @receiver(pre_save, sender=Album)
@@ -46,48 +68,202 @@ def cascade_disable(sender, instance, created, update_fields, **kwargs):
             time = None
             reason = ''
 
-        # The multiple <model>_as_queryset's below are used to get around a
-        # potential infinite loop from the signal. Using .update() does not
-        # trigger it.
-
-        # Disabling/Enabling an album does the same to all linked songs
-        if sender == Album:
-            album_songs = Song.objects.filter(album=instance)
-            album_songs.update(disabled=instance.disabled,
-                               disabled_date=time,
-                               disabled_reason=reason)
-
-        # Disabling/Enabling an artist will only affect songs in which they
-        # are the only artist.
-        if sender == Artist:
-            for song in Song.objects.filter(artists=instance):
-                if song.artists.count() == 1:
-                    song_as_queryset = Song.objects.filter(pk=song.pk)
-                    song_as_queryset.update(disabled=instance.disabled,
-                                            disabled_date=time,
-                                            disabled_reason=reason)
-
-        # Disabling/Enabling an game does the same to all linked songs
-        if sender == Game:
-            game_songs = Song.objects.filter(game=instance)
-            game_songs.update(disabled=instance.disabled,
-                              disabled_date=time,
-                              disabled_reason=reason)
-
-        # Disabling a song does nothing, but enabling a song will enable all
-        # linked albums, artists, and games.
-        if sender == Song:
-            if not instance.disabled:
-                album_as_queryset = Album.objects.filter(pk=instance.album.pk)
-                album_as_queryset.update(disabled=instance.disabled,
-                                         disabled_date=time,
-                                         disabled_reason=reason)
-
-                instance.artists.all().update(disabled=instance.disabled,
-                                              disabled_date=time,
-                                              disabled_reason=reason)
-
-                game_as_queryset = Album.objects.filter(pk=instance.game.pk)
-                game_as_queryset.update(disabled=instance.disabled,
-                                        disabled_date=time,
-                                        disabled_reason=reason)
+        # The updates below are used to get around a potential infinite loop
+        # from the signal. Using .update() does not trigger it.
+        changes = {
+            'disabled': instance.disabled,
+            'disabled_date': time,
+            'disabled_reason': reason
+        }
+
+        with transaction.atomic():
+            # Disabling a song does nothing, but enabling a song will enable
+            # all linked albums, artists, and games.
+            if sender == Song:
+                if not instance.disabled:
+                    if instance.album_id is not None:
+                        Album.objects.filter(
+                            pk=instance.album_id
+                        ).update(**changes)
+                    instance.artists.all().update(**changes)
+                    if instance.game_id is not None:
+                        Game.objects.filter(
+                            pk=instance.game_id
+                        ).update(**changes)
+                return
+
+            # Disabling/Enabling an album or game does the same to all linked
+            # songs, but an artist will only affect songs in which they are
+            # the only artist.
+            if sender == Album:
+                songs = Song.objects.filter(album=instance)
+            elif sender == Game:
+                songs = Song.objects.filter(game=instance)
+            else:
+                sole_artist = Song.artists.through.objects.values(
+                    'song'
+                ).annotate(
+                    artist_count=Count('artist')
+                ).filter(artist_count=1).values('song')
+                songs = Song.objects.filter(artists=instance,
+                                            pk__in=sole_artist)
+
+            song_ids = list(songs.values_list('pk', flat=True))
+            if song_ids:
+                songs.update(**changes)
+                songs_bulk_changed.send(sender=Song,
+                                        song_ids=song_ids,
+                                        fields=list(changes))
+
+
+@receiver(songs_bulk_changed, sender=Song)
+def reconcile_bulk_changes(sender, song_ids, fields, **kwargs):
+    """
+    Bulk updates skip the signals keeping the playlist totals current, so
+    rebuild them once if the songs changed in a way that affects them.
+    """
+    if PLAYLIST_FIELDS.intersection(fields):
+        PlaylistAggregate.objects.reconcile()
+
+
+@receiver(post_init, sender=Song)
+def load_playlist_fields(sender, instance, **kwargs):
+    """
+    Keep the values a song was loaded with (or created with) for the fields
+    deciding its playlist contribution. Deferred fields are left out.
+    """
+    instance._playlist_loaded = {f: instance.__dict__[f]
+                                 for f in PLAYLIST_ATTNAMES
+                                 if f in instance.__dict__}
+
+
+@receiver(pre_save, sender=Song)
+def remember_playlist_contribution(sender, instance, update_fields,
+                                   **kwargs):
+    """
+    Before a song is saved, remember how it counted towards the playlist
+    totals so only the difference needs to be applied afterwards. This
+    uses the values the song was loaded with, only going back to the
+    database for fields that were deferred or a store that was swapped.
+    """
+    instance._playlist_before = None
+    if update_fields and not PLAYLIST_FIELDS.intersection(update_fields):
+        return
+
+    before = (Decimal(0), 0)
+    if instance.pk is not None and not instance._state.adding:
+        loaded = getattr(instance, '_playlist_loaded', {})
+        if len(loaded) < len(PLAYLIST_ATTNAMES):
+            old = Song.objects.filter(pk=instance.pk).values_list(
+                'song_type',
+                'disabled',
+                'published_date',
+                'active_store__length'
+            ).first()
+            if old:
+                before = PlaylistAggregate.objects.contribution(*old)
+        else:
+            store_id = loaded['active_store_id']
+            length = None
+            if store_id is not None:
+                if store_id == instance.active_store_id:
+                    length = instance.active_store.length
+                else:
+                    length = Store.objects.filter(pk=store_id).values_list(
+                        'length', flat=True
+                    ).first()
+            before = PlaylistAggregate.objects.contribution(
+                loaded['song_type'],
+                loaded['disabled'],
+                loaded['published_date'],
+                length
+            )
+    instance._playlist_before = before
+
+
+@receiver(post_save, sender=Song)
+def update_playlist_totals(sender, instance, update_fields, **kwargs):
+    """
+    Apply the change in a song's playlist contribution to the totals.
+    """
+    before = getattr(instance, '_playlist_before', None)
+    if before is None:
+        return
+    instance._playlist_before = None
+
+    # What was just saved is what the next save compares against
+    saved = PLAYLIST_ATTNAMES
+    if update_fields:
+        fields = [Song._meta.get_field(name) for name in update_fields]
+        saved = [f.attname for f in fields if f.attname in PLAYLIST_ATTNAMES]
+    for field in saved:
+        instance._playlist_loaded[field] = getattr(instance, field)
+
+    length, count = instance._playlist_contribution()
+    publish_date = None
+    if instance.is_song and not instance.disabled:
+        publish_date = instance.published_date
+    # A song joining the playlist may be the least played one now
+    num_played = instance.num_played if count > before[1] else None
+    PlaylistAggregate.objects.adjust(length - before[0],
+                                     count - before[1],
+                                     publish_date,
+                                     num_played)
+
+
+@receiver(post_delete, sender=Song)
+def remove_playlist_contribution(sender, instance, **kwargs):
+    """
+    Take a deleted song out of the playlist totals.
+    """
+    length, count = instance._playlist_contribution()
+    PlaylistAggregate.objects.adjust(-length, -count)
+
+
+@receiver(pre_save, sender=Store)
+def remember_store_length(sender, instance, **kwargs):
+    """
+    Before a store is saved, remember its length so a change can be applied
+    to the playlist totals.
+    """
+    instance._length_before = None
+    if instance.pk is not None:
+        instance._length_before = Store.objects.filter(
+            pk=instance.pk
+        ).values_list('length', flat=True).first()
+
+
+@receiver(post_save, sender=Store)
+def update_store_length(sender, instance, created, **kwargs):
+    """
+    If the length of a store changes, adjust the playlist totals for every
+    available song using it as the active store.
+    """
+    before = getattr(instance, '_length_before', None) or Decimal(0)
+    after = instance.length or Decimal(0)
+    if created or before == after:
+        return
+
+    songs = Song.music.available_songs().filter(active_store=instance)
+    PlaylistAggregate.objects.adjust((after - before) * songs.count())
+
+
+@receiver(pre_delete, sender=Store)
+def remove_store_length(sender, instance, **kwargs):
+    """
+    Songs using a deleted store as their active store lose their length in
+    the playlist totals.
+    """
+    if instance.length:
+        songs = Song.music.available_songs().filter(active_store=instance)
+        PlaylistAggregate.objects.adjust(-instance.length * songs.count())
+
+
+@receiver(post_save, sender=Setting)
+def update_next_play(sender, instance, **kwargs):
+    """
+    If a replay setting changes, flag that every song's replay wait needs
+    recalculating, which the "updatenextplay" command picks up.
+    """
+    if instance.name in REPLAY_SETTINGS:
+        PlaylistAggregate.objects.mark_next_play_stale()
@@ -1,3 +1,437 @@
-from django.test import TestCase
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.cache import setting_cache
+from core.models import RadioUser
+from api.serializers.radio import RadioSongSerializer
+from core.utils import set_setting
+from profiles.models import SongRequest
+from .management.commands import cachestores, runactions, updatenextplay
+from .models import ActionJob, CachedStore, PlaylistAggregate, Song, Store
+
+
+class RandomPickTests(TestCase):
+    '''
+    Picking random songs over and over should give every song its fair share.
+    '''
+    SONGS = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i),
+                 sorted_title='song {}'.format(i),
+                 published_date=published)
+            for i in range(cls.SONGS)
+        ])
+
+    def setUp(self):
+        # Seeded keys as well as picks, so every run is the same
+        random.seed(3)
+        Song.music.shuffle()
+
+    def pick_counts(self, picks):
+        counts = Counter(Song.music.get_random_requestable_song().pk
+                         for _ in range(picks))
+        return {pk: counts[pk]
+                for pk in Song.objects.values_list('pk', flat=True)}
+
+    def test_even_picks(self):
+        # About 50 picks each, with a standard deviation of about 7
+        counts = self.pick_counts(2500)
+        self.assertGreater(min(counts.values()), 20)
+        self.assertLess(max(counts.values()), 85)
+
+    def test_low_keys_catch_up(self):
+        # Songs stuck with the lowest keys still get their turn
+        low = list(Song.objects.values_list('pk', flat=True)[:5])
+        Song.objects.filter(pk__in=low).update(random_key=0.0)
+        Song.objects.exclude(pk__in=low).update(random_key=0.99)
+        counts = self.pick_counts(2500)
+        self.assertGreater(min(counts[pk] for pk in low), 20)
+
+    def test_rating_weighting(self):
+        set_setting('song_selection_weight', 'rating')
+        setting_cache.clear()
+        best = list(Song.objects.values_list('pk', flat=True)[:25])
+        Song.objects.filter(pk__in=best).update(rating_count=1, rating_sum=5)
+        Song.objects.exclude(pk__in=best).update(rating_count=1, rating_sum=1)
+
+        # Songs rated 5 should come up about five times as often as 1s
+        counts = self.pick_counts(2000)
+        best_picks = sum(counts[pk] for pk in best)
+        ratio = best_picks / (2000 - best_picks)
+        self.assertGreater(ratio, 3.5)
+        self.assertLess(ratio, 7)
+
+    def test_plays_weighting_cost(self):
+        set_setting('song_selection_weight', 'plays')
+        setting_cache.clear()
+        fresh = Song.objects.first()
+        Song.objects.exclude(pk=fresh.pk).update(num_played=100)
+        PlaylistAggregate.objects.reconcile()
+
+        # However many songs are turned down, each pick saves the new keys
+        # in a single update and never scans for the least played song
+        for _ in range(50):
+            with CaptureQueriesContext(connection) as context:
+                Song.music.get_random_requestable_song()
+            statements = [q['sql'] for q in context.captured_queries]
+            self.assertEqual(
+                len([sql for sql in statements
+                     if sql.startswith('UPDATE')]),
+                1
+            )
+            self.assertFalse(any('MIN(' in sql for sql in statements))
+
+    def test_least_played_follows_plays(self):
+        PlaylistAggregate.objects.reconcile()
+        profile = RadioUser.objects.create(email='listener@example.com',
+                                           name='listener').radioprofile
+        songs = list(Song.objects.all())
+        requests = [SongRequest.objects.create(profile=profile, song=song)
+                    for song in songs]
+        now = timezone.now()
+
+        SongRequest.music.mark_played([(r.pk, now) for r in requests[1:]])
+        self.assertEqual(PlaylistAggregate.objects.get().least_played, 0)
+        SongRequest.music.mark_played([(requests[0].pk, now)])
+        self.assertEqual(PlaylistAggregate.objects.get().least_played, 1)
+
+        # A new song has never been played
+        Song.objects.create(title='New', published_date=now)
+        self.assertEqual(PlaylistAggregate.objects.get().least_played, 0)
+
+
+@override_settings(RADIO_ACTION_TIMEOUT=600)
+class ActionJobTests(TestCase):
+    '''
+    Admin actions queued as jobs and worked through in chunks.
+    '''
+    def make_job(self, ids, **kwargs):
+        return ActionJob.objects.create(
+            action=ActionJob.PUBLISH,
+            model_label='radio.song',
+            object_ids=json.dumps(ids),
+            arguments=json.dumps({
+                'published_date': timezone.now().isoformat()
+            }),
+            total=len(ids),
+            **kwargs
+        )
+
+    def test_requeue_failed_and_stuck_jobs(self):
+        jobs = {status: self.make_job([], status=status)
+                for status, _ in ActionJob.STATUS_CHOICES}
+        stuck = self.make_job([], status=ActionJob.RUNNING)
+        ActionJob.objects.filter(pk=stuck.pk).update(
+            modified_date=timezone.now() - timedelta(hours=1)
+        )
+
+        admin = RadioUser.objects.create(email='admin@example.com',
+                                         name='Admin',
+                                         is_staff=True,
+                                         is_superuser=True)
+        self.client.force_login(admin)
+        self.client.post('/admin/radio/actionjob/', {
+            'action': 'requeue_jobs',
+            '_selected_action': [job.pk for job in ActionJob.objects.all()]
+        })
+
+        statuses = dict(ActionJob.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[jobs[ActionJob.FAILED].pk],
+                         ActionJob.QUEUED)
+        self.assertEqual(statuses[stuck.pk], ActionJob.QUEUED)
+        self.assertEqual(statuses[jobs[ActionJob.RUNNING].pk],
+                         ActionJob.RUNNING)
+        self.assertEqual(statuses[jobs[ActionJob.DONE].pk], ActionJob.DONE)
+
+    def run_job(self, job, chunk_size):
+        command = runactions.Command(stdout=StringIO(), stderr=StringIO())
+        with mock.patch.object(ActionJob.objects, 'finish'):
+            command.run(job, chunk_size)
+        job.refresh_from_db()
+
+    def test_chunks_record_progress(self):
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i), sorted_title='song {}'.format(i))
+            for i in range(5)
+        ])
+        job = self.make_job(list(Song.objects.values_list('pk', flat=True)))
+        stale = timezone.now() - timedelta(hours=1)
+        ActionJob.objects.filter(pk=job.pk).update(modified_date=stale)
+        job = ActionJob.objects.claim_next()
+
+        ActionJob.objects.filter(pk=job.pk).update(modified_date=stale)
+        self.run_job(job, 2)
+        self.assertEqual(job.processed, 5)
+        self.assertGreater(job.modified_date, stale)
+        self.assertEqual(Song.music.available().count(), 5)
+
+    def test_requeued_job_stops(self):
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i), sorted_title='song {}'.format(i))
+            for i in range(5)
+        ])
+        job = self.make_job(list(Song.objects.values_list('pk', flat=True)))
+        job = ActionJob.objects.claim_next()
+
+        # Requeued while the worker was busy, eg. after timing out
+        ActionJob.objects.filter(pk=job.pk).update(status=ActionJob.QUEUED)
+        self.run_job(job, 2)
+        self.assertEqual(job.processed, 0)
+        self.assertEqual(Song.music.available().count(), 0)
+
+
+class ReplayWaitTests(TestCase):
+    '''
+    Changes to the replay waits are handed to the "updatenextplay" command.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        store = Store.objects.create(iri='file:///music/song.ogg', length=100)
+        Song.objects.bulk_create([
+            Song(title='Song {}'.format(i),
+                 sorted_title='song {}'.format(i),
+                 active_store=store,
+                 last_played=published,
+                 published_date=published)
+            for i in range(3)
+        ])
+        PlaylistAggregate.objects.reconcile()
+
+    def setUp(self):
+        PlaylistAggregate.objects.claim_next_play_update()
+
+    def run_command(self, *args):
+        updatenextplay.Command(stdout=StringIO()).run_from_argv(
+            ['manage.py', 'updatenextplay'] + list(args)
+        )
+
+    def test_setting_change_flags_update(self):
+        set_setting('replay_ratio', 0.5)
+        setting_cache.clear()
+        self.assertTrue(PlaylistAggregate.objects.get().next_play_stale)
+
+        self.run_command()
+        self.assertFalse(PlaylistAggregate.objects.get().next_play_stale)
+        song = Song.objects.first()
+        self.assertEqual(song.next_play, song.get_date_when_requestable())
+
+    def test_length_change_flags_update(self):
+        PlaylistAggregate.objects.adjust(count=1)
+        self.assertFalse(PlaylistAggregate.objects.get().next_play_stale)
+        PlaylistAggregate.objects.adjust(length=60, count=1)
+        self.assertTrue(PlaylistAggregate.objects.claim_next_play_update())
+
+        PlaylistAggregate.objects.reconcile()
+        self.assertTrue(PlaylistAggregate.objects.claim_next_play_update())
+        PlaylistAggregate.objects.reconcile()
+        self.assertFalse(PlaylistAggregate.objects.claim_next_play_update())
+
+
+class PlaylistTotalsTests(TestCase):
+    '''
+    Saving songs keeps the playlist totals current as they go.
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        cls.store = Store.objects.create(iri='file:///music/a.ogg',
+                                         length=100)
+        cls.other_store = Store.objects.create(iri='file:///music/b.ogg',
+                                               length=40)
+        cls.song = Song.objects.create(title='Song',
+                                       active_store=cls.store,
+                                       published_date=published)
+
+    def totals(self):
+        aggregate = PlaylistAggregate.objects.get()
+        return aggregate.total_length, aggregate.song_count
+
+    def test_save_uses_loaded_values(self):
+        song = Song.objects.select_related('active_store').get()
+        song.disabled = True
+        # The save, the totals update and clearing planned requests, without
+        # looking the song up again
+        with self.assertNumQueries(3):
+            song.save()
+        self.assertEqual(self.totals(), (0, 0))
+
+        song.disabled = False
+        song.save()
+        self.assertEqual(self.totals(), (100, 1))
+
+    def test_swapped_store(self):
+        song = Song.objects.get()
+        song.active_store = self.other_store
+        song.save()
+        self.assertEqual(self.totals(), (40, 1))
+
+    def test_deferred_fields(self):
+        song = Song.objects.only('id', 'title').get()
+        song.save()
+        self.assertEqual(self.totals(), (100, 1))
+
+    def test_request_state_follows_publish_dates(self):
+        later = Song.objects.create(
+            title='Later',
+            active_store=self.other_store,
+            published_date=timezone.now() + timedelta(hours=1)
+        )
+        song = Song.music.get_queryset().with_request_state().get(
+            pk=self.song.pk
+        )
+        self.assertEqual(song.playlist_total_length, 100)
+
+        # An hour later
+        past = timezone.now() - timedelta(seconds=1)
+        Song.objects.filter(pk=later.pk).update(published_date=past)
+        PlaylistAggregate.objects.update(stale_date=past)
+        song = Song.music.get_queryset().with_request_state().get(
+            pk=self.song.pk
+        )
+        self.assertIsNone(song.playlist_total_length)
+        self.assertEqual(Song.music.playlist_length(), 140)
+
+
+class CachedStoreTests(TestCase):
+    '''
+    Local copies of the remote stores the DJ is about to play.
+    '''
+    MIB = 1024 * 1024
+
+    @classmethod
+    def setUpTestData(cls):
+        published = timezone.now() - timedelta(days=1)
+        cls.stores = [
+            Store.objects.create(iri='s3://radio/{}.ogg'.format(i),
+                                 length=100,
+                                 filehash='hash{}'.format(i))
+            for i in range(4)
+        ]
+        cls.local = Store.objects.create(iri='file:///music/local.ogg',
+                                         length=100)
+        cls.songs = [Song.objects.create(title='Song {}'.format(i),
+                                         active_store=store,
+                                         published_date=published)
+                     for i, store in enumerate(cls.stores + [cls.local])]
+        user = RadioUser.objects.create(email='listener@example.com',
+                                        name='Listener')
+        cls.profile = user.radioprofile
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def request(self, song, **kwargs):
+        return SongRequest.objects.create(profile=self.profile,
+                                          song=song,
+                                          **kwargs)
+
+    def cache(self, store, name=None, size=MIB, last_used=None):
+        path = os.path.join(self.directory, name or store.filehash)
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+        return CachedStore.objects.create(
+            store=store,
+            path=path,
+            file_size=size,
+            filehash=store.filehash,
+            last_used=last_used or timezone.now()
+        )
+
+    def test_upcoming_order(self):
+        now = timezone.now()
+        songs = self.songs
+        self.request(songs[3], queued_at=now, played_at=now)
+        self.request(songs[1], queued_at=now)
+        self.request(songs[0], queued_at=now - timedelta(minutes=5))
+        self.request(songs[2])
+        self.request(songs[0])
+        self.request(songs[4])
+
+        # Queued first (oldest first), then waiting, each store only once,
+        # leaving out local and already played stores
+        stores = self.stores
+        self.assertEqual(CachedStore.objects.upcoming_stores(10),
+                         [stores[0], stores[1], stores[2]])
+        self.assertEqual(CachedStore.objects.upcoming_stores(0),
+                         [stores[0], stores[1]])
+
+    @override_settings(RADIO_CACHE_SIZE=2)
+    def test_evict_to_budget(self):
+        start = timezone.now() - timedelta(hours=1)
+        cached = [self.cache(store, last_used=start + timedelta(minutes=i))
+                  for i, store in enumerate(self.stores)]
+
+        # The oldest copy is upcoming, so the next two oldest go
+        command = cachestores.Command()
+        self.assertEqual(command.evict([self.stores[0].pk]), 2)
+        self.assertEqual(
+            set(CachedStore.objects.values_list('store', flat=True)),
+            {self.stores[0].pk, self.stores[3].pk}
+        )
+        self.assertTrue(os.path.exists(cached[0].path))
+        self.assertFalse(os.path.exists(cached[1].path))
+        self.assertFalse(os.path.exists(cached[2].path))
+
+        # Within budget, nothing else goes
+        self.assertEqual(command.evict([]), 0)
+
+    @override_settings(RADIO_CACHE_SIZE=1)
+    def test_shared_file_kept(self):
+        start = timezone.now() - timedelta(hours=1)
+        first = self.cache(self.stores[0], name='same', last_used=start)
+        second = self.cache(self.stores[1], name='same')
+
+        command = cachestores.Command()
+        self.assertEqual(command.evict([]), 1)
+        self.assertFalse(CachedStore.objects.filter(pk=first.pk).exists())
+        self.assertTrue(os.path.exists(second.path))
+
+    def test_path_of_warm_copy_only(self):
+        song = self.songs[0]
+        cached = self.cache(self.stores[0], size=10)
+
+        def path():
+            song = Song.objects.select_related(
+                'active_store__cached'
+            ).get(pk=self.songs[0].pk)
+            return RadioSongSerializer(song).data['path']
+
+        self.assertEqual(path(), cached.path)
+
+        # The copy changed size on disk
+        with open(cached.path, 'ab') as file:
+            file.write(b'x')
+        self.assertEqual(path(), song.active_store.iri)
+
+        # The copy has different content than the store expects
+        CachedStore.objects.filter(pk=cached.pk).update(file_size=11,
+                                                        filehash='other')
+        self.assertEqual(path(), song.active_store.iri)
+
+        # The copy is gone
+        CachedStore.objects.filter(pk=cached.pk).update(
+            filehash=self.stores[0].filehash
+        )
+        self.assertEqual(path(), cached.path)
+        os.remove(cached.path)
+        self.assertEqual(path(), song.active_store.iri)
@@ -36,6 +36,21 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = 'core.RadioUser'
 
+# The local-memory default is private to each process. With more than one
+# worker, use a shared backend (memcached, redis, database) so that retries
+# with an 'Idempotency-Key' (on /next/ and the bulk played reports) get
+# their first response back whichever worker they reach, and so that saved
+# dynamic settings are picked up by every worker right away.
+CACHES = {
+    'default': {
+        'BACKEND': config(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': config('CACHE_LOCATION', default='')
+    }
+}
+
 DATABASES = {
     'default': config(
         'DATABASE_URL',
@@ -144,3 +159,35 @@ REST_FRAMEWORK = {
 RADIO_DJ_EMAIL = config('RADIO_DJ_EMAIL', default='dj@radiostation.net')
 
 RADIO_DJ_NAME = config('RADIO_DJ_NAME', default='DJ Reinhardt')
+
+# Seconds before the in-process cache of dynamic settings is reloaded
+DYNAMIC_SETTING_CACHE_TTL = config('DYNAMIC_SETTING_CACHE_TTL',
+                                   default=60,
+                                   cast=int)
+
+# Directory holding local copies of the upcoming "s3://" songs (see the
+# "cachestores" command), or nothing to always play them remotely
+RADIO_CACHE_DIR = config('RADIO_CACHE_DIR', default='')
+
+# Size (in MiB) the local copies are trimmed back to
+RADIO_CACHE_SIZE = config('RADIO_CACHE_SIZE', default=4096, cast=int)
+
+# Number of waiting requests whose songs are downloaded ahead of time
+RADIO_CACHE_AHEAD = config('RADIO_CACHE_AHEAD', default=10, cast=int)
+
+# If these four are not defined, then boto3 will look for defaults in the
+# ~/.aws configurations
+S3_REGION = config('S3_REGION', default=None)
+S3_ENDPOINT = config('S3_ENDPOINT', default=None)
+S3_ACCESS_KEY = config('S3_ACCESS_KEY', default=None)
+S3_SECRET_KEY = config('S3_SECRET_KEY', default=None)
+
+# Admin actions on more items than this are queued and applied this many
+# items at a time by the "runactions" command
+RADIO_ACTION_CHUNK_SIZE = config('RADIO_ACTION_CHUNK_SIZE',
+                                 default=500,
+                                 cast=int)
+
+# Running admin action jobs that haven't finished a chunk for this many
+# seconds are taken to be stuck, and can be requeued
+RADIO_ACTION_TIMEOUT = config('RADIO_ACTION_TIMEOUT', default=600, cast=int)